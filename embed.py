@@ -1,6 +1,7 @@
-from embeoj.export import export
+from embeoj.export import export, create_pbg_config
 from embeoj.preprocess import preprocess_exported_data
-from embeoj.train import convert_tsv_to_pbg, train_embeddings
+from embeoj.train import convert_graph_to_pbg, train_embeddings
+from embeoj.metrics import set_profiling
 from embeoj.utils import update_config, test_db_connection, logging
 import click
 import sys
@@ -35,10 +36,23 @@ import sys
     hide_input=True,
 )
 @click.option("--config_path", default=None, help="path to a yml configuration file")
-def embed(config_path, project_name, url, username, password, train):
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="dump cProfile stats of each stage to <project_name>/profiles",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="warm start from the previous checkpoint and train for INCREMENTAL_CONFIG epochs",
+)
+def embed(
+    config_path, project_name, url, username, password, train, profile, incremental
+):
     """Command line interface for training and generating graph embeddings
     """
     try:
+        set_profiling(profile)
         # test run to check for db connection
         if not test_db_connection():
             logging.info("could not connect to Neo4j")
@@ -53,9 +67,10 @@ def embed(config_path, project_name, url, username, password, train):
                 neo4j_password=password,
             )
             export()  # export graph data to tsv json file
-            preprocess_exported_data()  # convert to tsv file for biggraph to read
-            convert_tsv_to_pbg()  # process data files for training
-            train_embeddings()  # train
+            relations_df = preprocess_exported_data()  # read nodes and relationships
+            create_pbg_config()  # config.json from the schema found in preprocessing
+            convert_graph_to_pbg(relations_df)  # process data files for training
+            train_embeddings(incremental=incremental)  # train
             logging.info("Done....")
 
     except Exception as e:
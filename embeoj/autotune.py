@@ -0,0 +1,184 @@
+"""Chooses the number of partitions, bucket order, batch size and workers for PBG training
+from the entity and relation counts in metadata.json and a memory budget
+"""
+from pathlib import os
+import json
+import math
+from embeoj.utils import logging
+
+FLOAT_BYTES = 4
+EDGE_BYTES = 3 * 8  # lhs, rhs and rel offsets are stored as int64
+BASELINE_BYTES = 512 * 1024 ** 2  # python, torch and PBG buffers
+HEADROOM = 1.2  # allocator fragmentation and temporary copies
+BATCH_MEMORY_FRACTION = 0.25  # share of the budget the workers' batches may use
+
+
+def get_available_cpus():
+    """number of cores this process may run on (respects taskset/cgroup affinity)
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def estimate_embedding_bytes(entity_counts, num_partitions, dimension, background_io):
+    """memory of the entity partitions held at the same time while training one bucket.
+    PBG keeps the lhs and rhs partitions of each partitioned type in memory
+    (one more when the next bucket is prefetched with background_io)
+    and one Adagrad state value per row.
+    """
+    row_bytes = dimension * FLOAT_BYTES + FLOAT_BYTES
+    partitions_in_memory = min(num_partitions, 3 if background_io else 2)
+    total = 0
+    for count in entity_counts.values():
+        rows_per_partition = math.ceil(count / num_partitions)
+        total += partitions_in_memory * rows_per_partition * row_bytes
+    return total
+
+
+def estimate_bucket_bytes(num_edges, num_partitions, num_edge_chunks):
+    """memory of the largest edge bucket, assuming edges are spread evenly over the buckets
+    """
+    edges_per_bucket = math.ceil(num_edges / num_partitions ** 2 / (num_edge_chunks or 1))
+    return edges_per_bucket * EDGE_BYTES
+
+
+def estimate_batch_bytes(batch_size, dimension, num_negatives):
+    """working memory of one worker for one batch: positive embeddings of both sides,
+    negative embeddings and the score matrix, doubled for the backward pass
+    """
+    return 2 * batch_size * (2 * dimension + num_negatives + dimension) * FLOAT_BYTES
+
+
+def estimate_model_bytes(num_relations, dimension, operator):
+    if operator in ("linear", "affine"):
+        return num_relations * (dimension ** 2 + dimension) * FLOAT_BYTES
+    return num_relations * dimension * FLOAT_BYTES
+
+
+def choose_batch_size(pbg_settings, dimension, workers, memory_budget, edges_per_bucket):
+    """largest batch size up to the configured one that fits the batch memory share
+    and still gives every worker a batch of the bucket. PBG requires the batch size
+    to be a multiple of num_batch_negs.
+    """
+    num_batch_negs = max(int(pbg_settings["num_batch_negs"]), 1)
+    num_negatives = pbg_settings["num_batch_negs"] + pbg_settings["num_uniform_negs"]
+    per_edge_bytes = estimate_batch_bytes(1, dimension, num_negatives)
+    batch_size = int(pbg_settings["batch_size"])
+    batch_size = min(
+        batch_size, int(memory_budget * BATCH_MEMORY_FRACTION / workers / per_edge_bytes)
+    )
+    batch_size = min(batch_size, max(edges_per_bucket // workers, num_batch_negs))
+    return max(batch_size // num_batch_negs, 1) * num_batch_negs
+
+
+def choose_bucket_order(num_partitions, configured_order):
+    """with many partitions swapping dominates, affinity reuses one side of the
+    previous bucket; inside_out is the PBG default for few partitions
+    """
+    if num_partitions == 1:
+        return configured_order
+    if num_partitions >= 4:
+        return "affinity"
+    return "inside_out"
+
+
+def autotune(schema, global_config, pbg_settings, autotune_config):
+    """Chooses the training settings for the given memory budget.
+    The smallest number of partitions whose estimated peak memory fits the budget
+    is chosen, since every extra partition adds swapping between buckets.
+
+    Arguments:
+        schema {[dict]} -- schema from metadata.json (entity_counts, relations, num_edges)
+        global_config {[dict]} -- GLOBAL_CONFIG
+        pbg_settings {[dict]} -- OPTIONAL_PBG_SETTINGS
+        autotune_config {[dict]} -- AUTOTUNE_CONFIG
+
+    Returns:
+        [dict] -- chosen settings and the memory estimate behind them
+    """
+    from embeoj.resources import get_stage_threads  # resources imports this module
+
+    dimension = int(global_config["EMBEDDING_DIMENSIONS"])
+    memory_budget = int(float(autotune_config["MEMORY_BUDGET_GB"]) * 1024 ** 3)
+    entity_counts = schema["entity_counts"]
+    num_edges = schema["num_edges"]
+    num_relations = len(schema["relations"])
+    # ranks of a single host distributed run share the memory and the cores,
+    # and each rank needs two partitions it can lock
+    num_machines = max(int(pbg_settings["num_machines"]), 1)
+    workers = pbg_settings["workers"] or max(get_stage_threads("TRAIN") // num_machines, 1)
+    num_negatives = pbg_settings["num_batch_negs"] + pbg_settings["num_uniform_negs"]
+    model_bytes = estimate_model_bytes(num_relations, dimension, pbg_settings["operator"])
+
+    candidates = []
+    chosen = None
+    num_partitions = 1
+    while num_machines > 1 and num_partitions < 2 * num_machines:
+        num_partitions *= 2
+    max_partitions = max(int(autotune_config["MAX_PARTITIONS"]), num_partitions)
+    while num_partitions <= max_partitions:
+        edges_per_bucket = math.ceil(num_edges / num_partitions ** 2)
+        batch_size = choose_batch_size(
+            pbg_settings, dimension, workers, memory_budget, edges_per_bucket
+        )
+        estimate = dict(
+            embeddings_bytes=num_machines
+            * estimate_embedding_bytes(
+                entity_counts, num_partitions, dimension, pbg_settings["background_io"]
+            ),
+            bucket_bytes=num_machines
+            * estimate_bucket_bytes(num_edges, num_partitions, pbg_settings["num_edge_chunks"]),
+            batch_bytes=num_machines
+            * workers
+            * estimate_batch_bytes(batch_size, dimension, num_negatives),
+            model_bytes=model_bytes,
+            baseline_bytes=num_machines * BASELINE_BYTES,
+        )
+        estimate["total_bytes"] = int(sum(estimate.values()) * HEADROOM)
+        candidate = dict(num_partitions=num_partitions, batch_size=batch_size, **estimate)
+        candidates.append(candidate)
+        if estimate["total_bytes"] <= memory_budget:
+            chosen = candidate
+            break
+        partitioned_bytes = estimate["embeddings_bytes"] + estimate["bucket_bytes"]
+        if partitioned_bytes * HEADROOM < 0.05 * estimate["total_bytes"]:
+            break  # more partitions can no longer bring the estimate under the budget
+        num_partitions *= 2
+    if chosen is None:
+        chosen = candidates[-1]
+        logging.info(
+            f"AUTOTUNE: no partitioning up to {chosen['num_partitions']} fits "
+            f"{autotune_config['MEMORY_BUDGET_GB']} GB, using {chosen['num_partitions']} partitions"
+        )
+    settings = dict(
+        num_partitions=chosen["num_partitions"],
+        bucket_order=choose_bucket_order(
+            chosen["num_partitions"], pbg_settings["bucket_order"]
+        ),
+        batch_size=chosen["batch_size"],
+        workers=workers,
+    )
+    logging.info(
+        f"AUTOTUNE: {settings}, estimated peak memory "
+        f"{chosen['total_bytes'] / 1024 ** 3:.2f} GB of {autotune_config['MEMORY_BUDGET_GB']} GB"
+    )
+    return dict(
+        settings=settings,
+        memory_budget_bytes=memory_budget,
+        available_cpus=get_available_cpus(),
+        fits_budget=chosen["total_bytes"] <= memory_budget,
+        estimate=chosen,
+        candidates=candidates,
+    )
+
+
+def save_autotune_report(report, checkpoint_directory):
+    """saves the estimate next to config.json (default: myproject/model/autotune.json)
+    """
+    report_path = os.path.join(checkpoint_directory, "autotune.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    f.close()
+    logging.info(f"AUTOTUNE ESTIMATE SAVED TO {report_path}")
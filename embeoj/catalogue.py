@@ -0,0 +1,213 @@
+"""Compact on-disk catalogue of the node ids of all trained partitions
+
+data/entity_catalogue/
+    ids.npy               int64 node ids of all partitions, one partition after the other
+    sorted_ids.npy        the same ids sorted, for reverse lookup with a binary search
+    sorted_positions.npy  position in ids.npy of each sorted id
+    partitions.json       entity type, partition number, offset and count of each partition
+                          and a fingerprint of all ids
+
+The arrays are memory mapped, so opening the catalogue takes constant time and only
+the pages touched by a lookup are read. Training saves the fingerprint of the catalogue
+it trained on in the checkpoint directory (entity_fingerprint.txt), so embedding rows
+are never mapped to the ids of other entity files.
+"""
+from pathlib import os
+import hashlib
+import json
+import numpy as np
+from embeoj.utils import logging
+
+CATALOGUE_DIRECTORY = "entity_catalogue"
+FINGERPRINT_FILE = "entity_fingerprint.txt"
+
+
+def get_catalogue_directory(data_directory):
+    return os.path.join(data_directory, CATALOGUE_DIRECTORY)
+
+
+def parse_entity_file(entity_file):
+    """finds the entity type and partition of an entity_names_<type>_<part>.json file name
+    """
+    name = os.path.splitext(entity_file)[0]
+    partition_number = int(name.split("_")[-1])
+    entity_type = "_".join(
+        name.replace("entity_names_", "", 1).split("_")[:-1]
+    ).strip("_")
+    return entity_type, partition_number
+
+
+def build_entity_catalogue(data_directory, entity_files):
+    """Reads the entity_names json files written by the converter and saves their ids
+    in the catalogue format
+
+    Arguments:
+        data_directory {[str]} -- directory with the entity_names files
+        entity_files {[list]} -- names of the entity_names files, in partition order
+    """
+    catalogue_directory = get_catalogue_directory(data_directory)
+    os.makedirs(catalogue_directory, exist_ok=True)
+    partitions = []
+    all_ids = []
+    offset = 0
+    for entity_file in entity_files:
+        entity_type, partition_number = parse_entity_file(entity_file)
+        with open(os.path.join(data_directory, entity_file), "r") as f:
+            entity_ids = np.array(json.load(f), dtype=np.int64)
+        f.close()
+        partitions.append(
+            dict(
+                entity_type=entity_type,
+                partition_number=partition_number,
+                entity_file=entity_file,
+                offset=offset,
+                count=len(entity_ids),
+            )
+        )
+        all_ids.append(entity_ids)
+        offset += len(entity_ids)
+    ids = np.concatenate(all_ids) if all_ids else np.empty((0,), dtype=np.int64)
+    sorted_positions = np.argsort(ids, kind="stable")
+    np.save(os.path.join(catalogue_directory, "ids.npy"), ids)
+    np.save(os.path.join(catalogue_directory, "sorted_ids.npy"), ids[sorted_positions])
+    np.save(os.path.join(catalogue_directory, "sorted_positions.npy"), sorted_positions)
+    fingerprint = hashlib.sha1(json.dumps(partitions).encode("utf-8"))
+    fingerprint.update(ids.tobytes())
+    with open(os.path.join(catalogue_directory, "partitions.json"), "w") as f:
+        json.dump(dict(partitions=partitions, fingerprint=fingerprint.hexdigest()), f)
+    f.close()
+    logging.info(
+        f"ENTITY CATALOGUE WITH {len(ids)} IDS IN {len(partitions)} PARTITIONS "
+        f"SAVED TO {catalogue_directory}"
+    )
+
+
+def save_trained_fingerprint(data_directory, checkpoint_directory):
+    """records in the checkpoint directory which catalogue the checkpoint is trained on
+    """
+    fingerprint = load_entity_catalogue(data_directory)["fingerprint"]
+    with open(os.path.join(checkpoint_directory, FINGERPRINT_FILE), "w") as f:
+        f.write(f"{fingerprint}\n")
+    f.close()
+
+
+def read_trained_fingerprint(checkpoint_directory):
+    """fingerprint of the catalogue the checkpoint was trained on, None if not recorded
+    """
+    fingerprint_path = os.path.join(checkpoint_directory, FINGERPRINT_FILE)
+    if not os.path.exists(fingerprint_path):
+        return None
+    with open(fingerprint_path, "r") as f:
+        fingerprint = f.read().strip()
+    f.close()
+    return fingerprint or None
+
+
+def check_trained_fingerprint(catalogue, checkpoint_directory):
+    """Raises ValueError if the checkpoint was trained on other entity files than the
+    catalogue, whose rows would then be mapped to the wrong nodes
+    """
+    trained_fingerprint = read_trained_fingerprint(checkpoint_directory)
+    if trained_fingerprint is None:
+        logging.info("no entity fingerprint in the checkpoint, can't check the catalogue")
+    elif trained_fingerprint != catalogue["fingerprint"]:
+        raise ValueError(
+            "the entity files changed since the checkpoint was trained, "
+            "run embed.py again before using the embeddings"
+        )
+
+
+def load_entity_catalogue(data_directory, checkpoint_directory=None):
+    """Opens the catalogue with memory mapped arrays
+
+    Arguments:
+        data_directory {[str]} -- data directory of the project
+
+    Keyword Arguments:
+        checkpoint_directory {[str]} -- checks that the checkpoint in this directory was
+        trained on the catalogue (default: {None})
+
+    Returns:
+        [dict] -- partitions list, ids, sorted_ids, sorted_positions, partition offsets
+        and fingerprint
+    """
+    catalogue_directory = get_catalogue_directory(data_directory)
+    with open(os.path.join(catalogue_directory, "partitions.json"), "r") as f:
+        saved = json.load(f)
+    f.close()
+    partitions = saved["partitions"]
+    catalogue = dict(partitions=partitions, fingerprint=saved.get("fingerprint"))
+    for array_name in ["ids", "sorted_ids", "sorted_positions"]:
+        catalogue[array_name] = np.load(
+            os.path.join(catalogue_directory, f"{array_name}.npy"), mmap_mode="r"
+        )
+    catalogue["offsets"] = np.array([p["offset"] for p in partitions], dtype=np.int64)
+    if checkpoint_directory is not None:
+        check_trained_fingerprint(catalogue, checkpoint_directory)
+    return catalogue
+
+
+def get_partition_ids(catalogue, partition_index):
+    """node ids of one partition in embedding row order
+
+    Arguments:
+        catalogue {[dict]} -- catalogue from load_entity_catalogue
+        partition_index {[int]} -- position of the partition in catalogue["partitions"]
+
+    Returns:
+        [np.ndarray] -- memory mapped int64 ids
+    """
+    partition = catalogue["partitions"][partition_index]
+    return catalogue["ids"][partition["offset"]:partition["offset"] + partition["count"]]
+
+
+def lookup_entity(catalogue, entity_id):
+    """Finds the partition and the embedding row of a node id
+
+    Arguments:
+        catalogue {[dict]} -- catalogue from load_entity_catalogue
+        entity_id {[int]} -- node id
+
+    Returns:
+        [dict] -- entity_type, partition_number, entity_index, entity_file and
+        partition_index, None if the node was not trained
+    """
+    entity_id = int(entity_id)
+    sorted_ids = catalogue["sorted_ids"]
+    position = int(np.searchsorted(sorted_ids, entity_id))
+    if position >= len(sorted_ids) or sorted_ids[position] != entity_id:
+        return None
+    row = int(catalogue["sorted_positions"][position])
+    partition_index = int(np.searchsorted(catalogue["offsets"], row, side="right") - 1)
+    partition = catalogue["partitions"][partition_index]
+    return dict(
+        entity_type=partition["entity_type"],
+        partition_number=partition["partition_number"],
+        entity_index=row - partition["offset"],
+        entity_file=partition["entity_file"],
+        partition_index=partition_index,
+    )
+
+
+def lookup_entities(catalogue, entity_ids):
+    """vectorised lookup_entity for many node ids
+
+    Arguments:
+        catalogue {[dict]} -- catalogue from load_entity_catalogue
+        entity_ids {[np.ndarray]} -- int64 node ids
+
+    Returns:
+        [tuple] -- partition index and embedding row of every id, -1 for ids that were not trained
+    """
+    entity_ids = np.asarray(entity_ids, dtype=np.int64)
+    sorted_ids = catalogue["sorted_ids"]
+    partition_index = np.full(len(entity_ids), -1, dtype=np.int64)
+    entity_index = np.full(len(entity_ids), -1, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return partition_index, entity_index
+    position = np.minimum(np.searchsorted(sorted_ids, entity_ids), len(sorted_ids) - 1)
+    found = np.asarray(sorted_ids[position]) == entity_ids
+    row = np.asarray(catalogue["sorted_positions"][position[found]])
+    partition_index[found] = np.searchsorted(catalogue["offsets"], row, side="right") - 1
+    entity_index[found] = row - catalogue["offsets"][partition_index[found]]
+    return partition_index, entity_index
@@ -0,0 +1,191 @@
+"""Compressed json exports (COMPRESSION_CONFIG).
+gzip exports are compressed by APOC on the server, or locally when the export is
+streamed through the driver; zstd exports are always streamed, since APOC can't write
+zstd. Reading decompresses line by line so the file never has to fit in memory,
+with pigz in a separate process for gzip when it is installed
+"""
+from contextlib import contextmanager
+from pathlib import os
+import gzip
+import io
+import shutil
+import subprocess
+import time
+from embeoj.utils import logging
+
+EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+APOC_COMPRESSION = {"gzip": "GZIP"}  # formats APOC can write itself
+
+
+def get_compression_format(compression_config):
+    """configured format, None for plain json
+
+    Raises:
+        ValueError -- for formats other than gzip and zstd
+    """
+    compression_format = (compression_config or dict()).get("FORMAT")
+    if compression_format not in EXTENSIONS:
+        raise ValueError(f"unknown compression format {compression_format}, use gzip or zstd")
+    return compression_format
+
+
+def get_export_path(data_directory, export_file, compression_format):
+    """path of the json export, e.g. myproject/data/graph.json.gz
+    """
+    return os.path.join(data_directory, export_file + ".json" + EXTENSIONS[compression_format])
+
+
+def find_export_path(data_directory, export_file, compression_format, read_other_formats=False):
+    """the export in the configured format. With read_other_formats
+    (COMPRESSION_CONFIG["READ_OTHER_FORMATS"]) the most recently written export in any
+    format is used instead, with a warning, e.g. after the compression setting was changed
+
+    Raises:
+        FileNotFoundError -- if the export to read doesn't exist
+    """
+    export_path = get_export_path(data_directory, export_file, compression_format)
+    existing = [
+        get_export_path(data_directory, export_file, other_format)
+        for other_format in EXTENSIONS
+        if os.path.exists(get_export_path(data_directory, export_file, other_format))
+    ]
+    newest_path = max(existing, key=os.path.getmtime) if existing else export_path
+    if not read_other_formats:
+        if not os.path.exists(export_path):
+            raise FileNotFoundError(
+                f"the export {export_path} doesn't exist, export the graph again "
+                "or set COMPRESSION_CONFIG.READ_OTHER_FORMATS to read "
+                + (newest_path if existing else "an export in another format")
+            )
+        if newest_path != export_path:
+            logging.warning(f"{newest_path} is newer than the export {export_path} read")
+        return export_path
+    if not existing:
+        raise FileNotFoundError(f"no export of {export_file} in {data_directory}")
+    if newest_path != export_path:
+        written = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(newest_path))
+        )
+        state = "older" if os.path.exists(export_path) else "missing"
+        logging.warning(
+            f"the export {export_path} is {state}, reading {newest_path} written at "
+            f"{written}. Export again if that file is stale"
+        )
+    return newest_path
+
+
+def get_file_format(file_path):
+    for compression_format, extension in EXTENSIONS.items():
+        if compression_format and file_path.endswith(extension):
+            return compression_format
+    return None
+
+
+def import_zstandard():
+    try:
+        import zstandard
+
+        return zstandard
+    except ImportError:
+        raise ImportError("zstd compressed exports need the zstandard package: pip install zstandard")
+
+
+def get_threads(compression_config):
+    return int((compression_config or dict()).get("THREADS") or os.cpu_count() or 1)
+
+
+@contextmanager
+def open_compressed_writer(file_path, compression_format, compression_config=None):
+    """Opens a binary file that compresses what is written to it. zstd compresses with
+    THREADS threads
+
+    Arguments:
+        file_path {[str]} -- path of the compressed file
+        compression_format {[str]} -- gzip or zstd
+    """
+    level = (compression_config or dict()).get("LEVEL")
+    if compression_format == "gzip":
+        with gzip.open(file_path, "wb", compresslevel=level or 6) as f:
+            yield f
+    elif compression_format == "zstd":
+        zstandard = import_zstandard()
+        compressor = zstandard.ZstdCompressor(
+            level=level or 3, threads=get_threads(compression_config)
+        )
+        with open(file_path, "wb") as raw_file:
+            with compressor.stream_writer(raw_file) as f:
+                yield f
+    else:
+        with open(file_path, "wb") as f:
+            yield f
+
+
+@contextmanager
+def open_text_reader(file_path, compression_config=None):
+    """Opens a plain, gzip or zstd file (chosen by its extension) for reading text line
+    by line. gzip is decompressed by pigz in a separate process when it is installed,
+    so decompression runs in parallel with parsing
+
+    Arguments:
+        file_path {[str]} -- path of the file
+    """
+    compression_format = get_file_format(file_path)
+    if compression_format == "gzip" and shutil.which("pigz"):
+        process = subprocess.Popen(
+            ["pigz", "-dc", "-p", str(get_threads(compression_config)), file_path],
+            stdout=subprocess.PIPE,
+        )
+        try:
+            yield io.TextIOWrapper(process.stdout, encoding="utf-8")
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            raise IOError(f"pigz failed to decompress {file_path}")
+    elif compression_format == "gzip":
+        with gzip.open(file_path, "rt", encoding="utf-8") as f:
+            yield f
+    elif compression_format == "zstd":
+        zstandard = import_zstandard()
+        with open(file_path, "rb") as raw_file:
+            reader = zstandard.ZstdDecompressor().stream_reader(raw_file)
+            yield io.TextIOWrapper(reader, encoding="utf-8")
+    else:
+        with open(file_path, "r") as f:
+            yield f
+
+
+def get_apoc_compression(compression_format, stream):
+    """compression setting for the APOC export config, None when the export is
+    streamed and compressed locally
+    """
+    if stream or compression_format not in APOC_COMPRESSION:
+        return None
+    return APOC_COMPRESSION[compression_format]
+
+
+def write_streamed_export(records, file_path, compression_format, compression_config=None):
+    """Writes the data column of a streamed APOC export (stream: true) batch by batch
+
+    Arguments:
+        records {[iterable]} -- cursor of the export query
+        file_path {[str]} -- path of the (compressed) export
+
+    Returns:
+        [int] -- number of batches written
+    """
+    num_batches = 0
+    with open_compressed_writer(file_path, compression_format, compression_config) as f:
+        for record in records:
+            data = record["data"]
+            if not data:
+                continue
+            f.write(data.encode("utf-8"))
+            if not data.endswith("\n"):
+                f.write(b"\n")  # batches don't end with a line break
+            num_batches += 1
+    logging.info(f"WROTE {num_batches} STREAMED BATCHES TO {file_path}")
+    return num_batches
@@ -0,0 +1,163 @@
+"""Converts the preprocessed relationships directly into the entity files and partitioned
+edge buckets read by PBG, without writing and re-parsing the intermediate tsv file
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, os
+import json
+import h5py
+import numpy as np
+import pandas as pd
+from embeoj.utils import logging
+
+FORMAT_VERSION = 1  # version of the PBG edge file format
+RANDOM_SEED = 0
+
+
+def assign_entity_offsets(ids, num_partitions, rng):
+    """Assigns dense integer ids to the nodes of one entity type: nodes are shuffled and
+    spread round robin over the partitions so every partition gets the same number
+    of nodes, as PBG's converter does
+
+    Arguments:
+        ids {[np.ndarray]} -- node id of every edge endpoint of this type
+        num_partitions {[int]} -- number of partitions of the entity type
+        rng {[np.random.Generator]} -- random generator for the shuffle
+
+    Returns:
+        [tuple] -- partition and offset of every endpoint, names of each partition
+    """
+    codes, unique_ids = pd.factorize(ids)
+    order = rng.permutation(len(unique_ids))
+    position = np.empty(len(unique_ids), dtype=np.int64)
+    position[order] = np.arange(len(unique_ids))
+    shuffled_ids = unique_ids[order]
+    partition_names = [
+        shuffled_ids[partition::num_partitions] for partition in range(num_partitions)
+    ]
+    endpoint_position = position[codes]
+    return (
+        endpoint_position % num_partitions,
+        endpoint_position // num_partitions,
+        partition_names,
+    )
+
+
+def get_relation_indexes(relation_df, relations):
+    """index of each edge's relation in the PBG config, matched on (lhs, type, rhs)
+    so a relationship type used between several label pairs maps to the right entry
+
+    Returns:
+        [np.ndarray] -- relation index per edge, -1 if the relation is not in the config
+    """
+    columns = ["lhs", "label", "rhs"]
+    config_triples = pd.DataFrame(
+        [(relation.lhs, relation.name, relation.rhs) for relation in relations],
+        columns=columns,
+    )
+    config_triples["rel"] = np.arange(len(relations))
+    rel = (
+        relation_df[columns]
+        .merge(config_triples.drop_duplicates(columns), how="left", on=columns)["rel"]
+        .fillna(-1)
+    )
+    return rel.to_numpy().astype(np.int64)
+
+
+def write_bucket(edge_file, lhs, rhs, rel):
+    """writes one edges_<lhs part>_<rhs part>.h5 bucket in PBG's format
+    """
+    with h5py.File(edge_file, "w") as hf:
+        hf.attrs["format_version"] = FORMAT_VERSION
+        hf.create_dataset("lhs", data=lhs)
+        hf.create_dataset("rhs", data=rhs)
+        hf.create_dataset("rel", data=rel)
+    return len(rel)
+
+
+def write_entity_files(entity_path, entity_type, partition_names):
+    for partition, names in enumerate(partition_names):
+        with open(
+            os.path.join(entity_path, f"entity_count_{entity_type}_{partition}.txt"), "w"
+        ) as f:
+            f.write(f"{len(names)}\n")
+        f.close()
+        with open(
+            os.path.join(entity_path, f"entity_names_{entity_type}_{partition}.json"), "w"
+        ) as f:
+            json.dump([str(name) for name in names], f)
+        f.close()
+
+
+def convert_relations_to_pbg(relation_df, pbg_config, num_workers=None):
+    """Writes the entity count/name files and the partitioned edge buckets for PBG.
+    Ids are mapped with vectorised lookups in this process; only the buckets are written by
+    a pool of worker processes, which receive their slices of the mapped arrays pickled.
+
+    Arguments:
+        relation_df {[Dataframe]} -- relationships with start, label, end, lhs and rhs columns
+        pbg_config {[object]} -- Config Schema object
+
+    Keyword Arguments:
+        num_workers {int} -- processes writing buckets, all cores if None (default: {None})
+
+    Returns:
+        [int] -- number of edges written
+    """
+    rng = np.random.default_rng(RANDOM_SEED)
+    relation_df = relation_df.reset_index(drop=True)
+    rel = get_relation_indexes(relation_df, pbg_config.relations)
+    skipped = int((rel < 0).sum())
+    if skipped:
+        logging.info(f"skipping {skipped} edges whose relation is not in the config")
+    relation_df = relation_df[rel >= 0].reset_index(drop=True)
+    rel = rel[rel >= 0]
+
+    num_edges = len(relation_df)
+    lhs_partition = np.zeros(num_edges, dtype=np.int64)
+    rhs_partition = np.zeros(num_edges, dtype=np.int64)
+    lhs_offset = np.zeros(num_edges, dtype=np.int64)
+    rhs_offset = np.zeros(num_edges, dtype=np.int64)
+    for entity_type, entity_config in pbg_config.entities.items():
+        is_lhs = (relation_df["lhs"] == entity_type).to_numpy()
+        is_rhs = (relation_df["rhs"] == entity_type).to_numpy()
+        ids = np.concatenate(
+            [
+                relation_df["start"].to_numpy()[is_lhs],
+                relation_df["end"].to_numpy()[is_rhs],
+            ]
+        )
+        partitions, offsets, partition_names = assign_entity_offsets(
+            ids, entity_config.num_partitions, rng
+        )
+        num_lhs = int(is_lhs.sum())
+        lhs_partition[is_lhs], lhs_offset[is_lhs] = partitions[:num_lhs], offsets[:num_lhs]
+        rhs_partition[is_rhs], rhs_offset[is_rhs] = partitions[num_lhs:], offsets[num_lhs:]
+        write_entity_files(pbg_config.entity_path, entity_type, partition_names)
+
+    if not pbg_config.relations:
+        logging.info("no relations in the config, no edges to write")
+        return 0
+    nparts_lhs = max(pbg_config.entities[r.lhs].num_partitions for r in pbg_config.relations)
+    nparts_rhs = max(pbg_config.entities[r.rhs].num_partitions for r in pbg_config.relations)
+    bucket = lhs_partition * nparts_rhs + rhs_partition
+    order = np.argsort(bucket, kind="stable")
+    bounds = np.searchsorted(bucket[order], np.arange(nparts_lhs * nparts_rhs + 1))
+    edge_path = Path(pbg_config.edge_paths[0])
+    edge_path.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = []
+        for bucket_index in range(nparts_lhs * nparts_rhs):
+            selected = order[bounds[bucket_index]:bounds[bucket_index + 1]]
+            edge_file = edge_path / (
+                f"edges_{bucket_index // nparts_rhs}_{bucket_index % nparts_rhs}.h5"
+            )
+            futures.append(
+                executor.submit(
+                    write_bucket,
+                    str(edge_file),
+                    lhs_offset[selected],
+                    rhs_offset[selected],
+                    rel[selected],
+                )
+            )
+        return sum(future.result() for future in futures)
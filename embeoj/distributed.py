@@ -0,0 +1,128 @@
+"""Launches PBG distributed training on a single host: one process per trainer rank
+and per partition server, synchronised through a file:// or localhost tcp:// rendezvous
+"""
+from multiprocessing.connection import wait
+from pathlib import os
+import multiprocessing
+import attr
+from embeoj.utils import logging
+
+PARTITION_SERVER_GRACE_SECONDS = 30
+
+
+def get_num_partitions(pbg_config):
+    """number of partitions of the partitioned entity types (1 if none is partitioned)
+    """
+    return max(
+        entity_config.num_partitions for entity_config in pbg_config.entities.values()
+    )
+
+
+def validate_distributed_config(pbg_config):
+    """Checks the partitioning against the number of trainer ranks. A trainer locks both
+    partitions of its bucket, so at least 2 partitions per rank are needed to keep every
+    rank busy, and all partitioned types must have the same number of partitions.
+
+    Raises:
+        ValueError -- if the config can't be trained with num_machines ranks
+    """
+    num_machines = pbg_config.num_machines
+    partition_counts = set(
+        entity_config.num_partitions
+        for entity_config in pbg_config.entities.values()
+        if entity_config.num_partitions > 1
+    )
+    if len(partition_counts) > 1:
+        raise ValueError(
+            f"partitioned entity types have different numbers of partitions: {partition_counts}"
+        )
+    num_partitions = get_num_partitions(pbg_config)
+    if num_partitions < 2 * num_machines:
+        raise ValueError(
+            f"{num_machines} trainer ranks need at least {2 * num_machines} partitions, "
+            f"the config has {num_partitions}. Increase NUM_PARTITIONS or lower num_machines"
+        )
+    if pbg_config.num_partition_servers > 0 and pbg_config.num_partition_servers > num_partitions:
+        raise ValueError(
+            f"{pbg_config.num_partition_servers} partition servers for {num_partitions} partitions"
+        )
+
+
+def get_rendezvous(pbg_config, checkpoint_directory):
+    """keeps a configured distributed_init_method, otherwise uses a fresh file in the
+    checkpoint directory (the file store must not exist when the ranks start)
+    """
+    if pbg_config.distributed_init_method:
+        return pbg_config.distributed_init_method
+    rendezvous_file = os.path.join(checkpoint_directory, "distributed_rendezvous")
+    if os.path.exists(rendezvous_file):
+        os.remove(rendezvous_file)
+    return f"file://{rendezvous_file}"
+
+
+def run_trainer(pbg_config, rank):
+    from torchbiggraph.train import train
+
+    train(pbg_config, rank=rank)
+
+
+def run_partition_server(pbg_config, rank):
+    from torchbiggraph.partitionserver import run_partition_server
+
+    run_partition_server(pbg_config, rank=rank)
+
+
+def launch_distributed_training(pbg_config, checkpoint_directory):
+    """Trains with num_machines trainer ranks (and num_partition_servers partition
+    servers) as local processes. If a rank fails the others are stopped.
+
+    Arguments:
+        pbg_config {[object]} -- Config Schema object with num_machines > 1
+        checkpoint_directory {[str]} -- directory for the file:// rendezvous
+
+    Raises:
+        RuntimeError -- if a trainer or partition server exits with an error
+    """
+    validate_distributed_config(pbg_config)
+    init_method = get_rendezvous(pbg_config, checkpoint_directory)
+    pbg_config = attr.evolve(pbg_config, distributed_init_method=init_method)
+    context = multiprocessing.get_context("spawn")
+    trainers = [
+        context.Process(
+            target=run_trainer, args=(pbg_config, rank), name=f"pbg-trainer-{rank}"
+        )
+        for rank in range(pbg_config.num_machines)
+    ]
+    partition_servers = [
+        context.Process(
+            target=run_partition_server,
+            args=(pbg_config, rank),
+            name=f"pbg-partition-server-{rank}",
+        )
+        for rank in range(max(pbg_config.num_partition_servers, 0))
+    ]
+    logging.info(
+        f"STARTING {len(trainers)} TRAINER RANKS AND {len(partition_servers)} "
+        f"PARTITION SERVERS, RENDEZVOUS {init_method}"
+    )
+    for process in partition_servers + trainers:
+        process.start()
+    try:
+        running = list(trainers)
+        while running:
+            wait([process.sentinel for process in running])
+            for process in list(running):
+                if process.exitcode is None:
+                    continue
+                running.remove(process)
+                if process.exitcode != 0:
+                    raise RuntimeError(
+                        f"{process.name} exited with status {process.exitcode}"
+                    )
+        for process in partition_servers:
+            process.join(PARTITION_SERVER_GRACE_SECONDS)
+    finally:
+        for process in partition_servers + trainers:
+            if process.is_alive():
+                process.terminate()
+                process.join()
@@ -1,24 +1,46 @@
 """Functions to export graph database to json format and create config file for PBG training
 """
 
-from embeoj.utils import connect_to_graphdb, logging
+from embeoj.utils import (
+    connect_to_graphdb,
+    logging,
+    load_metadata,
+    update_metadata,
+    quote_name,
+)
+from embeoj.metrics import track_stage
+from embeoj.compression import (
+    get_compression_format,
+    get_export_path,
+    get_apoc_compression,
+    write_streamed_export,
+)
 from pathlib import os
 import json
 import sys
 
 graph_connection = connect_to_graphdb()
 GLOBAL_CONFIG = None
+EXPORT_FILTERS = None
+COMPRESSION_CONFIG = None
 DATA_DIRECTORY = None
 CHECKPOINT_DIRECTORY = None
+EXPORT_BATCH_SIZE = 500
+FILTERED_EXPORT_QUERY = """CALL apoc.export.json.query($query, null, $config)
+    YIELD data RETURN data"""
 
 
 def initialise_config():
     from embeoj.utils import load_config
 
     global GLOBAL_CONFIG
+    global EXPORT_FILTERS
+    global COMPRESSION_CONFIG
     global DATA_DIRECTORY
     global CHECKPOINT_DIRECTORY
     GLOBAL_CONFIG = load_config("GLOBAL_CONFIG")
+    EXPORT_FILTERS = load_config("EXPORT_FILTERS") or dict()
+    COMPRESSION_CONFIG = load_config("COMPRESSION_CONFIG") or dict()
     cwd = os.getcwd()  # get current directory
     # default myproject/data
     DATA_DIRECTORY = os.path.join(
@@ -46,26 +68,170 @@ def create_folders():
         sys.exit(e)
 
 
+def has_export_filters(filters):
+    return bool(filters) and any(filters.values())
+
+
+def build_filter_parts(filters):
+    """Builds the relationship pattern and the conditions selecting the relationships of
+    EXPORT_FILTERS. Labels are matched against the first label of the nodes,
+    which is the entity type used for training. Included relationship types are put
+    in the pattern so the database only reads relationships of those types.
+
+    Arguments:
+        filters {[dict]} -- EXPORT_FILTERS
+
+    Returns:
+        [tuple] -- cypher (n)-[r]->(m) pattern, list of conditions and their parameters
+    """
+    filters = filters or {}
+    include_types = filters.get("INCLUDE_RELATIONSHIP_TYPES") or []
+    pattern = "(n)-[r]->(m)"
+    if include_types:
+        pattern = f"(n)-[r:{'|'.join(quote_name(t) for t in include_types)}]->(m)"
+    conditions = []
+    parameters = dict()
+    if filters.get("EXCLUDE_RELATIONSHIP_TYPES"):
+        conditions.append("NOT type(r) IN $exclude_types")
+        parameters["exclude_types"] = list(filters["EXCLUDE_RELATIONSHIP_TYPES"])
+    for node in ["n", "m"]:
+        if filters.get("INCLUDE_LABELS"):
+            conditions.append(f"head(labels({node})) IN $include_labels")
+            parameters["include_labels"] = list(filters["INCLUDE_LABELS"])
+        if filters.get("EXCLUDE_LABELS"):
+            conditions.append(f"NOT head(labels({node})) IN $exclude_labels")
+            parameters["exclude_labels"] = list(filters["EXCLUDE_LABELS"])
+    if filters.get("WHERE"):
+        conditions.append(f"({filters['WHERE']})")
+    return pattern, conditions, parameters
+
+
+def build_filter_clause(filters):
+    """MATCH ... WHERE ... clause selecting the relationships of EXPORT_FILTERS
+
+    Arguments:
+        filters {[dict]} -- EXPORT_FILTERS
+
+    Returns:
+        [tuple] -- cypher MATCH ... WHERE ... string and its parameters
+    """
+    pattern, conditions, parameters = build_filter_parts(filters)
+    clause = f"MATCH {pattern}"
+    if conditions:
+        clause += "\n    WHERE " + "\n    AND ".join(conditions)
+    return clause, parameters
+
+
+def build_filtered_export_queries(filters):
+    """Queries exporting the selected relationships and their end nodes one row at a
+    time, so the selection is never collected in the database heap. A node is
+    exported by the first query if it starts a selected relationship, otherwise by
+    the second if it ends one, so every node is exported once. Whether a node has a
+    selected relationship is checked with a pattern comprehension over its own
+    relationships
+
+    Arguments:
+        filters {[dict]} -- EXPORT_FILTERS
+
+    Returns:
+        [tuple] -- list of (column, query) and the parameters of the queries
+    """
+    pattern, conditions, parameters = build_filter_parts(filters)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    # n is bound outside the comprehension in the first query, m in the second
+    has_selected = f"size([{pattern}{where} | 1]) > 0"
+    filter_clause, _ = build_filter_clause(filters)
+    queries = [
+        ("n", f"MATCH (n) WHERE {has_selected} RETURN n"),
+        ("n", f"MATCH (m) WHERE {has_selected} WITH m AS n WHERE NOT ({has_selected}) RETURN n"),
+        ("r", f"{filter_clause}\n    RETURN r"),
+    ]
+    return queries, parameters
+
+
+def unwrap_rows(records, column):
+    """apoc.export.json.query writes every row as {"<column>": value}, the rows are
+    unwrapped to the node and relationship lines of apoc.export.json.all
+
+    Arguments:
+        records {[iterable]} -- cursor of a streamed query export
+        column {[str]} -- the single column of the exported query
+
+    Yields:
+        [dict] -- data of each batch
+    """
+    prefix = '{"' + column + '":'
+    for record in records:
+        lines = []
+        for line in (record["data"] or "").splitlines():
+            if not line.strip():
+                continue
+            if line.startswith(prefix) and line.endswith("}"):
+                lines.append(line[len(prefix):-1])
+            else:
+                lines.append(json.dumps(json.loads(line)[column]))
+        yield dict(data="\n".join(lines))
+
+
+def stream_filtered_export(queries, parameters, batch_size):
+    """runs the streamed query exports one after the other
+
+    Yields:
+        [dict] -- data of each batch, unwrapped
+    """
+    for column, query in queries:
+        config = dict(stream=True, batchSize=batch_size, params=parameters)
+        records = graph_connection.run(FILTERED_EXPORT_QUERY, dict(query=query, config=config))
+        yield from unwrap_rows(records, column)
+
+
 def export_graph_to_json():
-    """exports the graph database as a json file
+    """exports the graph database as a json file.
+    With EXPORT_FILTERS only the selected relationships and their end nodes are exported,
+    streamed through the driver query by query.
+    With COMPRESSION_CONFIG the file is compressed, by APOC (gzip) or while the export is
+    streamed through the driver (zstd, STREAM: true or EXPORT_FILTERS)
     """
     try:
-        export_file_name = GLOBAL_CONFIG["JSON_EXPORT_FILE"] + ".json"
+        compression_format = get_compression_format(COMPRESSION_CONFIG)
+        filtered = has_export_filters(EXPORT_FILTERS)
+        stream = (
+            bool(COMPRESSION_CONFIG.get("STREAM")) or compression_format == "zstd" or filtered
+        )
         graph_file_path = os.path.abspath(
-            os.path.join(
-                DATA_DIRECTORY, export_file_name
+            get_export_path(
+                DATA_DIRECTORY, GLOBAL_CONFIG["JSON_EXPORT_FILE"], compression_format
             )  # default:  myproject/data/graph.json
         )
         logging.info(f"""EXPORTING GRAPH DATABASE TO {graph_file_path}...... """)
-        query = (
-            f"""CALL apoc.export.json.all('{graph_file_path}'"""
-            + """,{batchSize:500})"""
-        )
-        graph_connection.run(query)
-        if os.path.exists(graph_file_path):
-            logging.info("Done...")
-        else:
-            logging.info("export failed! try again!")
+        export_config = dict(batchSize=EXPORT_BATCH_SIZE)
+        if stream:
+            export_config["stream"] = True  # the server returns the data instead of writing it
+        elif get_apoc_compression(compression_format, stream):
+            export_config["compression"] = get_apoc_compression(compression_format, stream)
+        query = """CALL apoc.export.json.all($file, $config)"""
+        if stream:
+            query += """
+    YIELD data RETURN data"""
+        parameters = dict(file=None if stream else graph_file_path, config=export_config)
+        with track_stage("export.graph_to_json", unit="bytes") as record:
+            if filtered:
+                queries, filter_parameters = build_filtered_export_queries(EXPORT_FILTERS)
+                logging.info(f"EXPORTING ONLY: {build_filter_clause(EXPORT_FILTERS)[0]}")
+                records = stream_filtered_export(queries, filter_parameters, EXPORT_BATCH_SIZE)
+            elif stream:
+                records = graph_connection.run(query, parameters)
+            else:
+                graph_connection.run(query, parameters)
+            if stream:
+                write_streamed_export(
+                    records, graph_file_path, compression_format, COMPRESSION_CONFIG
+                )
+            if os.path.exists(graph_file_path):
+                record["count"] = os.path.getsize(graph_file_path)
+        if not os.path.exists(graph_file_path):
+            raise FileNotFoundError(f"the export wrote no {graph_file_path}")
+        logging.info("Done...")
     except Exception as e:
         logging.info(
             """error in exporting data. 
@@ -100,26 +266,38 @@ def save_metafile_details(entities):
             for p in partitions
             for p1 in partitions
         ]  # edge files are stored are in format : edges_0_0.json for number of partitions
-        meta_dict = dict(
+        # save to myproject/metadata.json next to the schema written in preprocessing
+        update_metadata(
             entities=entities,
             partitions=GLOBAL_CONFIG["NUM_PARTITIONS"],
             entity_files=entity_filenames,
             embedding_files=embedding_filenames,
             edge_files=edge_filenames,
         )  # metadata for all these files
-        metadata_path = os.path.join(
-            os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], "metadata.json"
-        )  # save to myproject/metadata.json
-        with open(metadata_path, "w") as f:
-            json.dump(meta_dict, f)
-        f.close()
     except Exception as e:
         logging.info("""error in exporting meta data. """)
         logging.info(e, exc_info=True)
 
 
+def scan_graph_schema():
+    """extracts the relations by scanning every relationship of the graph database.
+    This is only used when preprocessing did not record the schema in metadata.json
+
+    Returns:
+        [list] -- relations as dicts of lhs, name and rhs
+    """
+    logging.info("NO SCHEMA IN metadata.json, SCANNING THE GRAPH DATABASE...... ")
+    filter_clause, parameters = build_filter_clause(EXPORT_FILTERS)
+    query = f"""{filter_clause}
+    WITH DISTINCT {{l1: labels(n), r: type(r), l2: labels(m)}} AS connect 
+    RETURN head(connect.l1) as lhs,connect.r as name,head(connect.l2) as rhs"""
+    metadata = graph_connection.run(query, parameters).to_data_frame()
+    return list(metadata.to_dict("index").values())  # all relations
+
+
 def export_meta_data():
     """extracts unique entity labels and relationships between them 
+    from the schema collected while preprocessing the exported relationships.
     This is then saved in the PBG config
     Note: By  default, PBG accepts only one label per node. 
     Hence the first label is picked by default. 
@@ -129,13 +307,16 @@ def export_meta_data():
     """
     try:
         logging.info(f"""READING GRAPH METADATA...... """)
-        query = """MATCH (n)-[r]->(x) 
-        WITH DISTINCT {l1: labels(n), r: type(r), l2: labels(x)} AS connect 
-        RETURN head(connect.l1) as lhs,connect.r as name,head(connect.l2) as rhs"""
-        metadata = graph_connection.run(query).to_data_frame()
-        relations = list(metadata.to_dict("index").values())  # all relations
-        entities = list(
-            set(list(metadata["lhs"].unique()) + list(metadata["rhs"].unique()))
+        schema = load_metadata().get("schema")
+        if schema is not None:
+            relations = [
+                dict(lhs=r["lhs"], name=r["name"], rhs=r["rhs"])
+                for r in schema["relations"]
+            ]  # counts are kept in metadata.json only
+        else:
+            relations = scan_graph_schema()
+        entities = sorted(
+            set([r["lhs"] for r in relations] + [r["rhs"] for r in relations])
         )  # unique names of entities
         partitions = GLOBAL_CONFIG["NUM_PARTITIONS"]
         config = {
@@ -152,6 +333,33 @@ def export_meta_data():
         logging.info(e, exc_info=True)
 
 
+def autotune_pbg_settings(default_config):
+    """Chooses partitions, bucket order, batch size and workers for the memory budget in
+    AUTOTUNE_CONFIG from the counts in metadata.json. NUM_PARTITIONS is overridden for
+    this run and the estimate is saved next to config.json
+
+    Arguments:
+        default_config {[dict]} -- OPTIONAL_PBG_SETTINGS, updated in place
+    """
+    from embeoj.utils import load_config
+    from embeoj.autotune import autotune, save_autotune_report
+
+    autotune_config = load_config("AUTOTUNE_CONFIG")
+    if not autotune_config or not autotune_config["ENABLED"]:
+        return
+    schema = load_metadata().get("schema")
+    if schema is None:
+        logging.info("AUTOTUNE: no entity counts in metadata.json, keeping config.yml settings")
+        return
+    report = autotune(schema, GLOBAL_CONFIG, default_config, autotune_config)
+    settings = report["settings"]
+    GLOBAL_CONFIG["NUM_PARTITIONS"] = settings["num_partitions"]
+    default_config["bucket_order"] = settings["bucket_order"]
+    default_config["batch_size"] = settings["batch_size"]
+    default_config["workers"] = settings["workers"]
+    save_autotune_report(report, CHECKPOINT_DIRECTORY)
+
+
 def build_pbg_config():
     """Creates the PBG config 
 
@@ -163,6 +371,7 @@ def build_pbg_config():
 
         logging.info(f"""CREATING CONFIGURATION FILE FOR TRAINING...... """)
         default_config = load_config("OPTIONAL_PBG_SETTINGS")
+        autotune_pbg_settings(default_config)
         pbg_config = export_meta_data()
         pbg_config["num_epochs"] = GLOBAL_CONFIG["EPOCHS"]
         pbg_config["dimension"] = GLOBAL_CONFIG["EMBEDDING_DIMENSIONS"]
@@ -192,7 +401,9 @@ def save_pbg_config():
     """Saves the PBG config to the checkpoint directory
     """
     try:
-        pbg_config = build_pbg_config()
+        with track_stage("export.pbg_config", unit="relations") as record:
+            pbg_config = build_pbg_config()
+            record["count"] = len(pbg_config["relations"])
         model_path = os.path.join(
             CHECKPOINT_DIRECTORY, GLOBAL_CONFIG["PBG_CONFIG_NAME"]
         )
@@ -215,10 +426,26 @@ def export():
             "-------------------------PREPARING FOR DATA EXPORT------------------------"
         )
         create_folders()  # create neccesary folders
-        export_graph_to_json()  # export graph to json
-        save_pbg_config()  # create and save config.json for training
+        with track_stage("export", unit="bytes", profile=True):
+            export_graph_to_json()  # export graph to json
         logging.info("Done....")
     except Exception as e:
         logging.info("error in export")
         logging.info(e, exc_info=True)
         sys.exit(e)
+
+
+def create_pbg_config():
+    """entry function for creating the PBG config from the schema collected in preprocessing.
+    """
+    try:
+        initialise_config()
+        logging.info(
+            "-------------------------CREATING PBG CONFIG------------------------"
+        )
+        save_pbg_config()  # create and save config.json for training
+        logging.info("Done....")
+    except Exception as e:
+        logging.info("error in creating pbg config")
+        logging.info(e, exc_info=True)
+        sys.exit(e)
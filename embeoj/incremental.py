@@ -0,0 +1,348 @@
+"""Warm start for incremental retraining: seeds the embeddings of the new entity files
+from the previous checkpoint by node id so only new nodes start from random values
+"""
+from pathlib import Path, os
+import glob
+import json
+import shutil
+import h5py
+import numpy as np
+import pandas as pd
+from embeoj.utils import logging
+
+FORMAT_VERSION = 1  # version of the PBG checkpoint/edge file format
+INIT_VERSION = 1
+
+
+def snapshot_entity_names(data_directory, checkpoint_directory):
+    """copies the entity_names_<type>_<part>.json files the checkpoint was trained on
+    into the checkpoint directory, so a later run can map node ids to rows of
+    these embeddings after the data directory has been overwritten
+    """
+    for names_file in glob.glob(os.path.join(data_directory, "entity_names_*_*.json")):
+        shutil.copy(names_file, checkpoint_directory)
+
+
+def load_entity_names(entity_path, entity_type, partition, cache):
+    if (entity_type, partition) not in cache:
+        names_path = os.path.join(
+            entity_path, f"entity_names_{entity_type}_{partition}.json"
+        )
+        with open(names_path, "r") as f:
+            cache[(entity_type, partition)] = np.array(json.load(f), dtype=object)
+        f.close()
+    return cache[(entity_type, partition)]
+
+
+def hash_bucket_edges(pbg_config, edge_file, names_cache):
+    """hashes the (lhs id, relation name, rhs id) triples of one edge bucket so edges can
+    be compared across runs whose entity offsets differ
+
+    Returns:
+        [np.ndarray] -- uint64 hash per edge
+    """
+    lhs_partition, rhs_partition = [int(p) for p in Path(edge_file).stem.split("_")[1:]]
+    with h5py.File(edge_file, "r") as hf:
+        lhs, rhs, rel = hf["lhs"][...], hf["rhs"][...], hf["rel"][...]
+    lhs_ids = np.empty(len(rel), dtype=object)
+    rhs_ids = np.empty(len(rel), dtype=object)
+    for relation_index, relation in enumerate(pbg_config.relations):
+        selected = rel == relation_index
+        if not selected.any():
+            continue
+        for entity_type, partition, offsets, ids in [
+            (relation.lhs, lhs_partition, lhs, lhs_ids),
+            (relation.rhs, rhs_partition, rhs, rhs_ids),
+        ]:
+            if pbg_config.entities[entity_type].num_partitions == 1:
+                partition = 0
+            names = load_entity_names(
+                pbg_config.entity_path, entity_type, partition, names_cache
+            )
+            ids[selected] = names[offsets[selected]]
+    relation_names = np.array([r.name for r in pbg_config.relations], dtype=object)
+    triples = pd.DataFrame(dict(lhs=lhs_ids, rel=relation_names[rel], rhs=rhs_ids))
+    return pd.util.hash_pandas_object(triples, index=False).to_numpy()
+
+
+def snapshot_edge_hashes(pbg_config, checkpoint_directory):
+    """saves the sorted hashes of the edges the checkpoint was trained on
+    (default: myproject/model/edge_hashes.npy) to find the new edges of the next run.
+    Only TOUCHED_BUCKETS_ONLY runs read them, so they are only saved when it is set
+    """
+    names_cache = dict()
+    hashes = [
+        hash_bucket_edges(pbg_config, edge_file, names_cache)
+        for edge_path in pbg_config.edge_paths
+        for edge_file in sorted(Path(edge_path).glob("edges_*_*.h5"))
+    ]
+    hashes = np.sort(np.concatenate(hashes)) if hashes else np.empty((0,), np.uint64)
+    np.save(os.path.join(checkpoint_directory, "edge_hashes.npy"), hashes)
+
+
+def remove_edge_hashes(checkpoint_directory):
+    """removes the edge hashes of an earlier checkpoint, which don't match this one
+    """
+    hashes_path = os.path.join(checkpoint_directory, "edge_hashes.npy")
+    if os.path.exists(hashes_path):
+        os.remove(hashes_path)
+
+
+def read_checkpoint_version(directory):
+    version_file = os.path.join(directory, "checkpoint_version.txt")
+    if not os.path.exists(version_file):
+        return None
+    with open(version_file, "r") as f:
+        version = f.read().strip()
+    f.close()
+    return int(version) if version else None
+
+
+def archive_checkpoint(checkpoint_directory, version):
+    """moves the previous checkpoint to <checkpoint>/previous so PBG starts a new run
+    instead of resuming it. Indexes, cached search results and inferred embeddings of
+    the previous checkpoint are removed.
+
+    Returns:
+        [str] -- path of the archived checkpoint
+    """
+    previous_directory = os.path.join(checkpoint_directory, "previous")
+    shutil.rmtree(previous_directory, ignore_errors=True)
+    os.makedirs(previous_directory)
+    patterns = [
+        f"embeddings_*.v{version}.h5",
+        f"model.v{version}.h5",
+        "entity_names_*_*.json",
+        "entity_fingerprint.txt",
+        "checkpoint_version.txt",
+        "training_stats.json",
+        "edge_hashes.npy",
+    ]
+    for pattern in patterns:
+        for checkpoint_file in glob.glob(os.path.join(checkpoint_directory, pattern)):
+            shutil.move(checkpoint_file, previous_directory)
+    for stale_file in glob.glob(os.path.join(checkpoint_directory, "embeddings_*.v*.h5")):
+        os.remove(stale_file)  # older versions kept by PBG
+    shutil.rmtree(os.path.join(checkpoint_directory, "index"), ignore_errors=True)
+    for derived_file in ["similarity_cache.sqlite", "inferred_embeddings.h5"]:
+        derived_path = os.path.join(checkpoint_directory, derived_file)
+        if os.path.exists(derived_path):
+            os.remove(derived_path)
+    return previous_directory
+
+
+def clear_checkpoint(checkpoint_directory):
+    """archives the checkpoint of an earlier run, if any, before training from scratch.
+    PBG would otherwise resume it: once it has reached num_epochs nothing is trained and
+    the old embeddings are kept next to the new entity files
+    """
+    version = read_checkpoint_version(checkpoint_directory)
+    if version is None:
+        return
+    logging.info(f"archiving checkpoint v{version}, training from scratch")
+    archive_checkpoint(checkpoint_directory, version)
+
+
+def load_previous_embeddings(previous_directory, entity_type, version):
+    """reads all partitions of one entity type of the previous checkpoint. Raises
+    ValueError when a partition has a different number of names and embedding rows
+
+    Returns:
+        [tuple] -- node ids (pd.Index) and embeddings in the same order, None if the type is new
+    """
+    all_ids = []
+    all_embeddings = []
+    for names_file in sorted(
+        glob.glob(os.path.join(previous_directory, f"entity_names_{entity_type}_*.json"))
+    ):
+        partition = os.path.splitext(names_file)[0].split("_")[-1]
+        embedding_file = os.path.join(
+            previous_directory, f"embeddings_{entity_type}_{partition}.v{version}.h5"
+        )
+        if not os.path.exists(embedding_file):
+            continue
+        with open(names_file, "r") as f:
+            names = json.load(f)
+        f.close()
+        with h5py.File(embedding_file, "r") as hf:
+            embeddings = hf["embeddings"][...]
+        if len(names) != len(embeddings):
+            raise ValueError(
+                f"{os.path.basename(names_file)} has {len(names)} ids but "
+                f"{os.path.basename(embedding_file)} has {len(embeddings)} rows, "
+                "train without --incremental"
+            )
+        all_ids.extend(names)
+        all_embeddings.append(embeddings)
+    if not all_embeddings:
+        return None, None
+    return pd.Index(all_ids), np.concatenate(all_embeddings)
+
+
+def write_init_embeddings(path, embeddings):
+    with h5py.File(path, "w") as hf:
+        hf.attrs["format_version"] = FORMAT_VERSION
+        hf.create_dataset("embeddings", data=embeddings)
+
+
+def seed_init_checkpoint(pbg_config, previous_directory, previous_version, init_directory):
+    """Writes an init checkpoint for the new entity files: rows of nodes found in the
+    previous checkpoint are copied by id, the other rows are drawn like PBG does
+    (normal * init_scale). The model file (relation operators, global embeddings)
+    is copied as is.
+
+    Returns:
+        [dict] -- for each (entity type, partition) a boolean mask of the new rows
+    """
+    shutil.rmtree(init_directory, ignore_errors=True)
+    os.makedirs(init_directory)
+    new_entity_masks = dict()
+    num_seeded = num_new = 0
+    for entity_type, entity_config in pbg_config.entities.items():
+        previous_ids, previous_embeddings = load_previous_embeddings(
+            previous_directory, entity_type, previous_version
+        )
+        for partition in range(entity_config.num_partitions):
+            names_path = os.path.join(
+                pbg_config.entity_path, f"entity_names_{entity_type}_{partition}.json"
+            )
+            with open(names_path, "r") as f:
+                entity_ids = json.load(f)
+            f.close()
+            embeddings = (
+                np.random.randn(len(entity_ids), pbg_config.dimension).astype(np.float32)
+                * pbg_config.init_scale
+            )
+            if previous_ids is not None:
+                rows = previous_ids.get_indexer(entity_ids)
+                found = rows >= 0
+                embeddings[found] = previous_embeddings[rows[found]]
+            else:
+                found = np.zeros(len(entity_ids), dtype=bool)
+            new_entity_masks[(entity_type, partition)] = ~found
+            num_seeded += int(found.sum())
+            num_new += int((~found).sum())
+            write_init_embeddings(
+                os.path.join(
+                    init_directory,
+                    f"embeddings_{entity_type}_{partition}.v{INIT_VERSION}.h5",
+                ),
+                embeddings,
+            )
+    previous_model = os.path.join(previous_directory, f"model.v{previous_version}.h5")
+    if os.path.exists(previous_model):
+        shutil.copy(
+            previous_model, os.path.join(init_directory, f"model.v{INIT_VERSION}.h5")
+        )
+    with open(os.path.join(init_directory, "checkpoint_version.txt"), "w") as f:
+        f.write(f"{INIT_VERSION}\n")
+    f.close()
+    logging.info(
+        f"WARM START: {num_seeded} entities seeded from checkpoint v{previous_version}, "
+        f"{num_new} new entities initialised"
+    )
+    return new_entity_masks
+
+
+def write_empty_bucket(path):
+    with h5py.File(path, "w") as hf:
+        hf.attrs["format_version"] = FORMAT_VERSION
+        for dataset in ("lhs", "rhs", "rel"):
+            hf.create_dataset(dataset, data=np.empty((0,), dtype=np.int64))
+
+
+def select_touched_buckets(
+    pbg_config, new_entity_masks, previous_directory, incremental_edge_path
+):
+    """Creates an edge directory in which only the buckets having a new edge keep their
+    edges, the other buckets are empty so PBG skips their training. Edges are new when
+    their hash is not in the edges of the previous checkpoint; without those hashes
+    edges with a new entity are used.
+
+    Returns:
+        [str] -- path of the edge directory to train on
+    """
+    shutil.rmtree(incremental_edge_path, ignore_errors=True)
+    os.makedirs(incremental_edge_path)
+    previous_hashes_path = os.path.join(previous_directory, "edge_hashes.npy")
+    previous_hashes = (
+        np.load(previous_hashes_path) if os.path.exists(previous_hashes_path) else None
+    )
+    names_cache = dict()
+    num_touched = num_buckets = 0
+    for edge_file in sorted(Path(pbg_config.edge_paths[0]).glob("edges_*_*.h5")):
+        if previous_hashes is not None:
+            hashes = hash_bucket_edges(pbg_config, edge_file, names_cache)
+            position = np.searchsorted(previous_hashes, hashes).clip(
+                max=max(len(previous_hashes) - 1, 0)
+            )
+            touched = len(previous_hashes) == 0 or bool(
+                (previous_hashes[position] != hashes).any()
+            )
+        else:
+            touched = has_new_entity(pbg_config, edge_file, new_entity_masks)
+        target = os.path.join(incremental_edge_path, edge_file.name)
+        if touched:
+            shutil.copy(edge_file, target)
+            num_touched += 1
+        else:
+            write_empty_bucket(target)
+        num_buckets += 1
+    logging.info(f"WARM START: training on {num_touched} of {num_buckets} buckets with new edges")
+    return incremental_edge_path
+
+
+def has_new_entity(pbg_config, edge_file, new_entity_masks):
+    lhs_partition, rhs_partition = [int(p) for p in Path(edge_file).stem.split("_")[1:]]
+    with h5py.File(edge_file, "r") as hf:
+        lhs, rhs, rel = hf["lhs"][...], hf["rhs"][...], hf["rel"][...]
+    for relation_index, relation in enumerate(pbg_config.relations):
+        selected = rel == relation_index
+        if not selected.any():
+            continue
+        for entity_type, partition, offsets in [
+            (relation.lhs, lhs_partition, lhs),
+            (relation.rhs, rhs_partition, rhs),
+        ]:
+            if pbg_config.entities[entity_type].num_partitions == 1:
+                partition = 0
+            if new_entity_masks[(entity_type, partition)][offsets[selected]].any():
+                return True
+    return False
+
+
+def prepare_warm_start(pbg_config, checkpoint_directory, incremental_config):
+    """Prepares an incremental run from the previous checkpoint in checkpoint_directory
+
+    Arguments:
+        pbg_config {[object]} -- Config Schema object of the new run
+        checkpoint_directory {[str]} -- directory of the previous checkpoint
+        incremental_config {[dict]} -- INCREMENTAL_CONFIG
+
+    Returns:
+        [dict] -- config.json overrides (init_path, num_epochs, edge_paths),
+        empty if there is no previous checkpoint to start from
+    """
+    previous_version = read_checkpoint_version(checkpoint_directory)
+    if previous_version is None:
+        logging.info("WARM START: no previous checkpoint found, training from scratch")
+        return dict()
+    if not glob.glob(os.path.join(checkpoint_directory, "entity_names_*_*.json")):
+        logging.info("WARM START: previous checkpoint has no entity names")
+        clear_checkpoint(checkpoint_directory)
+        return dict()
+    # seeded from the live checkpoint, which is only archived once seeding succeeded
+    init_directory = os.path.join(checkpoint_directory, "init")
+    new_entity_masks = seed_init_checkpoint(
+        pbg_config, checkpoint_directory, previous_version, init_directory
+    )
+    previous_directory = archive_checkpoint(checkpoint_directory, previous_version)
+    overrides = dict(init_path=init_directory, num_epochs=incremental_config["EPOCHS"])
+    if incremental_config["TOUCHED_BUCKETS_ONLY"]:
+        incremental_edge_path = pbg_config.edge_paths[0].rstrip("/") + "_incremental"
+        overrides["edge_paths"] = [
+            select_touched_buckets(
+                pbg_config, new_entity_masks, previous_directory, incremental_edge_path
+            )
+        ]
+    return overrides
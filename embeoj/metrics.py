@@ -0,0 +1,181 @@
+"""Per-stage instrumentation: wall/cpu time, peak memory and throughput of each stage
+written as json lines (and optionally as a prometheus textfile)
+"""
+import cProfile
+import io
+import json
+import pstats
+import resource
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import os
+from embeoj.utils import logging, load_config
+
+PROFILE = False  # set by the --profile flag of embed.py / task.py
+active_profiler = None
+stage_records = dict()  # latest record of every stage run by this process
+
+
+def set_profiling(enabled=True):
+    """Turns cProfile dumps of the top level stages on or off
+
+    Keyword Arguments:
+        enabled {bool} -- dump cProfile stats for each top level stage (default: {True})
+    """
+    global PROFILE
+    PROFILE = enabled
+
+
+def get_project_path():
+    GLOBAL_CONFIG = load_config("GLOBAL_CONFIG")
+    return os.path.join(os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"])
+
+
+def get_cpu_seconds():
+    """cpu time (user + system) of this process and of its finished child processes
+    (PBG trainers, conversion workers)
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def get_peak_rss_mb():
+    """peak resident set size of this process or of its largest child process.
+    ru_maxrss is reported in kilobytes on linux
+    """
+    peak_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return round(peak_kb / 1024, 2)
+
+
+def write_prometheus_textfile(textfile_path):
+    """Writes the latest record of every stage in the prometheus text exposition format.
+    The file is replaced atomically as required by the node_exporter textfile collector
+
+    Arguments:
+        textfile_path {str} -- path of the .prom file
+    """
+    gauges = [
+        ("pyembeo_stage_wall_seconds", "wall_seconds", "Wall clock time of the stage"),
+        ("pyembeo_stage_cpu_seconds", "cpu_seconds", "CPU time of the stage"),
+        ("pyembeo_stage_peak_rss_megabytes", "peak_rss_mb", "Peak RSS after the stage"),
+        ("pyembeo_stage_items", "count", "Items processed by the stage"),
+        ("pyembeo_stage_throughput", "throughput", "Items processed per second"),
+        ("pyembeo_stage_cache_hit_ratio", "cache_hit_rate", "Share of result cache lookups that hit"),
+        ("pyembeo_stage_last_run_timestamp_seconds", "finished_at_epoch", "End of the last run"),
+    ]
+    lines = []
+    for metric_name, key, help_text in gauges:
+        lines.append(f"# HELP {metric_name} {help_text}")
+        lines.append(f"# TYPE {metric_name} gauge")
+        for record in stage_records.values():
+            if record.get(key) is None:
+                continue
+            labels = f'stage="{record["stage"]}",unit="{record["unit"]}",status="{record["status"]}"'
+            lines.append(f"{metric_name}{{{labels}}} {record[key]}")
+    tmp_path = textfile_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, textfile_path)
+
+
+def write_record(record):
+    """appends one stage record to the metrics file of the project
+    (default: myproject/metrics.jsonl) and refreshes the prometheus textfile if configured
+    """
+    try:
+        METRICS_CONFIG = load_config("METRICS_CONFIG")
+        project_path = get_project_path()
+        if os.path.isdir(project_path):
+            metrics_path = os.path.join(project_path, METRICS_CONFIG["METRICS_FILE"])
+            with open(metrics_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if METRICS_CONFIG.get("PROMETHEUS_TEXTFILE"):
+            write_prometheus_textfile(METRICS_CONFIG["PROMETHEUS_TEXTFILE"])
+    except Exception as e:
+        logging.info(f"Could not write metrics for {record['stage']}: {e}")
+
+
+def dump_profile(stage, profiler):
+    """dumps cProfile stats of a stage to myproject/profiles/<stage>.prof
+    and logs the most expensive calls
+    """
+    try:
+        profile_directory = os.path.join(get_project_path(), "profiles")
+        os.makedirs(profile_directory, exist_ok=True)
+        profile_path = os.path.join(profile_directory, f"{stage}.prof")
+        profiler.dump_stats(profile_path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(15)
+        logging.info(f"PROFILE OF {stage} SAVED TO {profile_path}\n{summary.getvalue()}")
+    except Exception as e:
+        logging.info(f"Could not save profile for {stage}: {e}")
+
+
+@contextmanager
+def track_stage(stage, unit="rows", profile=False):
+    """Measures a stage or sub-step of the pipeline. The yielded dict is the record
+    of the stage: set record["count"] to the number of rows/edges/queries processed
+    to get the throughput.
+
+        with track_stage("preprocess.read_json") as record:
+            json_list = ...
+            record["count"] = len(json_list)
+
+    Arguments:
+        stage {str} -- name of the stage, e.g. export or preprocess.read_json
+
+    Keyword Arguments:
+        unit {str} -- what record["count"] counts (default: {"rows"})
+        profile {bool} -- dump cProfile stats for this stage when profiling is enabled (default: {False})
+    """
+    global active_profiler
+    record = dict(
+        stage=stage,
+        unit=unit,
+        count=None,
+        status="ok",
+        started_at=datetime.now(timezone.utc).isoformat(),
+    )
+    profiler = None
+    if profile and PROFILE and active_profiler is None:
+        # only one profiler can be active, nested stages are part of the outer profile
+        profiler = active_profiler = cProfile.Profile()
+        profiler.enable()
+    wall_start = time.perf_counter()
+    cpu_start = get_cpu_seconds()
+    try:
+        yield record
+    except BaseException:
+        record["status"] = "error"
+        raise
+    finally:
+        wall_seconds = time.perf_counter() - wall_start
+        if profiler is not None:
+            profiler.disable()
+            active_profiler = None
+        record["wall_seconds"] = round(wall_seconds, 4)
+        record["cpu_seconds"] = round(get_cpu_seconds() - cpu_start, 4)
+        record["peak_rss_mb"] = get_peak_rss_mb()
+        record["throughput"] = (
+            round(record["count"] / wall_seconds, 2)
+            if record["count"] and wall_seconds > 0
+            else None
+        )
+        record["finished_at_epoch"] = round(time.time(), 3)
+        stage_records[stage] = record
+        logging.info(
+            f"METRICS {stage}: {record['wall_seconds']}s wall, "
+            f"{record['cpu_seconds']}s cpu, peak rss {record['peak_rss_mb']} MB"
+            + (
+                f", {record['count']} {unit} ({record['throughput']} {unit}/s)"
+                if record["throughput"] is not None
+                else ""
+            )
+        )
+        write_record(record)
+        if profiler is not None:
+            dump_profile(stage, profiler)
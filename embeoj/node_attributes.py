@@ -0,0 +1,110 @@
+"""Filterable attributes of the exported nodes (data/node_attributes).
+The labels and the SEARCH_FILTERS properties of every node are stored in long format:
+for each field, int64 rows into ids.npy and int32 codes into the distinct values of the
+field, so nodes with several labels or list valued properties have several rows
+"""
+from pathlib import os
+import json
+import numpy as np
+import pandas as pd
+
+LABEL_FIELD = "label"
+
+
+def get_attribute_directory(data_directory):
+    return os.path.join(data_directory, "node_attributes")
+
+
+def format_value(value):
+    """values are compared as strings, as they are given on the command line
+    (json for numbers and booleans, e.g. 5, 1.5, true). Whole floats are stored as
+    integers, so 1.0 and 1 are the same value
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def get_value_forms(value):
+    """the stored values a filter value given on the command line matches: the string
+    as given and, for numbers, the number as formatted by format_value (score=1 and
+    score=1.0 both match a stored 1.0). Whole numbers also match their float form,
+    as stored by earlier versions
+
+    Arguments:
+        value {[str]} -- value of a field=value filter
+
+    Returns:
+        [set] -- stored values to accept
+    """
+    forms = {value}
+    try:
+        number = json.loads(value)
+    except ValueError:
+        return forms
+    if isinstance(number, (int, float)) and not isinstance(number, bool):
+        forms.add(format_value(number))
+        if float(number).is_integer():
+            forms.add(json.dumps(float(number)))
+    return forms
+
+
+def save_node_attributes(data_directory, node_ids, labels, properties, property_names):
+    """Saves the labels and the given properties of the nodes
+
+    Arguments:
+        data_directory {[str]} -- data directory of the project
+        node_ids {[pd.Series]} -- node ids
+        labels {[pd.Series]} -- list of labels of each node
+        properties {[pd.Series]} -- property dict of each node
+        property_names {[list]} -- properties to save
+
+    Returns:
+        [dict] -- number of distinct values of each field
+    """
+    attribute_directory = get_attribute_directory(data_directory)
+    os.makedirs(attribute_directory, exist_ok=True)
+    np.save(os.path.join(attribute_directory, "ids.npy"), node_ids.to_numpy().astype(np.int64))
+    fields = {LABEL_FIELD: labels.reset_index(drop=True)}
+    properties = properties.reset_index(drop=True)
+    for property_name in property_names or []:
+        fields[property_name] = properties.apply(
+            lambda p: p.get(property_name) if isinstance(p, dict) else None
+        )
+    values = dict()
+    for i, (field, column) in enumerate(fields.items()):
+        exploded = column.explode().dropna()
+        codes, uniques = pd.factorize(exploded.map(format_value))
+        np.save(
+            os.path.join(attribute_directory, f"field_{i}.rows.npy"),
+            exploded.index.to_numpy().astype(np.int64),
+        )
+        np.save(os.path.join(attribute_directory, f"field_{i}.codes.npy"), codes.astype(np.int32))
+        values[field] = list(uniques)
+    with open(os.path.join(attribute_directory, "values.json"), "w") as f:
+        json.dump(dict(fields=list(fields), values=values), f)
+    f.close()
+    return {field: len(field_values) for field, field_values in values.items()}
+
+
+def load_node_attributes(data_directory):
+    """Reads the saved attributes
+
+    Returns:
+        [dict] -- ids and, by field, (rows, codes, values); None if no attributes were saved
+    """
+    attribute_directory = get_attribute_directory(data_directory)
+    values_path = os.path.join(attribute_directory, "values.json")
+    if not os.path.exists(values_path):
+        return None
+    with open(values_path, "r") as f:
+        saved = json.load(f)
+    f.close()
+    fields = dict()
+    for i, field in enumerate(saved["fields"]):
+        fields[field] = (
+            np.load(os.path.join(attribute_directory, f"field_{i}.rows.npy")),
+            np.load(os.path.join(attribute_directory, f"field_{i}.codes.npy")),
+            saved["values"][field],
+        )
+    return dict(ids=np.load(os.path.join(attribute_directory, "ids.npy")), fields=fields)
@@ -1,39 +1,66 @@
 """Converts graph database exported in jsonl format to tsv format required by PBG
 """
 import json
+import numpy as np
 import pandas as pd
-from embeoj.utils import logging
+from embeoj.utils import logging, update_metadata
+from embeoj.metrics import track_stage
+from embeoj.node_attributes import save_node_attributes
+from embeoj.compression import find_export_path, get_compression_format, open_text_reader
 from pathlib import os
 import sys
 
 GLOBAL_CONFIG = None
+CONVERSION_CONFIG = None
+OPTIONAL_PBG_SETTINGS = None
+DEGREE_CAP_CONFIG = None
+EXPORT_FILTERS = None
+COMPRESSION_CONFIG = None
+SEARCH_FILTERS = None
 json_path = None
+SPLIT_BUCKETS = 10000  # resolution of the hash based train/test split
 
 
 def initialise_config():
     from embeoj.utils import load_config
 
     global GLOBAL_CONFIG
+    global CONVERSION_CONFIG
+    global OPTIONAL_PBG_SETTINGS
+    global DEGREE_CAP_CONFIG
+    global EXPORT_FILTERS
+    global COMPRESSION_CONFIG
+    global SEARCH_FILTERS
     global json_path
     GLOBAL_CONFIG = load_config("GLOBAL_CONFIG")
-    json_path = os.path.join(
-        os.getcwd(),
-        GLOBAL_CONFIG["PROJECT_NAME"],
-        GLOBAL_CONFIG["DATA_DIRECTORY"],
-        GLOBAL_CONFIG["JSON_EXPORT_FILE"] + ".json",
-    )  # path to the json dump of the graph db
+    CONVERSION_CONFIG = load_config("CONVERSION_CONFIG")
+    OPTIONAL_PBG_SETTINGS = load_config("OPTIONAL_PBG_SETTINGS") or dict()
+    DEGREE_CAP_CONFIG = load_config("DEGREE_CAP_CONFIG") or dict()
+    EXPORT_FILTERS = load_config("EXPORT_FILTERS") or dict()
+    COMPRESSION_CONFIG = load_config("COMPRESSION_CONFIG") or dict()
+    SEARCH_FILTERS = load_config("SEARCH_FILTERS") or dict()
+    json_path = find_export_path(
+        os.path.join(os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], GLOBAL_CONFIG["DATA_DIRECTORY"]),
+        GLOBAL_CONFIG["JSON_EXPORT_FILE"],
+        get_compression_format(COMPRESSION_CONFIG),
+        bool(COMPRESSION_CONFIG.get("READ_OTHER_FORMATS")),
+    )  # path to the json dump of the graph db (graph.json, graph.json.gz or graph.json.zst)
 
 
 def read_json_file():
-    """read exported json(l) file consisting of the graph database
+    """read exported json(l) file consisting of the graph database. Compressed files are
+    decompressed while they are read, one line at a time
     Returns:
         [list] -- list of dictionaries for each node and relation
     """
     try:
         logging.info(f"READING GRAPH DATA IN JSON FROM {json_path}")
-        with open(json_path, "r") as json_file:
-            json_list = list(json_file)
-            json_list = [json.loads(json_string) for json_string in json_list]
+        with track_stage("preprocess.read_json") as record:
+            with open_text_reader(json_path, COMPRESSION_CONFIG) as json_file:
+                json_list = [
+                    json.loads(json_string) for json_string in json_file if json_string.strip()
+                ]
+            record["count"] = len(json_list)
         return json_list
     except Exception as e:
         logging.info("error in reading json path")
@@ -51,23 +78,273 @@ def separate_nodes_relations(json_list):
     """
     try:
         logging.info(f"SEPARATING NODES AND RELATIONSHIPS")
-
-        graph_df = pd.DataFrame(json_list)
-        nodes_df = graph_df[graph_df["type"] == "node"][
-            ["id", "type", "labels", "properties"]
-        ]
-        relation_df = graph_df[graph_df["type"] == "relationship"][
-            ["type", "start", "end", "label", "properties"]
-        ]
-        nodes_df["labels"] = nodes_df["labels"].apply(lambda x: x[0])
-        relation_df["start"] = relation_df["start"].apply(lambda x: x["id"])
-        relation_df["end"] = relation_df["end"].apply(lambda x: x["id"])
+        with track_stage("preprocess.separate_nodes_relations") as record:
+            graph_df = pd.DataFrame(json_list)
+            nodes_df = graph_df[graph_df["type"] == "node"][
+                ["id", "type", "labels", "properties"]
+            ]
+            relation_df = graph_df[graph_df["type"] == "relationship"][
+                ["type", "start", "end", "label", "properties"]
+            ]
+            nodes_df["label_list"] = nodes_df["labels"]  # all labels, for search filters
+            nodes_df["labels"] = nodes_df["labels"].apply(lambda x: x[0])
+            # apoc writes the labels of both end nodes with every relationship,
+            # the first label is the entity type used by PBG
+            relation_df["lhs"] = relation_df["start"].apply(lambda x: first_label(x))
+            relation_df["rhs"] = relation_df["end"].apply(lambda x: first_label(x))
+            relation_df["start"] = relation_df["start"].apply(lambda x: x["id"])
+            relation_df["end"] = relation_df["end"].apply(lambda x: x["id"])
+            relation_df = select_relationships(relation_df)
+            record["count"] = len(graph_df)
         return nodes_df, relation_df
     except Exception as e:
         logging.info("error in separating nodes and relations tsv")
         logging.info(e, exc_info=True)
 
 
+def select_relationships(relation_df):
+    """Keeps the relationships selected by the label and relationship type lists of
+    EXPORT_FILTERS. The export query already applies them, this also covers exports
+    made without the filters. The WHERE predicate can only be applied by the database.
+
+    Arguments:
+        relation_df {[Dataframe]} -- relationships with label, lhs and rhs columns
+
+    Returns:
+        [Dataframe] -- selected relationships
+    """
+    keep = pd.Series(True, index=relation_df.index)
+    if EXPORT_FILTERS.get("INCLUDE_RELATIONSHIP_TYPES"):
+        keep &= relation_df["label"].isin(EXPORT_FILTERS["INCLUDE_RELATIONSHIP_TYPES"])
+    if EXPORT_FILTERS.get("EXCLUDE_RELATIONSHIP_TYPES"):
+        keep &= ~relation_df["label"].isin(EXPORT_FILTERS["EXCLUDE_RELATIONSHIP_TYPES"])
+    for column in ["lhs", "rhs"]:
+        if EXPORT_FILTERS.get("INCLUDE_LABELS"):
+            keep &= relation_df[column].isin(EXPORT_FILTERS["INCLUDE_LABELS"])
+        if EXPORT_FILTERS.get("EXCLUDE_LABELS"):
+            keep &= ~relation_df[column].isin(EXPORT_FILTERS["EXCLUDE_LABELS"])
+    if not keep.all():
+        logging.info(f"EXPORT_FILTERS: dropping {int((~keep).sum())} relationships")
+    return relation_df[keep]
+
+
+def save_search_attributes(nodes_df):
+    """saves the labels and the SEARCH_FILTERS properties of the nodes
+    (data/node_attributes), from which the filter bitmaps of the indexes are built
+
+    Arguments:
+        nodes_df {[Dataframe]} -- nodes with id, label_list and properties columns
+    """
+    try:
+        with track_stage("preprocess.node_attributes", unit="nodes") as record:
+            data_directory = os.path.join(
+                os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], GLOBAL_CONFIG["DATA_DIRECTORY"]
+            )
+            num_values = save_node_attributes(
+                data_directory,
+                nodes_df["id"],
+                nodes_df["label_list"],
+                nodes_df["properties"],
+                SEARCH_FILTERS.get("PROPERTIES"),
+            )
+            record["count"] = len(nodes_df)
+        logging.info(f"SAVED FILTERABLE NODE ATTRIBUTES (distinct values: {num_values})")
+    except Exception as e:
+        logging.info("error in saving the node attributes")
+        logging.info(e, exc_info=True)
+        sys.exit(e)
+
+
+def first_label(node):
+    labels = node.get("labels") or [None]
+    return labels[0]
+
+
+def collect_schema(relation_df):
+    """Collects the (lhs label, relationship type, rhs label) triples and their counts
+    from the relationships read in preprocessing, so the schema does not need a
+    separate scan of the graph database. The schema is saved to metadata.json
+
+    Arguments:
+        relation_df {[Dataframe]} -- relationships with start, end, label, lhs and rhs columns
+
+    Returns:
+        [dict] -- relations with counts and the number of entities of each type
+    """
+    try:
+        logging.info("COLLECTING SCHEMA FROM RELATIONSHIPS")
+        with track_stage("preprocess.collect_schema", unit="edges") as record:
+            relation_counts = (
+                relation_df.groupby(["lhs", "label", "rhs"])
+                .size()
+                .reset_index(name="count")
+            )
+            relations = [
+                dict(lhs=row.lhs, name=row.label, rhs=row.rhs, count=int(row.count))
+                for row in relation_counts.itertuples(index=False)
+            ]
+            # entities that take part in at least one edge are the ones PBG embeds
+            endpoints = pd.concat(
+                [
+                    relation_df[["start", "lhs"]].rename(
+                        columns={"start": "id", "lhs": "label"}
+                    ),
+                    relation_df[["end", "rhs"]].rename(columns={"end": "id", "rhs": "label"}),
+                ]
+            ).drop_duplicates()
+            entity_counts = {
+                label: int(count)
+                for label, count in endpoints.groupby("label").size().items()
+            }
+            schema = dict(
+                relations=relations,
+                entity_counts=entity_counts,
+                num_edges=int(len(relation_df)),
+            )
+            update_metadata(schema=schema)
+            record["count"] = len(relation_df)
+        return schema
+    except Exception as e:
+        logging.info("error in collecting schema")
+        logging.info(e, exc_info=True)
+        sys.exit(e)
+
+
+def cap_node_degrees(relation_df):
+    """Caps the number of relationships of every node per relationship type at
+    DEGREE_CAP_CONFIG["MAX_DEGREE"], separately for outgoing and incoming relationships.
+    Every edge gets a random priority and each (node, type) group keeps its
+    MAX_DEGREE edges of lowest priority, which is the sample a reservoir over the
+    group would keep. Edges whose other end has no other relationship are kept first,
+    so the nodes of the long tail are not dropped from training.
+    The groups are ranked with one sort of integer codes per direction instead of a
+    pandas groupby, which needs about 100 bytes per relationship on top of relation_df.
+    The dropped counts are saved to metadata.json
+
+    Arguments:
+        relation_df {[Dataframe]} -- relationships with start, label and end columns
+
+    Returns:
+        [Dataframe] -- relationships left after capping
+    """
+    try:
+        max_degree = DEGREE_CAP_CONFIG.get("MAX_DEGREE")
+        if not max_degree:
+            return relation_df
+        logging.info(f"CAPPING NODE DEGREES AT {max_degree} PER RELATIONSHIP TYPE")
+        with track_stage("preprocess.degree_cap", unit="edges") as record:
+            rng = np.random.default_rng(DEGREE_CAP_CONFIG.get("SEED", 0))
+            num_edges = len(relation_df)
+            node_codes = pd.factorize(
+                pd.concat([relation_df["start"], relation_df["end"]], ignore_index=True)
+            )[0]
+            label_codes, labels = pd.factorize(relation_df["label"])
+            degree = np.bincount(node_codes)
+            priority = rng.random(num_edges)
+            keep = np.ones(num_edges, dtype=bool)
+            capped_groups = 0
+            for codes, other_codes in [
+                (node_codes[:num_edges], node_codes[num_edges:]),
+                (node_codes[num_edges:], node_codes[:num_edges]),
+            ]:
+                # (node, type) group of every edge, with edges to leaves ordered first
+                group = codes.astype(np.int64) * max(len(labels), 1) + label_codes
+                order = np.lexsort((priority + (degree[other_codes] > 1), group))
+                sorted_group = group[order]
+                starts = np.flatnonzero(np.r_[True, sorted_group[1:] != sorted_group[:-1]])
+                sizes = np.diff(np.r_[starts, num_edges])
+                rank = np.arange(num_edges) - np.repeat(starts, sizes)
+                keep[order[rank >= int(max_degree)]] = False
+                capped_groups += int((sizes > int(max_degree)).sum())
+            dropped_by_type = relation_df["label"][~keep].value_counts()
+            update_metadata(
+                degree_cap=dict(
+                    max_degree=int(max_degree),
+                    num_edges=int(len(relation_df)),
+                    dropped_edges=int((~keep).sum()),
+                    capped_groups=capped_groups,
+                    dropped_by_relationship_type={
+                        label: int(count) for label, count in dropped_by_type.items()
+                    },
+                )
+            )
+            record["count"] = len(relation_df)
+        logging.info(
+            f"DROPPED {int((~keep).sum())} OF {len(relation_df)} EDGES OF {capped_groups} "
+            f"(NODE, RELATIONSHIP TYPE) GROUPS ABOVE THE CAP"
+        )
+        return relation_df[keep]
+    except Exception as e:
+        logging.info("error in capping node degrees")
+        logging.info(e, exc_info=True)
+        sys.exit(e)
+
+
+def get_test_path():
+    """path of the held out edges (default: myproject/data/graph_test.tsv)
+    """
+    return os.path.join(
+        os.getcwd(),
+        GLOBAL_CONFIG["PROJECT_NAME"],
+        GLOBAL_CONFIG["DATA_DIRECTORY"],
+        GLOBAL_CONFIG["TSV_FILE_NAME"] + "_test.tsv",
+    )
+
+
+def split_train_test(relation_df):
+    """Holds out 1 - TRAIN_SPLIT of the relationships for evaluation.
+    Every edge is assigned by a hash of (start, label, end), so the split needs no
+    shuffle of the whole graph, can be applied chunk by chunk and an edge stays on
+    the same side when the graph is re-exported. Held out edges are written in the
+    same format as graph.tsv
+
+    Arguments:
+        relation_df {[Dataframe]} -- relationships with start, label and end columns
+
+    Returns:
+        [Dataframe] -- relationships used for training
+    """
+    try:
+        train_split = GLOBAL_CONFIG["TRAIN_SPLIT"]
+        test_path = get_test_path()
+        if train_split is None or float(train_split) >= 1:
+            if os.path.exists(test_path):
+                os.remove(test_path)  # held out edges of an earlier split
+            return relation_df
+        logging.info(f"HOLDING OUT {1 - float(train_split):.2%} OF THE EDGES FOR EVALUATION")
+        with track_stage("preprocess.split", unit="edges") as record:
+            edge_hash = pd.util.hash_pandas_object(
+                relation_df[["start", "label", "end"]].astype(str), index=False
+            ).to_numpy()
+            is_train = (edge_hash % SPLIT_BUCKETS) < int(float(train_split) * SPLIT_BUCKETS)
+            test_df = relation_df[~is_train]
+            test_df[["start", "label", "end"]].to_csv(
+                test_path, sep="\t", header=False, index=False
+            )
+            update_metadata(
+                split=dict(
+                    train_split=float(train_split),
+                    num_train_edges=int(is_train.sum()),
+                    num_test_edges=int(len(test_df)),
+                    test_file=os.path.basename(test_path),
+                )
+            )
+            record["count"] = len(relation_df)
+        logging.info(f"{len(test_df)} EDGES WRITTEN TO {test_path}")
+        return relation_df[is_train]
+    except Exception as e:
+        logging.info("error in splitting train and test edges")
+        logging.info(e, exc_info=True)
+        sys.exit(e)
+
+
+def is_tsv_required(conversion_config, dynamic_relations):
+    """whether training is converted from graph.tsv: with the tsv converter and with
+    dynamic relations, which the native converter does not handle
+    """
+    return conversion_config["CONVERTER"] == "tsv" or bool(dynamic_relations)
+
+
 def convert_to_tsv(relation_df):
     """Converts the Dataframe to tsv for PBG to read.
     each row is in the triplet format that defines one edge/relationship in the graph
@@ -87,9 +364,11 @@ def convert_to_tsv(relation_df):
             GLOBAL_CONFIG["TSV_FILE_NAME"] + ".tsv",
         )  # default myproject/data/graph.tsv
         logging.info(f"WRITING TSV FILE TO {tsv_path}")
-        relation_df[["start", "label", "end"]].to_csv(
-            tsv_path, sep="\t", header=False, index=False
-        )
+        with track_stage("preprocess.write_tsv", unit="edges") as record:
+            relation_df[["start", "label", "end"]].to_csv(
+                tsv_path, sep="\t", header=False, index=False
+            )
+            record["count"] = len(relation_df)
     except Exception as e:
         logging.info("error in converting to tsv")
         logging.info(e, exc_info=True)
@@ -98,17 +377,32 @@ def convert_to_tsv(relation_df):
 
 # entry function
 def preprocess_exported_data():
-    """entry function for converting graph export data in jsonl format to tsv format supported by PBG
+    """entry function for converting graph export data in jsonl format to tsv format supported by PBG.
+    The tsv file is only written when the tsv converter or dynamic relations are used, or
+    CONVERSION_CONFIG["WRITE_TSV"] is set
+
+    Returns:
+        [Dataframe] -- relationships for the native converter
     """
     try:
         initialise_config()
         logging.info(
             "-------------------------PREPROCESSING DATA------------------------"
         )
-        json_list = read_json_file()
-        nodes_df, relations_df = separate_nodes_relations(json_list)
-        convert_to_tsv(relations_df)
+        with track_stage("preprocess", unit="edges", profile=True) as record:
+            json_list = read_json_file()
+            nodes_df, relations_df = separate_nodes_relations(json_list)
+            save_search_attributes(nodes_df)
+            relations_df = cap_node_degrees(relations_df)
+            relations_df = split_train_test(relations_df)
+            collect_schema(relations_df)
+            if CONVERSION_CONFIG["WRITE_TSV"] or is_tsv_required(
+                CONVERSION_CONFIG, OPTIONAL_PBG_SETTINGS.get("dynamic_relations")
+            ):
+                convert_to_tsv(relations_df)
+            record["count"] = len(relations_df)
         logging.info("Done")
+        return relations_df
     except Exception as e:
         logging.info("error in preprocessing")
         logging.info(e, exc_info=True)
@@ -0,0 +1,123 @@
+"""CPU limits of the stages (RESOURCES in config.yml).
+PBG workers, the faiss OpenMP pool and torch's intra-op threads each use all cores by
+default, so stages running next to each other oversubscribe the machine. Each stage can
+be given a thread count and a set of cores; the affinity is inherited by the processes
+the stage starts (PBG workers, distributed ranks)
+"""
+from pathlib import os
+from embeoj.utils import logging
+from embeoj.autotune import get_available_cpus
+
+THREAD_ENVIRONMENT_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+initial_affinity = None  # cores of the process before any stage changed them
+
+
+def parse_cpu_list(cpu_list):
+    """cores given as a list of ids or a taskset style string such as "0-3,8"
+
+    Returns:
+        [set] -- core ids
+    """
+    if isinstance(cpu_list, (list, tuple)):
+        return set(int(cpu) for cpu in cpu_list)
+    cpus = set()
+    for part in str(cpu_list).split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.add(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """compact "0-3,8" form of a set of core ids for logging
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def get_stage_resources(stage):
+    """THREADS and CPU_AFFINITY of a stage (TRAIN, INDEX or SEARCH), null values if the
+    stage is not configured
+    """
+    from embeoj.utils import load_config
+
+    resources = (load_config("RESOURCES") or dict()).get(stage) or dict()
+    return dict(
+        THREADS=resources.get("THREADS"), CPU_AFFINITY=resources.get("CPU_AFFINITY")
+    )
+
+
+def set_affinity(cpu_affinity):
+    """pins the process to the configured cores, or back to the cores it started with
+    when the stage has no affinity
+    """
+    global initial_affinity
+    if not hasattr(os, "sched_setaffinity"):
+        if cpu_affinity is not None:
+            logging.info("CPU_AFFINITY is not supported on this platform, ignoring it")
+        return
+    if initial_affinity is None:
+        initial_affinity = os.sched_getaffinity(0)
+    cpus = parse_cpu_list(cpu_affinity) if cpu_affinity is not None else initial_affinity
+    os.sched_setaffinity(0, cpus)
+
+
+def set_thread_counts(threads):
+    """sets the faiss and torch thread pools and the environment of child processes
+    """
+    for variable in THREAD_ENVIRONMENT_VARIABLES:
+        os.environ[variable] = str(threads)
+    try:
+        import faiss
+
+        faiss.omp_set_num_threads(threads)
+    except ImportError:
+        pass
+    try:
+        import torch
+
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def get_stage_threads(stage):
+    """thread count of a stage, the number of cores it may run on if not configured
+    """
+    resources = get_stage_resources(stage)
+    if resources["THREADS"]:
+        return int(resources["THREADS"])
+    if resources["CPU_AFFINITY"] is not None:
+        return len(parse_cpu_list(resources["CPU_AFFINITY"]))
+    return get_available_cpus()
+
+
+def apply_stage_resources(stage):
+    """Applies the affinity and thread count of a stage to this process and logs them
+
+    Arguments:
+        stage {[str]} -- TRAIN, INDEX or SEARCH
+
+    Returns:
+        [dict] -- effective threads and cores
+    """
+    try:
+        resources = get_stage_resources(stage)
+        set_affinity(resources["CPU_AFFINITY"])
+        threads = get_stage_threads(stage)
+        set_thread_counts(threads)
+        cpus = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+        logging.info(
+            f"RESOURCES {stage}: {threads} threads"
+            + (f" on cores {format_cpu_list(cpus)}" if cpus else "")
+        )
+        return dict(threads=threads, cpus=sorted(cpus) if cpus else None)
+    except Exception as e:
+        logging.info(f"Could not apply the {stage} resources: {e}", exc_info=True)
@@ -0,0 +1,164 @@
+"""Recall versus speed benchmark of faiss index configurations on the checkpoint embeddings.
+Exact neighbours of a sample of nodes are found with a flat index and every candidate
+index is scored by its build time, serialized size, queries per second and recall@k
+"""
+from pathlib import os
+import json
+import sys
+import time
+import faiss
+import numpy as np
+from embeoj.utils import logging, get_checkpoint_version
+from embeoj.catalogue import load_entity_catalogue
+from embeoj.metrics import track_stage
+from embeoj.resources import apply_stage_resources
+from embeoj.tasks import index as index_task
+from embeoj.tasks.reduction import sample_embeddings, drop_query_rows
+
+BENCHMARK_CONFIG = None
+
+
+def initialise_config():
+    from embeoj.utils import load_config
+
+    global BENCHMARK_CONFIG
+    index_task.initialise_config()
+    BENCHMARK_CONFIG = load_config("BENCHMARK_CONFIG")
+
+
+def load_benchmark_vectors(rng):
+    """embeddings of all partitions, sampled down to MAX_VECTORS rows. The sample is
+    drawn over the rows of the catalogue before reading, so every partition contributes
+    in proportion to its count and only the sampled rows are loaded
+    """
+    catalogue = load_entity_catalogue(
+        index_task.DATA_DIRECTORY, index_task.CHECKPOINT_DIRECTORY
+    )
+    max_vectors = BENCHMARK_CONFIG["MAX_VECTORS"] or sum(
+        p["count"] for p in catalogue["partitions"]
+    )
+    return sample_embeddings(
+        catalogue, index_task.CHECKPOINT_DIRECTORY, get_checkpoint_version(), max_vectors, rng
+    )
+
+
+def recall_at_k(found, ground_truth):
+    """share of the exact k nearest neighbours that were returned
+    """
+    k = ground_truth.shape[1]
+    hits = sum(
+        len(np.intersect1d(found_row, truth_row)) for found_row, truth_row in zip(found, ground_truth)
+    )
+    return hits / (k * len(ground_truth))
+
+
+def is_ivf(index):
+    try:
+        faiss.extract_index_ivf(index)
+        return True
+    except RuntimeError:
+        return False
+
+
+def benchmark_index(index_name, vectors, query_rows, ground_truth):
+    """builds one index configuration and searches it with every NPROBE value. The
+    queries are indexed vectors, their self matches are not counted
+
+    Returns:
+        [list] -- one result dict per nprobe
+    """
+    k = ground_truth.shape[1]
+    index = index_task.create_faiss_index(index_name, vectors.shape[1])
+    if index is None:
+        raise ValueError(f"could not create index {index_name}")
+    started = time.perf_counter()
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - started
+    size_bytes = int(faiss.serialize_index(index).nbytes)
+    results = []
+    for nprobe in BENCHMARK_CONFIG["NPROBE"] if is_ivf(index) else [None]:
+        index_task.set_nprobe(index, nprobe)
+        started = time.perf_counter()
+        _, found = index.search(vectors[query_rows], k + 1)
+        search_seconds = time.perf_counter() - started
+        found = drop_query_rows(found, query_rows, k)
+        results.append(
+            dict(
+                index=index_name,
+                nprobe=nprobe,
+                build_seconds=build_seconds,
+                size_bytes=size_bytes,
+                queries_per_second=len(query_rows) / max(search_seconds, 1e-9),
+                recall=recall_at_k(found, ground_truth),
+            )
+        )
+    return results
+
+
+def format_table(results, k):
+    header = f"{'index':<24}{'nprobe':>8}{'build s':>10}{'size MB':>10}{'QPS':>12}{f'recall@{k}':>11}"
+    rows = [header, "-" * len(header)]
+    for result in results:
+        nprobe = "-" if result["nprobe"] is None else result["nprobe"]
+        rows.append(
+            f"{result['index']:<24}{nprobe:>8}{result['build_seconds']:>10.2f}"
+            f"{result['size_bytes'] / 1024 ** 2:>10.2f}{result['queries_per_second']:>12.0f}"
+            f"{result['recall']:>11.3f}"
+        )
+    return "\n".join(rows)
+
+
+# entry function
+def benchmark():
+    """Runs the benchmark and saves the results to model/index/benchmark.json
+
+    Returns:
+        [list] -- results of every index configuration and nprobe
+    """
+    try:
+        initialise_config()
+        apply_stage_resources("INDEX")
+        logging.info("-------------------------BENCHMARKING INDEXES------------------------")
+        rng = np.random.default_rng(BENCHMARK_CONFIG["SEED"])
+        k = int(BENCHMARK_CONFIG["K"])
+        with track_stage("benchmark", unit="configurations", profile=True) as record:
+            vectors = load_benchmark_vectors(rng)
+            num_queries = min(int(BENCHMARK_CONFIG["NUM_QUERIES"]), len(vectors))
+            query_rows = rng.choice(len(vectors), num_queries, replace=False)
+            logging.info(
+                f"{len(vectors)} vectors, {num_queries} queries, computing exact neighbours"
+            )
+            exact_index = faiss.IndexFlatL2(vectors.shape[1])
+            exact_index.add(vectors)
+            # the queries are indexed too, their own rows are dropped from the neighbours
+            _, ground_truth = exact_index.search(vectors[query_rows], k + 1)
+            ground_truth = drop_query_rows(ground_truth, query_rows, k)
+            results = []
+            for index_name in BENCHMARK_CONFIG["INDEXES"]:
+                try:
+                    results.extend(benchmark_index(index_name, vectors, query_rows, ground_truth))
+                except Exception as e:
+                    logging.info(f"skipping {index_name}: {e}")
+            record["count"] = len(results)
+        logging.info("\n" + format_table(results, k))
+        index_task.create_index_directory()
+        benchmark_path = os.path.join(index_task.CHECKPOINT_DIRECTORY, "index", "benchmark.json")
+        with open(benchmark_path, "w") as f:
+            json.dump(
+                dict(
+                    num_vectors=len(vectors),
+                    num_queries=num_queries,
+                    k=k,
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+        f.close()
+        logging.info(f"BENCHMARK SAVED TO {benchmark_path}")
+        return results
+    except Exception as e:
+        logging.error(f"Error in benchmark : {e}", exc_info=True)
+        sys.exit(e)
@@ -0,0 +1,248 @@
+"""k-means clustering of the trained embeddings of every entity type.
+Centroids are trained with faiss on a sample of the embeddings and can be refined with
+full passes over the partitions. Each pass, like the final assignment, streams the
+embeddings from the checkpoint h5 files in chunks, so only one chunk is held in memory.
+Assignments are saved aligned with the entity catalogue and can be written back to Neo4j
+"""
+from pathlib import os
+import json
+import sys
+import time
+import faiss
+import h5py
+import numpy as np
+from embeoj.utils import logging, connect_to_graphdb, get_checkpoint_version, quote_name
+from embeoj.catalogue import load_entity_catalogue
+from embeoj.metrics import track_stage
+from embeoj.resources import apply_stage_resources
+from embeoj.tasks.reduction import sample_embeddings
+from embeoj.tasks.scoring import prepare
+
+graph_connection = connect_to_graphdb()
+GLOBAL_CONFIG = None
+CLUSTERING_CONFIG = None
+DATA_DIRECTORY = None
+CHECKPOINT_DIRECTORY = None
+CLUSTER_DIRECTORY = None
+
+WRITE_BACK_QUERY = """UNWIND $rows AS row
+MATCH (n) WHERE id(n) = row.node_id
+SET n.{property} = row.cluster"""
+
+
+def initialise_config():
+    from embeoj.utils import load_config
+
+    global GLOBAL_CONFIG
+    global CLUSTERING_CONFIG
+    global DATA_DIRECTORY
+    global CHECKPOINT_DIRECTORY
+    global CLUSTER_DIRECTORY
+    GLOBAL_CONFIG = load_config("GLOBAL_CONFIG")
+    CLUSTERING_CONFIG = load_config("CLUSTERING_CONFIG")
+    DATA_DIRECTORY = os.path.join(
+        os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], GLOBAL_CONFIG["DATA_DIRECTORY"]
+    )
+    CHECKPOINT_DIRECTORY = os.path.join(
+        os.getcwd(),
+        GLOBAL_CONFIG["PROJECT_NAME"],
+        GLOBAL_CONFIG["CHECKPOINT_DIRECTORY"],
+    )
+    CLUSTER_DIRECTORY = os.path.join(CHECKPOINT_DIRECTORY, "clusters")
+
+
+def prepare_vectors(embeddings, comparator, bias):
+    """drops the bias dimension and normalises the embeddings for the cos comparator
+    """
+    if bias:
+        embeddings = embeddings[..., 1:]
+    return np.ascontiguousarray(prepare(comparator, embeddings), dtype=np.float32)
+
+
+def iterate_chunks(partitions, version, comparator, bias):
+    """Reads the embeddings of the partitions CHUNK_SIZE rows at a time
+
+    Yields:
+        [tuple] -- catalogue row of the first embedding and the (n, dimension) chunk
+    """
+    chunk_size = int(CLUSTERING_CONFIG["CHUNK_SIZE"])
+    for partition in partitions:
+        embedding_file = os.path.join(
+            CHECKPOINT_DIRECTORY,
+            f"embeddings_{partition['entity_type']}_{partition['partition_number']}.v{version}.h5",
+        )
+        with h5py.File(embedding_file, "r") as hf:
+            dataset = hf["embeddings"]
+            for start in range(0, dataset.shape[0], chunk_size):
+                chunk = prepare_vectors(dataset[start:start + chunk_size], comparator, bias)
+                yield partition["offset"] + start, chunk
+
+
+def train_centroids(partitions, version, comparator, bias, rng):
+    """Trains faiss k-means on a sample of the embeddings of one entity type
+
+    Returns:
+        [np.ndarray] -- (num_clusters, dimension) centroids
+    """
+    sample = sample_embeddings(
+        dict(partitions=partitions),
+        CHECKPOINT_DIRECTORY,
+        version,
+        CLUSTERING_CONFIG["SAMPLE_SIZE"],
+        rng,
+    )
+    sample = prepare_vectors(sample, comparator, bias)
+    num_clusters = min(int(CLUSTERING_CONFIG["NUM_CLUSTERS"]), len(sample))
+    kmeans = faiss.Kmeans(
+        sample.shape[1],
+        num_clusters,
+        niter=int(CLUSTERING_CONFIG["NITER"]),
+        seed=int(CLUSTERING_CONFIG["SEED"]),
+        spherical=comparator == "cos",
+        max_points_per_centroid=len(sample),  # the sample is already drawn
+    )
+    kmeans.train(sample)
+    return kmeans.centroids
+
+
+def assign_chunks(partitions, version, comparator, bias, centroids, assignments=None):
+    """Assigns every embedding to its nearest centroid, one chunk at a time, and
+    accumulates what is needed for a Lloyd update of the centroids
+
+    Returns:
+        [tuple] -- per cluster sums of the embeddings, per cluster counts and the inertia
+        (sum of squared distances)
+    """
+    index = faiss.IndexFlatL2(centroids.shape[1])
+    index.add(centroids)
+    sums = np.zeros(centroids.shape, dtype=np.float64)
+    counts = np.zeros(len(centroids), dtype=np.int64)
+    inertia = 0.0
+    for first_row, chunk in iterate_chunks(partitions, version, comparator, bias):
+        distances, labels = index.search(chunk, 1)
+        labels = labels[:, 0]
+        order = np.argsort(labels, kind="stable")
+        filled, starts = np.unique(labels[order], return_index=True)
+        sums[filled] += np.add.reduceat(chunk[order], starts, axis=0)
+        counts += np.bincount(labels, minlength=len(centroids))
+        inertia += float(distances.sum())
+        if assignments is not None:
+            assignments[first_row:first_row + len(chunk)] = labels
+    return sums, counts, inertia
+
+
+def cluster_entity_type(entity_type, partitions, version, pbg_config, assignments, rng):
+    """Clusters the embeddings of one entity type and fills its rows of the assignments
+
+    Returns:
+        [dict] -- summary of the clusters
+    """
+    comparator, bias = pbg_config["comparator"], pbg_config["bias"]
+    with track_stage(f"cluster.train.{entity_type}", unit="vectors") as record:
+        centroids = train_centroids(partitions, version, comparator, bias, rng)
+        record["count"] = min(
+            int(CLUSTERING_CONFIG["SAMPLE_SIZE"]), sum(p["count"] for p in partitions)
+        )
+    with track_stage(f"cluster.assign.{entity_type}", unit="vectors") as record:
+        for _ in range(int(CLUSTERING_CONFIG["REFINE_PASSES"])):
+            sums, counts, inertia = assign_chunks(
+                partitions, version, comparator, bias, centroids
+            )
+            filled = counts > 0  # empty clusters keep their centroid
+            centroids[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+            centroids = prepare_vectors(centroids, comparator, False)
+            logging.info(f"{entity_type}: refine pass inertia {inertia:.4f}")
+        _, counts, inertia = assign_chunks(
+            partitions, version, comparator, bias, centroids, assignments
+        )
+        record["count"] = int(counts.sum())
+    np.save(os.path.join(CLUSTER_DIRECTORY, f"centroids_{entity_type}.npy"), centroids)
+    return dict(
+        num_clusters=len(centroids),
+        num_entities=int(counts.sum()),
+        inertia=inertia,
+        sizes=counts.tolist(),
+    )
+
+
+def write_back(catalogue, assignments):
+    """Sets the cluster of every assigned node as the WRITE_PROPERTY node property,
+    WRITE_BATCH_SIZE nodes per query
+    """
+    query = WRITE_BACK_QUERY.format(property=quote_name(CLUSTERING_CONFIG["WRITE_PROPERTY"]))
+    batch_size = int(CLUSTERING_CONFIG["WRITE_BATCH_SIZE"])
+    assigned = np.flatnonzero(assignments >= 0)
+    with track_stage("cluster.write_back", unit="nodes") as record:
+        for batch_start in range(0, len(assigned), batch_size):
+            rows = assigned[batch_start:batch_start + batch_size]
+            graph_connection.run(
+                query,
+                dict(
+                    rows=[
+                        dict(node_id=int(node_id), cluster=int(cluster))
+                        for node_id, cluster in zip(catalogue["ids"][rows], assignments[rows])
+                    ]
+                ),
+            )
+        record["count"] = len(assigned)
+    logging.info(
+        f"WROTE THE CLUSTERS OF {len(assigned)} NODES TO THE "
+        f"{CLUSTERING_CONFIG['WRITE_PROPERTY']} PROPERTY"
+    )
+
+
+# entry function
+def cluster():
+    """Clusters the embeddings of the latest checkpoint. Assignments are saved to
+    model/clusters/assignments.npy (int32, aligned with data/entity_catalogue/ids.npy,
+    -1 for entity types that were not clustered) with the centroids of each entity type
+    and a summary in clusters.json
+
+    Returns:
+        [dict] -- summary of the clusters of each entity type
+    """
+    try:
+        initialise_config()
+        apply_stage_resources("INDEX")
+        logging.info("-------------------------CLUSTERING EMBEDDINGS------------------------")
+        with track_stage("cluster", unit="vectors", profile=True) as record:
+            started = time.perf_counter()
+            version = get_checkpoint_version()
+            with open(os.path.join(CHECKPOINT_DIRECTORY, GLOBAL_CONFIG["PBG_CONFIG_NAME"])) as f:
+                pbg_config = json.load(f)
+            f.close()
+            catalogue = load_entity_catalogue(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
+            os.makedirs(CLUSTER_DIRECTORY, exist_ok=True)
+            entity_types = CLUSTERING_CONFIG["ENTITY_TYPES"] or sorted(
+                set(p["entity_type"] for p in catalogue["partitions"])
+            )
+            assignments = np.full(len(catalogue["ids"]), -1, dtype=np.int32)
+            rng = np.random.default_rng(CLUSTERING_CONFIG["SEED"])
+            summary = dict(checkpoint_version=version, entity_types=dict())
+            for entity_type in entity_types:
+                partitions = [
+                    p for p in catalogue["partitions"] if p["entity_type"] == entity_type
+                ]
+                if not sum(p["count"] for p in partitions):
+                    logging.info(f"no embeddings for entity type {entity_type}, skipping")
+                    continue
+                logging.info(f"CLUSTERING {entity_type}")
+                summary["entity_types"][entity_type] = cluster_entity_type(
+                    entity_type, partitions, version, pbg_config, assignments, rng
+                )
+            np.save(os.path.join(CLUSTER_DIRECTORY, "assignments.npy"), assignments)
+            with open(os.path.join(CLUSTER_DIRECTORY, "clusters.json"), "w") as f:
+                json.dump(summary, f, indent=2)
+            f.close()
+            if CLUSTERING_CONFIG["WRITE_PROPERTY"]:
+                write_back(catalogue, assignments)
+            record["count"] = int((assignments >= 0).sum())
+        seconds = time.perf_counter() - started
+        logging.info(
+            f"CLUSTERED {record['count']} EMBEDDINGS IN {seconds:.1f}s, "
+            f"SAVED TO {CLUSTER_DIRECTORY}"
+        )
+        return summary
+    except Exception as e:
+        logging.error(f"Error in clustering : {e}", exc_info=True)
+        sys.exit(e)
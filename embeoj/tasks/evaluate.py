@@ -0,0 +1,286 @@
+"""Link prediction evaluation of the trained embeddings on the edges held out by TRAIN_SPLIT.
+Every held out edge is ranked against sampled negatives on both sides; edges are
+grouped by (lhs partition, rhs partition, relation) so each batch is scored with
+a few matrix products
+"""
+from pathlib import os
+import json
+import sys
+import time
+import h5py
+import numpy as np
+import pandas as pd
+from embeoj.utils import logging, get_checkpoint_version
+from embeoj.catalogue import load_entity_catalogue, lookup_entities
+from embeoj.metrics import track_stage
+from embeoj.tasks.scoring import (
+    load_model_parameters,
+    apply_operator,
+    prepare,
+    score_pairs,
+    score_all_pairs,
+    get_relation_indexes,
+)
+
+GLOBAL_CONFIG = None
+EVALUATION_CONFIG = None
+DATA_DIRECTORY = None
+CHECKPOINT_DIRECTORY = None
+HITS_AT = [1, 10]
+
+
+def initialise_config():
+    from embeoj.utils import load_config
+
+    global GLOBAL_CONFIG
+    global EVALUATION_CONFIG
+    global DATA_DIRECTORY
+    global CHECKPOINT_DIRECTORY
+    GLOBAL_CONFIG = load_config("GLOBAL_CONFIG")
+    EVALUATION_CONFIG = load_config("EVALUATION_CONFIG")
+    DATA_DIRECTORY = os.path.join(
+        os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], GLOBAL_CONFIG["DATA_DIRECTORY"]
+    )
+    CHECKPOINT_DIRECTORY = os.path.join(
+        os.getcwd(),
+        GLOBAL_CONFIG["PROJECT_NAME"],
+        GLOBAL_CONFIG["CHECKPOINT_DIRECTORY"],
+    )
+
+
+def read_test_edges():
+    """reads the held out edges written by preprocessing (default: myproject/data/graph_test.tsv)
+    """
+    test_path = os.path.join(DATA_DIRECTORY, GLOBAL_CONFIG["TSV_FILE_NAME"] + "_test.tsv")
+    if not os.path.exists(test_path):
+        raise FileNotFoundError(
+            f"{test_path} not found, set TRAIN_SPLIT in the config and run embed.py again"
+        )
+    logging.info(f"READING HELD OUT EDGES FROM {test_path}")
+    return pd.read_csv(
+        test_path,
+        sep="\t",
+        header=None,
+        names=["start", "label", "end"],
+        dtype={"start": np.int64, "label": str, "end": np.int64},
+    )
+
+
+def map_test_edges(test_df, catalogue, pbg_config):
+    """Finds the partition and embedding row of both endpoints and the relation index of
+    every held out edge. Edges with an endpoint that has no embedding or an unknown
+    (lhs, type, rhs) relation can't be scored and are dropped.
+
+    Returns:
+        [tuple] -- dict of int64 arrays rel, lhs_part, lhs_row, rhs_part, rhs_row and
+        the number of dropped edges
+    """
+    lhs_part, lhs_row = lookup_entities(catalogue, test_df["start"].to_numpy())
+    rhs_part, rhs_row = lookup_entities(catalogue, test_df["end"].to_numpy())
+    partition_types = np.array(
+        [partition["entity_type"] for partition in catalogue["partitions"]], dtype=object
+    )
+    rel = get_relation_indexes(
+        pbg_config,
+        np.where(lhs_part >= 0, partition_types[lhs_part], None),
+        test_df["label"].to_numpy(),
+        np.where(rhs_part >= 0, partition_types[rhs_part], None),
+    )
+    keep = (lhs_part >= 0) & (rhs_part >= 0) & (rel >= 0)
+    edges = dict(
+        rel=rel[keep],
+        lhs_part=lhs_part[keep],
+        lhs_row=lhs_row[keep],
+        rhs_part=rhs_part[keep],
+        rhs_row=rhs_row[keep],
+    )
+    return edges, int((~keep).sum())
+
+
+def load_partition_embeddings(partition, version):
+    embedding_file = os.path.join(
+        CHECKPOINT_DIRECTORY,
+        f"embeddings_{partition['entity_type']}_{partition['partition_number']}.v{version}.h5",
+    )
+    with h5py.File(embedding_file, "r") as hf:
+        embeddings = hf["embeddings"][...]
+    hf.close()
+    return embeddings
+
+
+def rank_against_negatives(positive_scores, negative_scores, valid):
+    """ranks of the positives among their negatives (ties count against the positive,
+    as in torchbiggraph) and the pairwise AUC terms
+
+    Returns:
+        [dict] -- sums to accumulate over batches
+    """
+    positive_scores = positive_scores[:, None]
+    ranks = 1 + ((negative_scores >= positive_scores) & valid).sum(axis=1)
+    wins = (negative_scores < positive_scores) + 0.5 * (negative_scores == positive_scores)
+    sums = dict(
+        reciprocal_rank=float((1.0 / ranks).sum()),
+        ranks=len(ranks),
+        auc=float((wins * valid).sum()),
+        auc_pairs=int(valid.sum()),
+    )
+    for k in HITS_AT:
+        sums[f"hits@{k}"] = int((ranks <= k).sum())
+    return sums
+
+
+def score_batch(lhs_embeddings, rhs_embeddings, lhs_rows, rhs_rows, relation, context, rng):
+    """scores one batch of edges of a single relation and partition pair against
+    NUM_NEGATIVES uniformly sampled entities on each side, shared by the batch
+    """
+    pbg_config, model = context["pbg_config"], context["model"]
+    comparator, bias = pbg_config["comparator"], pbg_config["bias"]
+    operator = pbg_config["relations"][relation]["operator"]
+    parameters = model["operators"].get(relation, {})
+    lhs_global, rhs_global = context["lhs_global"], context["rhs_global"]
+    num_negatives = int(EVALUATION_CONFIG["NUM_NEGATIVES"])
+
+    def adjust_lhs(rows):
+        return prepare(comparator, lhs_embeddings[rows] + lhs_global, bias)
+
+    def adjust_rhs(rows):
+        return prepare(
+            comparator,
+            apply_operator(operator, parameters, rhs_embeddings[rows] + rhs_global),
+            bias,
+        )
+
+    lhs, rhs = adjust_lhs(lhs_rows), adjust_rhs(rhs_rows)
+    positive_scores = score_pairs(comparator, lhs, rhs, bias)
+    lhs_negatives = rng.integers(0, len(lhs_embeddings), num_negatives)
+    rhs_negatives = rng.integers(0, len(rhs_embeddings), num_negatives)
+    # a sampled negative that is the true entity is not a negative
+    results = [
+        rank_against_negatives(
+            positive_scores,
+            score_all_pairs(comparator, lhs, adjust_rhs(rhs_negatives), bias),
+            rhs_negatives[None, :] != rhs_rows[:, None],
+        ),
+        rank_against_negatives(
+            positive_scores,
+            score_all_pairs(comparator, rhs, adjust_lhs(lhs_negatives), bias),
+            lhs_negatives[None, :] != lhs_rows[:, None],
+        ),
+    ]
+    return {key: sum(result[key] for result in results) for key in results[0]}
+
+
+def evaluate_edges(edges, catalogue, pbg_config, model, version):
+    """scores all edges group by group, keeping only the two partitions of the current
+    group in memory
+
+    Returns:
+        [dict] -- summed metrics over all edges and both sides
+    """
+    rng = np.random.default_rng(EVALUATION_CONFIG["SEED"])
+    batch_size = int(EVALUATION_CONFIG["BATCH_SIZE"])
+    num_partitions = len(catalogue["partitions"])
+    num_relations = len(pbg_config["relations"])
+    group = (
+        edges["lhs_part"] * num_partitions + edges["rhs_part"]
+    ) * num_relations + edges["rel"]
+    order = np.argsort(group, kind="stable")
+    group_keys, group_starts = np.unique(group[order], return_index=True)
+    group_ends = np.append(group_starts[1:], len(order))
+    totals = dict()
+    cache = dict()
+    for group_key, start, end in zip(group_keys, group_starts, group_ends):
+        relation = int(group_key % num_relations)
+        lhs_part = int(group_key // num_relations // num_partitions)
+        rhs_part = int(group_key // num_relations % num_partitions)
+        for part in list(cache):
+            if part not in (lhs_part, rhs_part):
+                del cache[part]
+        for part in (lhs_part, rhs_part):
+            if part not in cache:
+                cache[part] = load_partition_embeddings(catalogue["partitions"][part], version)
+        relation_config = pbg_config["relations"][relation]
+        global_embeddings = model["global_embeddings"] if pbg_config["global_emb"] else {}
+        context = dict(
+            pbg_config=pbg_config,
+            model=model,
+            lhs_global=global_embeddings.get(relation_config["lhs"], 0),
+            rhs_global=global_embeddings.get(relation_config["rhs"], 0),
+        )
+        selected = order[start:end]
+        for batch_start in range(0, len(selected), batch_size):
+            batch = selected[batch_start:batch_start + batch_size]
+            sums = score_batch(
+                cache[lhs_part],
+                cache[rhs_part],
+                edges["lhs_row"][batch],
+                edges["rhs_row"][batch],
+                relation,
+                context,
+                rng,
+            )
+            for key, value in sums.items():
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+# entry function
+def evaluate():
+    """Evaluates the latest checkpoint on the held out edges and saves the report
+    to the checkpoint directory (default: myproject/model/evaluation.json)
+
+    Returns:
+        [dict] -- MRR, Hits@1/10, AUC and evaluation throughput
+    """
+    try:
+        initialise_config()
+        logging.info("-------------------------EVALUATING------------------------")
+        with track_stage("evaluate", unit="edges", profile=True) as record:
+            started = time.perf_counter()
+            version = get_checkpoint_version()
+            with open(os.path.join(CHECKPOINT_DIRECTORY, GLOBAL_CONFIG["PBG_CONFIG_NAME"])) as f:
+                pbg_config = json.load(f)
+            f.close()
+            model = load_model_parameters(
+                os.path.join(CHECKPOINT_DIRECTORY, f"model.v{version}.h5")
+            )
+            catalogue = load_entity_catalogue(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
+            edges, skipped = map_test_edges(read_test_edges(), catalogue, pbg_config)
+            if skipped:
+                logging.info(f"skipping {skipped} held out edges without embeddings")
+            max_edges = EVALUATION_CONFIG["MAX_EDGES"]
+            if max_edges and len(edges["rel"]) > int(max_edges):
+                sample = np.random.default_rng(EVALUATION_CONFIG["SEED"]).choice(
+                    len(edges["rel"]), int(max_edges), replace=False
+                )
+                edges = {key: values[sample] for key, values in edges.items()}
+            num_edges = len(edges["rel"])
+            if num_edges == 0:
+                raise ValueError("no held out edge can be scored")
+            totals = evaluate_edges(edges, catalogue, pbg_config, model, version)
+            seconds = time.perf_counter() - started
+            report = dict(
+                checkpoint_version=version,
+                num_edges=num_edges,
+                skipped_edges=skipped,
+                num_negatives=int(EVALUATION_CONFIG["NUM_NEGATIVES"]),
+                mrr=totals["reciprocal_rank"] / totals["ranks"],
+                auc=totals["auc"] / max(totals["auc_pairs"], 1),
+                seconds=seconds,
+                edges_per_second=num_edges / seconds,
+            )
+            for k in HITS_AT:
+                report[f"hits@{k}"] = totals[f"hits@{k}"] / totals["ranks"]
+            record["count"] = num_edges
+        report_path = os.path.join(CHECKPOINT_DIRECTORY, "evaluation.json")
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        f.close()
+        logging.info("-----------EVALUATION----------------")
+        for key, value in report.items():
+            logging.info(f"{key}: {value}")
+        logging.info(f"REPORT SAVED TO {report_path}")
+        return report
+    except Exception as e:
+        logging.error(f"Error in evaluation : {e}", exc_info=True)
+        sys.exit(e)
@@ -0,0 +1,172 @@
+"""Filter bitmaps of the search indexes.
+When the indexes are built, every (field, value) of the node attributes gets a bitmap of
+the rows of each partition with that value (model/index/filters_<type>_<partition>.npy,
+bit i of byte i // 8 for row i as read by faiss.IDSelectorBitmap). A search filter is
+answered by combining bitmaps: values of the same field with OR, fields with AND
+"""
+from pathlib import os
+import json
+import numpy as np
+import pandas as pd
+from embeoj.utils import logging
+from embeoj.node_attributes import load_node_attributes
+
+FILTER_FILE_PREFIX = "filters_"
+
+
+def get_filter_paths(index_directory, entity_type, partition_number):
+    name = f"{FILTER_FILE_PREFIX}{entity_type}_{partition_number}"
+    return (
+        os.path.join(index_directory, name + ".npy"),
+        os.path.join(index_directory, name + ".json"),
+    )
+
+
+def set_rows(bitmap, rows):
+    """sets the bits of the given rows in a packed bitmap, in place
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    np.bitwise_or.at(bitmap, rows >> 3, (1 << (rows & 7)).astype(np.uint8))
+
+
+def group_rows(partition_rows, codes):
+    """rows of each distinct code, grouped with one sort instead of a scan per value
+
+    Returns:
+        [tuple] -- distinct codes and the rows of each
+    """
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    present = sorted_codes[np.flatnonzero(np.diff(sorted_codes, prepend=-1))]
+    bounds = np.searchsorted(sorted_codes, present)
+    return present, np.split(partition_rows[order], bounds[1:])
+
+
+def build_filter_bitmaps(attributes, partition_ids, max_values, bitmap_path):
+    """Builds the bitmaps of one partition and saves them to bitmap_path, written one
+    bitmap at a time into a memory mapped array
+
+    Arguments:
+        attributes {[dict]} -- node attributes from load_node_attributes
+        partition_ids {[np.ndarray]} -- node ids of the partition in embedding row order
+        max_values {[int]} -- fields with more distinct values get no bitmaps
+        bitmap_path {[str]} -- .npy file of the (num_bitmaps, ceil(rows / 8)) uint8 bitmaps
+
+    Returns:
+        [dict] -- the bitmap of each value by field
+    """
+    positions = pd.Index(partition_ids).get_indexer(attributes["ids"])
+    groups, keys = [], dict(fields=dict(), skipped_fields=[])
+    for field, (rows, codes, values) in attributes["fields"].items():
+        if max_values and len(values) > int(max_values):
+            keys["skipped_fields"].append(field)
+            continue
+        partition_rows = positions[rows]
+        in_partition = partition_rows >= 0
+        present, grouped = group_rows(partition_rows[in_partition], codes[in_partition])
+        keys["fields"][field] = dict()
+        for code, value_rows in zip(present, grouped):
+            keys["fields"][field][values[code]] = len(groups)
+            groups.append(value_rows)
+    num_bytes = (len(partition_ids) + 7) // 8
+    if not groups or not num_bytes:
+        np.save(bitmap_path, np.zeros((len(groups), num_bytes), dtype=np.uint8))
+        return keys
+    bitmaps = np.lib.format.open_memmap(
+        bitmap_path, mode="w+", dtype=np.uint8, shape=(len(groups), num_bytes)
+    )  # zero filled
+    for i, value_rows in enumerate(groups):
+        set_rows(bitmaps[i], value_rows)
+    bitmaps.flush()
+    del bitmaps
+    return keys
+
+
+def save_filter_bitmaps(index_directory, data_directory, catalogue, search_filters):
+    """Builds the bitmaps of all partitions, unless they were built with the same
+    SEARCH_FILTERS settings. Nothing is built if preprocessing saved no node attributes
+    """
+    settings = dict(
+        properties=list(search_filters.get("PROPERTIES") or []),
+        max_values=search_filters.get("MAX_VALUES"),
+    )
+    attributes = None
+    for partition in catalogue["partitions"]:
+        bitmap_path, keys_path = get_filter_paths(
+            index_directory, partition["entity_type"], partition["partition_number"]
+        )
+        if os.path.exists(keys_path):
+            with open(keys_path, "r") as f:
+                saved_settings = json.load(f).get("settings")
+            f.close()
+            if saved_settings == settings:
+                continue
+        if attributes is None:
+            attributes = load_node_attributes(data_directory)
+            if attributes is None:
+                logging.info("no node attributes saved, run embed.py again to filter searches")
+                return
+        partition_ids = catalogue["ids"][
+            partition["offset"]:partition["offset"] + partition["count"]
+        ]
+        keys = build_filter_bitmaps(
+            attributes, partition_ids, settings["max_values"], bitmap_path
+        )
+        keys["settings"] = settings
+        with open(keys_path, "w") as f:
+            json.dump(keys, f)
+        f.close()
+        for field in keys["skipped_fields"]:
+            logging.info(f"{field} has more than {settings['max_values']} values, not filterable")
+
+
+def load_filter_bitmaps(index_directory, entity_type, partition_number):
+    bitmap_path, keys_path = get_filter_paths(index_directory, entity_type, partition_number)
+    if not os.path.exists(keys_path):
+        raise FileNotFoundError(
+            f"no filter bitmaps for {entity_type}_{partition_number}, "
+            "run embed.py with SEARCH_FILTERS set to filter searches"
+        )
+    with open(keys_path, "r") as f:
+        keys = json.load(f)
+    f.close()
+    return np.load(bitmap_path, mmap_mode="r"), keys
+
+
+def combine_filters(filters, bitmaps, keys):
+    """bitmap of the rows of a partition that match every field of the filters
+
+    Arguments:
+        filters {[dict]} -- accepted values by field, e.g. {"status": ["active"]}
+        bitmaps, keys -- filter bitmaps of the partition from load_filter_bitmaps
+
+    Raises:
+        ValueError -- for fields without bitmaps
+
+    Returns:
+        [np.ndarray] -- packed uint8 bitmap
+    """
+    combined = np.full(bitmaps.shape[1], 0xFF, dtype=np.uint8)
+    for field, values in filters.items():
+        if field not in keys["fields"]:
+            raise ValueError(
+                f"can't filter on {field}, add it to SEARCH_FILTERS.PROPERTIES "
+                f"(at most MAX_VALUES values) and run embed.py again"
+            )
+        field_bitmap = np.zeros(bitmaps.shape[1], dtype=np.uint8)
+        for value in values:
+            if value in keys["fields"][field]:
+                field_bitmap |= bitmaps[keys["fields"][field][value]]
+        combined &= field_bitmap
+    return combined
+
+
+def count_rows(bitmap):
+    return int(np.unpackbits(bitmap).sum())
+
+
+def is_row_selected(bitmap, rows):
+    """whether each row is set in the packed bitmap
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    return ((bitmap[rows >> 3] >> (rows & 7)) & 1).astype(bool)
@@ -3,16 +3,24 @@ import json
 from pathlib import os
 import h5py
 import numpy as np
-from embeoj.utils import logging, get_checkpoint_version
+from embeoj.utils import logging, get_checkpoint_version, get_checkpoint_id
+from embeoj.catalogue import load_entity_catalogue
+from embeoj.metrics import track_stage
+from embeoj.resources import apply_stage_resources
+from embeoj.tasks import reduction
+from embeoj.tasks import filters as search_filters
 
 # graph_connection = connect_to_graphdb()
 SIMILARITY_SEARCH_CONFIG = None
+REDUCTION_CONFIG = None
+SEARCH_FILTERS = None
 GLOBAL_CONFIG = None
 DATA_DIRECTORY = None
 CHECKPOINT_DIRECTORY = None
 FAISS_INDEX_NAME = None
 EMBEDDING_DIMENSIONS = None
 NUM_CLUSTER = None
+NPROBE = None
 neighbors = None
 
 
@@ -20,15 +28,20 @@ def initialise_config():
     from embeoj.utils import load_config
 
     global SIMILARITY_SEARCH_CONFIG
+    global REDUCTION_CONFIG
+    global SEARCH_FILTERS
     global GLOBAL_CONFIG
     global DATA_DIRECTORY
     global CHECKPOINT_DIRECTORY
     global FAISS_INDEX_NAME
     global EMBEDDING_DIMENSIONS
     global NUM_CLUSTER
+    global NPROBE
     global neighbors
 
     SIMILARITY_SEARCH_CONFIG = load_config("SIMILARITY_SEARCH_CONFIG")
+    REDUCTION_CONFIG = load_config("REDUCTION_CONFIG") or dict()
+    SEARCH_FILTERS = load_config("SEARCH_FILTERS") or dict()
     GLOBAL_CONFIG = load_config("GLOBAL_CONFIG")
     DATA_DIRECTORY = os.path.join(
         os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], GLOBAL_CONFIG["DATA_DIRECTORY"]
@@ -41,6 +54,7 @@ def initialise_config():
     FAISS_INDEX_NAME = SIMILARITY_SEARCH_CONFIG["FAISS_INDEX_NAME"]
     EMBEDDING_DIMENSIONS = GLOBAL_CONFIG["EMBEDDING_DIMENSIONS"]
     NUM_CLUSTER = SIMILARITY_SEARCH_CONFIG["NUM_CLUSTER"]
+    NPROBE = SIMILARITY_SEARCH_CONFIG["NPROBE"]
     neighbors = SIMILARITY_SEARCH_CONFIG["NEAREST_NEIGHBORS"] + 1
 
 
@@ -52,27 +66,97 @@ def create_index_directory():
         logging.error(f"Could not create index: {e}", exc_info=True)
 
 
-def create_faiss_index():
-    """Creates the index for the embeddings 
+def create_faiss_index(index_name=None, dimension=None):
+    """Creates the index for the embeddings. IndexIVFFlat and IndexFlatL2 are built with
+    NUM_CLUSTER lists, any other name is passed to faiss.index_factory
+    (e.g. "HNSW32", "IVF1024,PQ16")
 
-    Arguments:
-        index_name {str} -- Name of faiss index to use
+    Keyword Arguments:
+        index_name {str} -- Name of faiss index to use (default: {FAISS_INDEX_NAME})
+        dimension {int} -- size of the vectors (default: {EMBEDDING_DIMENSIONS})
 
     Returns:
         faiss index of given type
     """
     try:
-
-        if FAISS_INDEX_NAME == "IndexIVFFlat":
-            quantizer = faiss.IndexFlatL2(EMBEDDING_DIMENSIONS)
-            index = faiss.IndexIVFFlat(quantizer, EMBEDDING_DIMENSIONS, NUM_CLUSTER)
-        elif FAISS_INDEX_NAME == "IndexFlatL2":
-            index = faiss.IndexFlatL2(EMBEDDING_DIMENSIONS)
+        index_name = index_name or FAISS_INDEX_NAME
+        dimension = dimension or EMBEDDING_DIMENSIONS
+        if index_name == "IndexIVFFlat":
+            quantizer = faiss.IndexFlatL2(dimension)
+            index = faiss.IndexIVFFlat(quantizer, dimension, NUM_CLUSTER)
+        elif index_name == "IndexFlatL2":
+            index = faiss.IndexFlatL2(dimension)
+        else:
+            index = faiss.index_factory(dimension, index_name)
         return index
     except Exception as e:
         logging.error(f"Could not create index: {e}", exc_info=True)
 
 
+def set_nprobe(index, nprobe):
+    """sets the number of inverted lists visited per query of IVF indexes
+    """
+    if not nprobe:
+        return
+    try:
+        faiss.extract_index_ivf(index).nprobe = int(nprobe)
+    except RuntimeError:
+        pass  # not an IVF index
+
+
+def get_index_settings():
+    return dict(
+        faiss_index_name=FAISS_INDEX_NAME,
+        num_cluster=NUM_CLUSTER,
+        embedding_dimensions=EMBEDDING_DIMENSIONS,
+        checkpoint_version=get_checkpoint_version(),
+        checkpoint_id=get_checkpoint_id(CHECKPOINT_DIRECTORY),
+        reduction=reduction.get_reduction_settings(REDUCTION_CONFIG),
+    )
+
+
+def get_index_dimension():
+    """size of the indexed vectors, the reduced size if a reduction is configured
+    """
+    if reduction.is_enabled(REDUCTION_CONFIG):
+        return int(REDUCTION_CONFIG["DIMENSIONS"])
+    return EMBEDDING_DIMENSIONS
+
+
+def load_query_transform():
+    """the fitted reduction, None if the vectors are indexed without one
+    """
+    if not reduction.is_enabled(REDUCTION_CONFIG):
+        return None
+    return reduction.load_transform(CHECKPOINT_DIRECTORY)
+
+
+def remove_stale_indexes():
+    """removes the index files and the fitted reduction when they were built with other
+    index settings or from another checkpoint, so they are rebuilt by create_indexes
+    """
+    index_directory = os.path.join(CHECKPOINT_DIRECTORY, "index")
+    settings_path = os.path.join(index_directory, "index_settings.json")
+    settings = get_index_settings()
+    if os.path.exists(settings_path):
+        with open(settings_path, "r") as f:
+            previous_settings = json.load(f)
+        f.close()
+        if previous_settings == settings:
+            return
+    for index_file in os.listdir(index_directory):
+        if index_file.endswith(".index") or index_file.startswith(
+            search_filters.FILTER_FILE_PREFIX
+        ) or index_file in (
+            reduction.TRANSFORM_FILE,
+            reduction.REPORT_FILE,
+        ):
+            os.remove(os.path.join(index_directory, index_file))
+    with open(settings_path, "w") as f:
+        json.dump(settings, f)
+    f.close()
+
+
 def read_embeddings(entity_type, partition_number):
     """Reads embeddings (.h5) files
 
@@ -109,11 +193,14 @@ def load_index(index_path):
         logging.error(f"Error in Indexing : {e}", exc_info=True)
 
 
-def save_index(entity_type, partition_number):
+def save_index(entity_type, partition_number, transform=None):
     """Saves the index file 
     
     Arguments:
         entity_file {[str]} -- Name of the entity files
+
+    Keyword Arguments:
+        transform {[faiss.VectorTransform]} -- reduction applied before indexing (default: {None})
     
     Returns:
         [type] -- created index
@@ -121,15 +208,18 @@ def save_index(entity_type, partition_number):
     try:
         index_filename = f"index_{entity_type}_{partition_number}.index"
         index_path = os.path.join(CHECKPOINT_DIRECTORY, "index", index_filename)
-        embeddings = read_embeddings(entity_type, partition_number)
-
         if not os.path.exists(index_path):
+            embeddings = reduction.apply_transform(
+                transform, read_embeddings(entity_type, partition_number)
+            )
             logging.info(f"creating new index file {index_filename}")
-            index = create_faiss_index()
-            if FAISS_INDEX_NAME == "IndexIVFFlat":
-                index.train(embeddings)
+            with track_stage(f"index.build.{entity_type}_{partition_number}", unit="vectors") as record:
+                index = create_faiss_index(dimension=get_index_dimension())
+                if not index.is_trained:
+                    index.train(embeddings)
                 index.add(embeddings)
                 faiss.write_index(index, index_path)
+                record["count"] = index.ntotal
         else:
             logging.info("index exists ")
 
@@ -143,50 +233,174 @@ def create_indexes():
         logging.info(
             f"-------------------------CHECKING FOR INDEXES------------------------"
         )
+        apply_stage_resources("INDEX")
         create_index_directory()
-        with open(os.path.join(DATA_DIRECTORY, "entity_dictionary.json"), "r") as f:
-            all_entity_dictionary = json.load(f)
-        f.close()
-        for ent in all_entity_dictionary["all_entities"]:
-            try:
-                partition_number = ent["partition_number"]
-                entity_type = ent["entity_type"]
-                save_index(entity_type, partition_number)
-            except Exception as e:
-                logging.info(f"error in index creation: {e}", exc_info=True)
-                continue
+        remove_stale_indexes()
+        with track_stage("index.create_indexes", unit="partitions", profile=True) as record:
+            catalogue = load_entity_catalogue(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
+            transform = load_query_transform()
+            if reduction.is_enabled(REDUCTION_CONFIG) and transform is None:
+                reduction.fit_reduction(
+                    REDUCTION_CONFIG, catalogue, CHECKPOINT_DIRECTORY, get_checkpoint_version()
+                )
+                transform = load_query_transform()
+            for ent in catalogue["partitions"]:
+                try:
+                    partition_number = ent["partition_number"]
+                    entity_type = ent["entity_type"]
+                    save_index(entity_type, partition_number, transform)
+                except Exception as e:
+                    logging.info(f"error in index creation: {e}", exc_info=True)
+                    continue
+            search_filters.save_filter_bitmaps(
+                os.path.join(CHECKPOINT_DIRECTORY, "index"), DATA_DIRECTORY, catalogue, SEARCH_FILTERS
+            )
+            record["count"] = len(catalogue["partitions"])
         logging.info("Done")
     except Exception as e:
         logging.info(f"error in index creation: {e}", exc_info=True)
 
 
-def search_in_index(index_filename, query_entity_embedding):
+def search_in_index(index_filename, query_entity_embedding, bitmap=None):
     try:
         index_path = os.path.join(CHECKPOINT_DIRECTORY, "index", index_filename)
         index = load_index(index_path)
+        if bitmap is not None:
+            return search_with_bitmap(index, query_entity_embedding, bitmap)
+        set_nprobe(index, NPROBE)
         distances, indices = index.search(query_entity_embedding, neighbors)
         return distances, indices
     except Exception as e:
         logging.info(f"{e}", exc_info=True)
 
 
-def search_all(entity_type, partition_number, query_index):
+def search_with_bitmap(index, query_entity_embedding, bitmap):
+    """Searches only the rows set in a filter bitmap, passed to faiss as an ID selector.
+    IVF indexes visit more lists until k rows are found, since the selected rows may be
+    in lists that NPROBE doesn't reach. Indexes that can't use a selector (faiss < 1.7.3,
+    some index types) are searched for more neighbours and the results are filtered.
+
+    Arguments:
+        index {[faiss.Index]} -- index of one partition
+        query_entity_embedding {[np.ndarray]} -- (1, dimension) query
+        bitmap {[np.ndarray]} -- packed uint8 bitmap of the selected rows
+
+    Returns:
+        [tuple] -- distances and rows, padded with -1 like faiss when fewer rows match
+    """
+    k = min(neighbors, search_filters.count_rows(bitmap))
+    if k == 0:
+        return np.empty((1, 0), dtype=np.float32), np.empty((1, 0), dtype=np.int64)
+    bitmap = np.ascontiguousarray(bitmap, dtype=np.uint8)
+    try:
+        selector = faiss.IDSelectorBitmap(index.ntotal, faiss.swig_ptr(bitmap))
+        try:
+            index_ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            index_ivf = None
+        nprobe = int(NPROBE or 1)
+        while True:
+            if index_ivf is not None:
+                parameters = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+            else:
+                parameters = faiss.SearchParameters(sel=selector)
+            distances, indices = index.search(query_entity_embedding, k, params=parameters)
+            if (indices >= 0).sum() >= k or index_ivf is None or nprobe >= index_ivf.nlist:
+                break
+            nprobe = min(nprobe * 2, index_ivf.nlist)
+        if (indices >= 0).sum() >= k:
+            return distances, indices
+    except (AttributeError, TypeError, RuntimeError) as e:
+        logging.info(f"ID selectors not supported ({e}), filtering the results instead")
+    return search_and_filter(index, query_entity_embedding, bitmap, k)
+
+
+def search_and_filter(index, query_entity_embedding, bitmap, k):
+    """searches for more and more neighbours until k of them are set in the bitmap
+    """
+    set_nprobe(index, NPROBE)
+    num_neighbors = 4 * k
+    while True:
+        num_neighbors = min(num_neighbors, index.ntotal)
+        distances, indices = index.search(query_entity_embedding, num_neighbors)
+        found = indices[0] >= 0
+        found[found] = search_filters.is_row_selected(bitmap, indices[0][found])
+        if found.sum() >= k or num_neighbors >= index.ntotal:
+            return distances[:, found][:, :k], indices[:, found][:, :k]
+        num_neighbors *= 4
+
+
+def search_inferred(store, query_entity_embedding, first_list_id, transform=None):
+    """exact search over the embeddings of nodes added after training
+    (model/inferred_embeddings.h5), with the squared L2 distances the indexes return
+
+    Returns:
+        [tuple] -- results in the search_all format and the entity type of each store list
+    """
+    results = []
+    for i, (entity_type, (ids, embeddings)) in enumerate(store.items()):
+        embeddings = reduction.apply_transform(transform, embeddings)
+        distances = np.square(embeddings - query_entity_embedding).sum(axis=1)
+        nearest = np.argsort(distances)[:neighbors]
+        list_id = np.full(len(nearest), first_list_id + i)
+        results.append(np.stack([nearest, distances[nearest], list_id], axis=1))
+    search_results = np.vstack(results) if results else np.empty((0, 3))
+    return search_results, [f"inferred_{entity_type}" for entity_type in store]
+
+
+def search_all(
+    entity_type, partition_number, query_index, query_entity_embedding=None, filters=None
+):
+    """searches the indexes of all partitions and the inferred embeddings
+
+    Arguments:
+        entity_type {[str]} -- label of the query node
+        partition_number {[int]} -- partition of the query node
+        query_index {[int]} -- embedding row of the query node
+
+    Keyword Arguments:
+        query_entity_embedding {[np.ndarray]} -- embedding of a query node without a
+        trained embedding (default: {None})
+        filters {[dict]} -- accepted values by field (a property or "label"), e.g.
+        {"status": ["active"]} (default: {None})
+
+    Returns:
+        [tuple] -- results sorted by distance (row, distance, list id), names of the
+        searched lists and the number of neighbours
+    """
+    from embeoj.tasks.inferred_store import load_inferred
+
     initialise_config()
     entity_file_list = []
-    embeddings = read_embeddings(entity_type, partition_number)
-    query_entity_embedding = embeddings[query_index, :]
-    query_entity_embedding = query_entity_embedding.reshape((1, EMBEDDING_DIMENSIONS))
-    with open(os.path.join(DATA_DIRECTORY, "entity_dictionary.json"), "r") as f:
-        all_entity_dictionary = json.load(f)
-    f.close()
+    if query_entity_embedding is None:
+        embeddings = read_embeddings(entity_type, partition_number)
+        query_entity_embedding = embeddings[query_index, :]
+    query_entity_embedding = np.asarray(query_entity_embedding, dtype=np.float32).reshape(
+        (1, EMBEDDING_DIMENSIONS)
+    )
+    transform = load_query_transform()
+    query_entity_embedding = reduction.apply_transform(transform, query_entity_embedding)
+    catalogue = load_entity_catalogue(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
     search_results = np.empty((0, 3))
-    for i, ent in enumerate(all_entity_dictionary["all_entities"]):
+    for i, ent in enumerate(catalogue["partitions"]):
+        partition_number = ent["partition_number"]
+        entity_type = ent["entity_type"]
+        entity_file_list.append(f"{entity_type}_{partition_number}")
+        bitmap = None
+        if filters:  # invalid filters are raised instead of skipping the partition
+            bitmap = search_filters.combine_filters(
+                filters,
+                *search_filters.load_filter_bitmaps(
+                    os.path.join(CHECKPOINT_DIRECTORY, "index"), entity_type, partition_number
+                ),
+            )
+            if not bitmap.any():
+                continue  # no node of the partition matches
         try:
-            partition_number = ent["partition_number"]
-            entity_type = ent["entity_type"]
-            entity_file_list.append(f"{entity_type}_{partition_number}")
             index_filename = f"index_{entity_type}_{partition_number}.index"
-            distances, indices = search_in_index(index_filename, query_entity_embedding)
+            distances, indices = search_in_index(
+                index_filename, query_entity_embedding, bitmap
+            )
             distances = distances.reshape((-1, 1))
             indices = indices.reshape((-1, 1))
             list_id = np.array([i] * len(indices)).reshape(-1, 1)
@@ -195,5 +409,13 @@ def search_all(entity_type, partition_number, query_index):
         except Exception as e:
             logging.info(f"Skipping search due to : {e}", exc_info=True)
             continue
+    store = load_inferred(CHECKPOINT_DIRECTORY, get_checkpoint_id(CHECKPOINT_DIRECTORY))
+    if filters:
+        store = dict()  # the attributes of inferred nodes are not exported
+    inferred_results, inferred_lists = search_inferred(
+        store, query_entity_embedding, len(entity_file_list), transform
+    )
+    search_results = np.vstack([search_results, inferred_results])
+    entity_file_list.extend(inferred_lists)
     search_results = search_results[search_results[:, 1].argsort()]
     return search_results, entity_file_list, neighbors
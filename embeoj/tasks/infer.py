@@ -0,0 +1,241 @@
+"""Embeddings for nodes added to the graph after training.
+An unseen node gets the mean of what each of its trained neighbours predicts for it:
+for an outgoing relationship the relation operator applied to the neighbour (the rhs
+embedding it is compared with), for an incoming one the adjoint of the operator applied
+to the neighbour. The global embedding of the node's type is then subtracted.
+"""
+from pathlib import os
+import json
+import sys
+import time
+import h5py
+import numpy as np
+from embeoj.utils import logging, connect_to_graphdb, get_checkpoint_version, get_checkpoint_id
+from embeoj.catalogue import load_entity_catalogue, lookup_entities
+from embeoj.metrics import track_stage
+from embeoj.tasks.scoring import (
+    load_model_parameters,
+    apply_operator,
+    apply_adjoint,
+    prepare,
+    get_relation_indexes,
+)
+from embeoj.tasks.inferred_store import write_inferred
+from embeoj.tasks.result_cache import clear_cache
+
+graph_connection = connect_to_graphdb()
+GLOBAL_CONFIG = None
+INFERENCE_CONFIG = None
+DATA_DIRECTORY = None
+CHECKPOINT_DIRECTORY = None
+
+NEIGHBOURHOOD_QUERY = """UNWIND $ids AS node_id
+MATCH (n)-[r]-(m) WHERE id(n) = node_id
+RETURN node_id, head(labels(n)) AS entity_type, type(r) AS label,
+id(m) AS neighbour_id, head(labels(m)) AS neighbour_type,
+startNode(r) = n AS outgoing"""
+CONNECTED_NODES_QUERY = "MATCH (n) WHERE (n)--() RETURN id(n) AS node_id"
+
+
+def initialise_config():
+    from embeoj.utils import load_config
+
+    global GLOBAL_CONFIG
+    global INFERENCE_CONFIG
+    global DATA_DIRECTORY
+    global CHECKPOINT_DIRECTORY
+    GLOBAL_CONFIG = load_config("GLOBAL_CONFIG")
+    INFERENCE_CONFIG = load_config("INFERENCE_CONFIG")
+    DATA_DIRECTORY = os.path.join(
+        os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], GLOBAL_CONFIG["DATA_DIRECTORY"]
+    )
+    CHECKPOINT_DIRECTORY = os.path.join(
+        os.getcwd(),
+        GLOBAL_CONFIG["PROJECT_NAME"],
+        GLOBAL_CONFIG["CHECKPOINT_DIRECTORY"],
+    )
+
+
+def find_untrained_nodes(catalogue, batch_size):
+    """ids of the nodes of the graph that have at least one relationship but no trained
+    embedding. The connected nodes are streamed from the database and compared with the
+    catalogue batch_size ids at a time, so only the untrained ids are kept
+
+    Returns:
+        [tuple] -- untrained node ids and the number of connected nodes that are trained
+    """
+    untrained, num_trained, batch = [], 0, []
+    records = iter(graph_connection.run(CONNECTED_NODES_QUERY))
+    while True:
+        record = next(records, None)
+        if record is not None:
+            batch.append(record["node_id"])
+        if batch and (record is None or len(batch) >= batch_size):
+            node_ids = np.asarray(batch, dtype=np.int64)
+            trained = lookup_entities(catalogue, node_ids)[0] >= 0
+            untrained.append(node_ids[~trained])
+            num_trained += int(trained.sum())
+            batch = []
+        if record is None:
+            break
+    node_ids = np.concatenate(untrained) if untrained else np.empty((0,), dtype=np.int64)
+    return node_ids, num_trained
+
+
+def fetch_neighbourhoods(node_ids):
+    """relationships of a batch of nodes in one query
+
+    Returns:
+        [Dataframe] -- node_id, entity_type, label, neighbour_id, neighbour_type, outgoing
+    """
+    return graph_connection.run(
+        NEIGHBOURHOOD_QUERY, dict(ids=[int(node_id) for node_id in node_ids])
+    ).to_data_frame()
+
+
+def read_neighbour_embeddings(neighbour_ids, catalogue, version, dimension):
+    """trained embeddings of the neighbours, reading only the needed rows of each partition
+
+    Returns:
+        [tuple] -- (n, dimension) embeddings and a mask of the neighbours that were trained
+    """
+    partition_index, entity_index = lookup_entities(catalogue, neighbour_ids)
+    embeddings = np.zeros((len(neighbour_ids), dimension), dtype=np.float32)
+    for part in np.unique(partition_index[partition_index >= 0]):
+        partition = catalogue["partitions"][part]
+        selected = np.flatnonzero(partition_index == part)
+        rows, inverse = np.unique(entity_index[selected], return_inverse=True)
+        embedding_file = os.path.join(
+            CHECKPOINT_DIRECTORY,
+            f"embeddings_{partition['entity_type']}_{partition['partition_number']}.v{version}.h5",
+        )
+        with h5py.File(embedding_file, "r") as hf:
+            embeddings[selected] = hf["embeddings"][rows][inverse]
+    return embeddings, partition_index >= 0
+
+
+def aggregate_neighbourhoods(neighbourhood_df, embeddings, trained, pbg_config, model):
+    """Averages the embeddings each trained neighbour predicts for the nodes
+
+    Returns:
+        [tuple] -- node ids, entity types and (n, dimension) inferred embeddings
+    """
+    outgoing = neighbourhood_df["outgoing"].to_numpy().astype(bool)
+    entity_types = neighbourhood_df["entity_type"].to_numpy()
+    neighbour_types = neighbourhood_df["neighbour_type"].to_numpy()
+    rel = get_relation_indexes(
+        pbg_config,
+        np.where(outgoing, entity_types, neighbour_types),
+        neighbourhood_df["label"].to_numpy(),
+        np.where(outgoing, neighbour_types, entity_types),
+    )
+    usable = trained & (rel >= 0)
+    global_embeddings = model["global_embeddings"] if pbg_config["global_emb"] else {}
+    predictions = np.zeros_like(embeddings)
+    for relation in np.unique(rel[usable]):
+        relation_config = pbg_config["relations"][relation]
+        parameters = model["operators"].get(int(relation), {})
+        for is_outgoing, transform in [(True, apply_operator), (False, apply_adjoint)]:
+            rows = np.flatnonzero(usable & (rel == relation) & (outgoing == is_outgoing))
+            if not len(rows):
+                continue
+            neighbour_type = relation_config["rhs"] if is_outgoing else relation_config["lhs"]
+            # as PBG's adjust_embs: global embedding, comparator.prepare, then operator
+            predictions[rows] = transform(
+                relation_config["operator"],
+                parameters,
+                prepare(
+                    pbg_config["comparator"],
+                    embeddings[rows] + global_embeddings.get(neighbour_type, 0),
+                    pbg_config["bias"],
+                ),
+            )
+    node_ids = neighbourhood_df["node_id"].to_numpy().astype(np.int64)[usable]
+    predictions, entity_types = predictions[usable], entity_types[usable]
+    order = np.argsort(node_ids, kind="stable")
+    unique_ids, starts, counts = np.unique(
+        node_ids[order], return_index=True, return_counts=True
+    )
+    inferred = np.add.reduceat(predictions[order], starts, axis=0) / counts[:, None]
+    inferred_types = entity_types[order][starts]
+    for entity_type in np.unique(inferred_types):
+        inferred[inferred_types == entity_type] -= global_embeddings.get(entity_type, 0)
+    return unique_ids, inferred_types, inferred.astype(np.float32)
+
+
+# entry function
+def infer(node_ids=None):
+    """Infers embeddings for the given nodes, or for every connected node without a
+    trained embedding, and adds them to model/inferred_embeddings.h5 which the
+    similarity search reads
+
+    Keyword Arguments:
+        node_ids {[list]} -- ids of the nodes (default: {None})
+
+    Returns:
+        [int] -- number of nodes with an inferred embedding
+    """
+    try:
+        initialise_config()
+        logging.info("-------------------------INFERRING EMBEDDINGS------------------------")
+        with track_stage("infer", unit="nodes", profile=True) as record:
+            started = time.perf_counter()
+            version = get_checkpoint_version()
+            checkpoint_id = get_checkpoint_id(CHECKPOINT_DIRECTORY)
+            with open(os.path.join(CHECKPOINT_DIRECTORY, GLOBAL_CONFIG["PBG_CONFIG_NAME"])) as f:
+                pbg_config = json.load(f)
+            f.close()
+            if pbg_config["dynamic_relations"]:
+                raise ValueError("inference is not supported with dynamic_relations")
+            model = load_model_parameters(
+                os.path.join(CHECKPOINT_DIRECTORY, f"model.v{version}.h5")
+            )
+            catalogue = load_entity_catalogue(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
+            batch_size = int(INFERENCE_CONFIG["BATCH_SIZE"])
+            if node_ids is None:
+                node_ids, num_trained = find_untrained_nodes(catalogue, batch_size)
+            else:
+                node_ids = np.unique(np.asarray(node_ids, dtype=np.int64))
+                trained = lookup_entities(catalogue, node_ids)[0] >= 0
+                node_ids, num_trained = node_ids[~trained], int(trained.sum())
+            if num_trained:
+                logging.info(f"{num_trained} nodes already have trained embeddings")
+            logging.info(f"INFERRING EMBEDDINGS FOR {len(node_ids)} NODES")
+            num_inferred = 0
+            for batch_start in range(0, len(node_ids), batch_size):
+                neighbourhood_df = fetch_neighbourhoods(
+                    node_ids[batch_start:batch_start + batch_size]
+                )
+                if neighbourhood_df.empty:
+                    continue
+                embeddings, trained = read_neighbour_embeddings(
+                    neighbourhood_df["neighbour_id"].to_numpy().astype(np.int64),
+                    catalogue,
+                    version,
+                    pbg_config["dimension"],
+                )
+                ids, entity_types, inferred = aggregate_neighbourhoods(
+                    neighbourhood_df, embeddings, trained, pbg_config, model
+                )
+                for entity_type in np.unique(entity_types):
+                    selected = entity_types == entity_type
+                    write_inferred(
+                        CHECKPOINT_DIRECTORY,
+                        checkpoint_id,
+                        entity_type,
+                        ids[selected],
+                        inferred[selected],
+                    )
+                num_inferred += len(ids)
+            if num_inferred:
+                clear_cache(CHECKPOINT_DIRECTORY)  # cached results don't include the new nodes
+            record["count"] = num_inferred
+        seconds = time.perf_counter() - started
+        logging.info(
+            f"INFERRED {num_inferred} EMBEDDINGS ({num_inferred / max(seconds, 1e-9):.0f} nodes/s), "
+            f"{len(node_ids) - num_inferred} NODES WITHOUT TRAINED NEIGHBOURS SKIPPED"
+        )
+        return num_inferred
+    except Exception as e:
+        logging.error(f"Error in inference : {e}", exc_info=True)
+        sys.exit(e)
@@ -0,0 +1,85 @@
+"""Side store for the embeddings of nodes added after training (model/inferred_embeddings.h5).
+One group per entity type holds resizable ids and embeddings datasets. The store belongs
+to one checkpoint, identified by get_checkpoint_id since incremental runs reuse version
+numbers, and is emptied when written for another checkpoint.
+"""
+from pathlib import os
+import h5py
+import numpy as np
+import pandas as pd
+
+STORE_FILE = "inferred_embeddings.h5"
+
+
+def get_store_path(checkpoint_directory):
+    return os.path.join(checkpoint_directory, STORE_FILE)
+
+
+def write_inferred(checkpoint_directory, checkpoint_id, entity_type, ids, embeddings):
+    """Adds embeddings of one entity type to the store, replacing those of ids already in it
+
+    Arguments:
+        checkpoint_directory {[str]} -- model directory
+        checkpoint_id {[str]} -- checkpoint the embeddings were inferred from
+        entity_type {[str]} -- entity type of the nodes
+        ids {[np.ndarray]} -- unique int64 node ids
+        embeddings {[np.ndarray]} -- (n, dimension) embeddings
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    with h5py.File(get_store_path(checkpoint_directory), "a") as hf:
+        if hf.attrs.get("checkpoint_id") != checkpoint_id:
+            for group_name in list(hf.keys()):
+                del hf[group_name]  # inferred from another checkpoint
+            hf.attrs["checkpoint_id"] = checkpoint_id
+        group = hf.require_group(entity_type)
+        if "ids" not in group:
+            group.create_dataset("ids", shape=(0,), maxshape=(None,), dtype=np.int64, chunks=True)
+            group.create_dataset(
+                "embeddings",
+                shape=(0, embeddings.shape[1]),
+                maxshape=(None, embeddings.shape[1]),
+                dtype=np.float32,
+                chunks=True,
+            )
+        positions = pd.Index(group["ids"][...]).get_indexer(ids)
+        existing = positions >= 0
+        if existing.any():
+            order = np.argsort(positions[existing])
+            group["embeddings"][positions[existing][order]] = embeddings[existing][order]
+        num_stored, num_new = group["ids"].shape[0], int((~existing).sum())
+        group["ids"].resize((num_stored + num_new,))
+        group["embeddings"].resize((num_stored + num_new, embeddings.shape[1]))
+        group["ids"][num_stored:] = ids[~existing]
+        group["embeddings"][num_stored:] = embeddings[~existing]
+
+
+def load_inferred(checkpoint_directory, checkpoint_id):
+    """Reads the store
+
+    Returns:
+        [dict] -- (ids, embeddings) by entity type, empty if there is no store for this checkpoint
+    """
+    store_path = get_store_path(checkpoint_directory)
+    if not os.path.exists(store_path):
+        return dict()
+    with h5py.File(store_path, "r") as hf:
+        if hf.attrs.get("checkpoint_id") != checkpoint_id:
+            return dict()
+        return {
+            entity_type: (group["ids"][...], group["embeddings"][...])
+            for entity_type, group in hf.items()
+        }
+
+
+def find_inferred(store, entity_id):
+    """finds a node in the store loaded by load_inferred
+
+    Returns:
+        [tuple] -- entity type and embedding, None if the node is not in the store
+    """
+    for entity_type, (ids, embeddings) in store.items():
+        matches = np.flatnonzero(ids == int(entity_id))
+        if len(matches):
+            return entity_type, embeddings[matches[0]]
+    return None
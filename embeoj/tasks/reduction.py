@@ -0,0 +1,167 @@
+"""Optional dimensionality reduction of the embeddings before indexing.
+A faiss PCAMatrix or OPQMatrix is fitted on a sample of the checkpoint embeddings and
+saved next to the indexes (model/index/transform.faiss). The indexes are built on the
+reduced vectors and query vectors are projected with the same transform.
+"""
+from pathlib import os
+import json
+import faiss
+import h5py
+import numpy as np
+from embeoj.utils import logging
+from embeoj.metrics import track_stage
+
+TRANSFORM_FILE = "transform.faiss"
+REPORT_FILE = "transform.json"
+READ_BLOCK_ROWS = 100000  # most rows read from an embeddings file at once
+
+
+def is_enabled(reduction_config):
+    return bool(reduction_config) and bool(reduction_config.get("METHOD"))
+
+
+def get_reduction_settings(reduction_config):
+    """the settings the indexes depend on, None if no reduction is configured
+    """
+    if not is_enabled(reduction_config):
+        return None
+    return dict(
+        method=reduction_config["METHOD"],
+        dimensions=int(reduction_config["DIMENSIONS"]),
+        opq_subquantizers=int(reduction_config["OPQ_SUBQUANTIZERS"]),
+    )
+
+
+def sample_embeddings(catalogue, checkpoint_directory, version, sample_size, rng):
+    """uniform sample of the embeddings of all partitions. Every block of READ_BLOCK_ROWS
+    rows is read as one slice, from its first to its last sampled row, and subsampled in
+    numpy, which is much faster than h5py's fancy indexing of many scattered rows
+
+    Returns:
+        [np.ndarray] -- (n, dimension) float32 embeddings
+    """
+    counts = np.array([p["count"] for p in catalogue["partitions"]], dtype=np.int64)
+    total = int(counts.sum())
+    sample_size = min(int(sample_size), total)
+    rows = np.sort(rng.choice(total, sample_size, replace=False))
+    offsets = np.append(0, np.cumsum(counts))
+    samples = []
+    for i, partition in enumerate(catalogue["partitions"]):
+        selected = rows[(rows >= offsets[i]) & (rows < offsets[i + 1])] - offsets[i]
+        if not len(selected):
+            continue
+        embedding_file = os.path.join(
+            checkpoint_directory,
+            f"embeddings_{partition['entity_type']}_{partition['partition_number']}.v{version}.h5",
+        )
+        blocks = selected // READ_BLOCK_ROWS
+        bounds = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1], True])
+        with h5py.File(embedding_file, "r") as hf:
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                first, last = selected[start], selected[stop - 1]
+                block = hf["embeddings"][first:last + 1]
+                samples.append(block[selected[start:stop] - first])
+    return np.ascontiguousarray(np.concatenate(samples), dtype=np.float32)
+
+
+def create_transform(settings, dimension):
+    if settings["method"] == "pca":
+        return faiss.PCAMatrix(dimension, settings["dimensions"])
+    if settings["method"] == "opq":
+        return faiss.OPQMatrix(dimension, settings["opq_subquantizers"], settings["dimensions"])
+    raise ValueError(f"unknown reduction method {settings['method']}, use pca or opq")
+
+
+def apply_transform(transform, vectors):
+    if transform is None:
+        return vectors
+    return transform.apply(np.ascontiguousarray(vectors, dtype=np.float32))
+
+
+def drop_query_rows(neighbours, query_rows, k):
+    """the k nearest neighbours of each query without the query itself, which is also
+    indexed, from a search for k + 1 neighbours
+
+    Arguments:
+        neighbours {[np.ndarray]} -- (num_queries, k + 1) rows found for each query
+        query_rows {[np.ndarray]} -- row of each query vector in the index
+
+    Returns:
+        [np.ndarray] -- (num_queries, k) rows
+    """
+    is_query = neighbours == np.asarray(query_rows)[:, None]
+    order = np.argsort(is_query, axis=1, kind="stable")  # other rows first, in rank order
+    return np.take_along_axis(neighbours, order, axis=1)[:, :k]
+
+
+def measure_recall(sample, reduced, num_queries, k, rng):
+    """recall@k of exact search on the reduced vectors against exact search on the
+    original vectors, for sampled query vectors. The queries are rows of the sample,
+    so their self matches are dropped from both searches
+    """
+    queries = rng.choice(len(sample), min(num_queries, len(sample)), replace=False)
+    exact_index = faiss.IndexFlatL2(sample.shape[1])
+    exact_index.add(sample)
+    _, ground_truth = exact_index.search(sample[queries], k + 1)
+    ground_truth = drop_query_rows(ground_truth, queries, k)
+    reduced_index = faiss.IndexFlatL2(reduced.shape[1])
+    reduced_index.add(reduced)
+    _, found = reduced_index.search(reduced[queries], k + 1)
+    found = drop_query_rows(found, queries, k)
+    hits = sum(len(np.intersect1d(f, g)) for f, g in zip(found, ground_truth))
+    return hits / (k * len(queries))
+
+
+def fit_reduction(reduction_config, catalogue, checkpoint_directory, version):
+    """Fits the transform on a sample of the embeddings and saves it with a report of the
+    explained variance and the recall@k of exact search on the reduced vectors
+
+    Returns:
+        [dict] -- report saved to model/index/transform.json
+    """
+    settings = get_reduction_settings(reduction_config)
+    index_directory = os.path.join(checkpoint_directory, "index")
+    rng = np.random.default_rng(reduction_config["SEED"])
+    logging.info(f"FITTING {settings['method'].upper()} TO {settings['dimensions']} DIMENSIONS")
+    with track_stage("index.fit_reduction", unit="vectors") as record:
+        sample = sample_embeddings(
+            catalogue, checkpoint_directory, version, reduction_config["SAMPLE_SIZE"], rng
+        )
+        transform = create_transform(settings, sample.shape[1])
+        transform.train(sample)
+        reduced = apply_transform(transform, sample)
+        centered = sample - sample.mean(axis=0)
+        explained_variance = float(
+            np.square(reduced - reduced.mean(axis=0)).sum() / np.square(centered).sum()
+        )
+        k = int(reduction_config["RECALL_K"])
+        recall = measure_recall(
+            sample, reduced, int(reduction_config["RECALL_QUERIES"]), k, rng
+        )
+        faiss.write_VectorTransform(transform, os.path.join(index_directory, TRANSFORM_FILE))
+        report = dict(
+            **settings,
+            input_dimensions=int(sample.shape[1]),
+            sample_size=int(len(sample)),
+            checkpoint_version=version,
+            explained_variance=explained_variance,
+            **{f"recall@{k}": recall},
+        )
+        with open(os.path.join(index_directory, REPORT_FILE), "w") as f:
+            json.dump(report, f, indent=2)
+        f.close()
+        record["count"] = len(sample)
+    logging.info(
+        f"EXPLAINED VARIANCE {explained_variance:.3f}, RECALL@{k} OF EXACT SEARCH ON "
+        f"REDUCED VECTORS {recall:.3f}"
+    )
+    return report
+
+
+def load_transform(checkpoint_directory):
+    """the fitted transform, None if no reduction was fitted
+    """
+    transform_path = os.path.join(checkpoint_directory, "index", TRANSFORM_FILE)
+    if not os.path.exists(transform_path):
+        return None
+    return faiss.read_VectorTransform(transform_path)
@@ -0,0 +1,195 @@
+"""Cache of similarity search results.
+Results are kept in memory with LRU eviction and a TTL, and optionally in a sqlite file
+next to the checkpoint (model/similarity_cache.sqlite), which outlives the process.
+Keys contain the checkpoint id (version, size and modification time of the model file),
+so results of another checkpoint are never returned, even when an incremental run reused
+its version number, and are dropped when a new checkpoint is seen
+"""
+from collections import OrderedDict
+from pathlib import os
+import json
+import sqlite3
+import time
+from embeoj.utils import logging
+
+CACHE_FILE = "similarity_cache.sqlite"
+
+RESULT_CACHE_CONFIG = None
+memory_cache = OrderedDict()  # key -> (created_at, results), most recently used last
+cache_checkpoint_id = None  # checkpoint of the cached results
+cache_stats = dict(memory_hits=0, disk_hits=0, misses=0)
+
+
+def initialise_config():
+    from embeoj.utils import load_config
+
+    global RESULT_CACHE_CONFIG
+    RESULT_CACHE_CONFIG = load_config("RESULT_CACHE_CONFIG") or dict(ENABLED=False)
+
+
+def is_enabled():
+    return bool(RESULT_CACHE_CONFIG and RESULT_CACHE_CONFIG["ENABLED"])
+
+
+def to_json_value(value):
+    """numpy scalars become python numbers, other values (e.g. neo4j dates) strings
+    """
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def make_key(entity_id, k, filters, settings):
+    """key of a query: node id, number of neighbours, filters and the index settings,
+    which include the checkpoint id
+    """
+    return json.dumps(
+        dict(entity_id=str(entity_id), k=k, filters=filters, settings=settings),
+        sort_keys=True,
+        default=to_json_value,
+    )
+
+
+def get_cache_path(checkpoint_directory):
+    return os.path.join(checkpoint_directory, CACHE_FILE)
+
+
+def connect_disk_cache(checkpoint_directory):
+    connection = sqlite3.connect(get_cache_path(checkpoint_directory))
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS cached_results "
+        "(key TEXT PRIMARY KEY, checkpoint_id TEXT, created_at REAL, results TEXT)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS lookup_counts (name TEXT PRIMARY KEY, count INTEGER)"
+    )
+    return connection
+
+
+def count_lookup(checkpoint_directory, name):
+    """counts a memory hit, disk hit or miss in this process and, with DISK_CACHE, in the
+    sqlite file, so the hit rate covers all the processes sharing the cache
+    """
+    cache_stats[name] += 1
+    if RESULT_CACHE_CONFIG["DISK_CACHE"]:
+        with connect_disk_cache(checkpoint_directory) as connection:
+            connection.execute(
+                "INSERT INTO lookup_counts VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET count = count + 1",
+                (name,),
+            )
+        connection.close()
+
+
+def check_checkpoint(checkpoint_directory, checkpoint_id):
+    """drops the cached results of other checkpoints
+    """
+    global cache_checkpoint_id
+    if cache_checkpoint_id == checkpoint_id:
+        return
+    if cache_checkpoint_id is not None:
+        logging.info(f"checkpoint changed to {checkpoint_id}, clearing the result cache")
+    memory_cache.clear()
+    if RESULT_CACHE_CONFIG["DISK_CACHE"]:
+        with connect_disk_cache(checkpoint_directory) as connection:
+            connection.execute(
+                "DELETE FROM cached_results WHERE checkpoint_id != ?", (checkpoint_id,)
+            )
+        connection.close()
+    cache_checkpoint_id = checkpoint_id
+
+
+def get_cached(checkpoint_directory, checkpoint_id, key):
+    """Looks up the results of a query, first in memory and then on disk
+
+    Returns:
+        [list] -- cached results, None on a miss
+    """
+    check_checkpoint(checkpoint_directory, checkpoint_id)
+    ttl = RESULT_CACHE_CONFIG["TTL_SECONDS"]
+    now = time.time()
+    if key in memory_cache:
+        created_at, results = memory_cache[key]
+        if not ttl or now - created_at < ttl:
+            memory_cache.move_to_end(key)
+            count_lookup(checkpoint_directory, "memory_hits")
+            return results
+        del memory_cache[key]
+    if RESULT_CACHE_CONFIG["DISK_CACHE"]:
+        with connect_disk_cache(checkpoint_directory) as connection:
+            row = connection.execute(
+                "SELECT created_at, results FROM cached_results "
+                "WHERE key = ? AND checkpoint_id = ?",
+                (key, checkpoint_id),
+            ).fetchone()
+        connection.close()
+        if row is not None and (not ttl or now - row[0] < ttl):
+            results = json.loads(row[1])
+            store_in_memory(key, row[0], results)
+            count_lookup(checkpoint_directory, "disk_hits")
+            return results
+    count_lookup(checkpoint_directory, "misses")
+    return None
+
+
+def store_in_memory(key, created_at, results):
+    memory_cache[key] = (created_at, results)
+    memory_cache.move_to_end(key)
+    while len(memory_cache) > int(RESULT_CACHE_CONFIG["MAX_ENTRIES"]):
+        memory_cache.popitem(last=False)  # least recently used
+
+
+def put_cached(checkpoint_directory, checkpoint_id, key, results):
+    """Caches the results of a query in memory and, with DISK_CACHE, on disk. The results
+    are stored as json so both tiers return the same values
+
+    Returns:
+        [list] -- the results as they will be returned from the cache
+    """
+    check_checkpoint(checkpoint_directory, checkpoint_id)
+    serialized = json.dumps(results, default=to_json_value)
+    created_at = time.time()
+    results = json.loads(serialized)
+    store_in_memory(key, created_at, results)
+    if RESULT_CACHE_CONFIG["DISK_CACHE"]:
+        ttl = RESULT_CACHE_CONFIG["TTL_SECONDS"]
+        with connect_disk_cache(checkpoint_directory) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cached_results VALUES (?, ?, ?, ?)",
+                (key, checkpoint_id, created_at, serialized),
+            )
+            if ttl:
+                connection.execute(
+                    "DELETE FROM cached_results WHERE created_at < ?",
+                    (created_at - ttl,),
+                )
+        connection.close()
+    return results
+
+
+def clear_cache(checkpoint_directory):
+    """drops all cached results, e.g. when the inferred embeddings change
+    """
+    memory_cache.clear()
+    cache_path = get_cache_path(checkpoint_directory)
+    if os.path.exists(cache_path):
+        with connect_disk_cache(checkpoint_directory) as connection:
+            connection.execute("DELETE FROM cached_results")
+        connection.close()
+
+
+def get_cache_stats(checkpoint_directory):
+    """hits and misses counted in the sqlite file with DISK_CACHE, since the cache file
+    was created, otherwise those of this process
+
+    Returns:
+        [dict] -- memory_hits, disk_hits, misses and hit_rate
+    """
+    stats = dict(cache_stats)
+    if RESULT_CACHE_CONFIG["DISK_CACHE"]:
+        with connect_disk_cache(checkpoint_directory) as connection:
+            counts = connection.execute("SELECT name, count FROM lookup_counts").fetchall()
+        connection.close()
+        stats = dict(memory_hits=0, disk_hits=0, misses=0)
+        stats.update(counts)
+    lookups = sum(stats.values())
+    hits = stats["memory_hits"] + stats["disk_hits"]
+    return dict(stats, hit_rate=hits / lookups if lookups else None)
@@ -0,0 +1,189 @@
+"""Scores edges with the trained PBG model in numpy, following torchbiggraph's model:
+the global embedding of the entity type is added, the relation operator is applied
+to the rhs side and both sides are prepared for the comparator
+"""
+import h5py
+import numpy as np
+import pandas as pd
+
+L2_EPSILON = 1e-30  # same clamp as torchbiggraph before the square root
+
+
+def load_model_parameters(model_path):
+    """Reads the global embeddings and relation operator parameters of a model.v<n>.h5 file
+
+    Arguments:
+        model_path {[str]} -- path of the model file
+
+    Returns:
+        [dict] -- global_embeddings by entity type, operators by relation index
+    """
+    global_embeddings = dict()
+    operators = dict()
+    with h5py.File(model_path, "r") as hf:
+        model = hf["model"]
+        for entity_type, group in model.get("entities", {}).items():
+            if "global_embedding" in group:
+                global_embeddings[entity_type] = group["global_embedding"][...]
+        for relation_index, group in model.get("relations", {}).items():
+            if "operator" in group and "rhs" in group["operator"]:
+                operators[int(relation_index)] = {
+                    name: dataset[...] for name, dataset in group["operator/rhs"].items()
+                }
+    return dict(global_embeddings=global_embeddings, operators=operators)
+
+
+def apply_operator(operator, parameters, embeddings):
+    """applies a relation operator to a (n, dimension) array of embeddings
+
+    Arguments:
+        operator {[str]} -- operator of the relation in config.json
+        parameters {[dict]} -- operator parameters from load_model_parameters
+        embeddings {[np.ndarray]} -- embeddings of the rhs side
+
+    Returns:
+        [np.ndarray] -- transformed embeddings
+    """
+    if operator == "none" or not parameters:
+        return embeddings
+    if operator == "diagonal":
+        return embeddings * parameters["diagonal"]
+    if operator == "translation":
+        return embeddings + parameters["translation"]
+    if operator == "linear":
+        return embeddings @ parameters["linear_transformation"].T
+    if operator == "affine":
+        return embeddings @ parameters["linear_transformation"].T + parameters["translation"]
+    if operator == "complex_diagonal":
+        half = embeddings.shape[-1] // 2
+        real, imag = embeddings[..., :half], embeddings[..., half:]
+        return np.concatenate(
+            [
+                real * parameters["real"] - imag * parameters["imag"],
+                real * parameters["imag"] + imag * parameters["real"],
+            ],
+            axis=-1,
+        )
+    raise ValueError(f"unsupported operator: {operator}")
+
+
+def apply_adjoint(operator, parameters, embeddings):
+    """applies the adjoint of a relation operator, which maps an lhs embedding to the rhs
+    embedding that scores highest against it with the dot comparator
+    (the inverse for translations)
+
+    Arguments:
+        operator {[str]} -- operator of the relation in config.json
+        parameters {[dict]} -- operator parameters from load_model_parameters
+        embeddings {[np.ndarray]} -- embeddings of the lhs side
+
+    Returns:
+        [np.ndarray] -- embeddings in the rhs space before the operator
+    """
+    if operator == "none" or not parameters:
+        return embeddings
+    if operator == "diagonal":
+        return embeddings * parameters["diagonal"]
+    if operator == "translation":
+        return embeddings - parameters["translation"]
+    if operator == "linear":
+        return embeddings @ parameters["linear_transformation"]
+    if operator == "affine":
+        return (embeddings - parameters["translation"]) @ parameters["linear_transformation"]
+    if operator == "complex_diagonal":
+        half = embeddings.shape[-1] // 2
+        real, imag = embeddings[..., :half], embeddings[..., half:]
+        return np.concatenate(
+            [
+                real * parameters["real"] + imag * parameters["imag"],
+                imag * parameters["real"] - real * parameters["imag"],
+            ],
+            axis=-1,
+        )
+    raise ValueError(f"unsupported operator: {operator}")
+
+
+def get_relation_indexes(pbg_config, lhs, label, rhs):
+    """index in config.json of the relation of each (lhs type, relationship type, rhs type)
+
+    Arguments:
+        pbg_config {[dict]} -- config.json
+        lhs, label, rhs {[np.ndarray]} -- entity and relationship types of the edges
+
+    Returns:
+        [np.ndarray] -- relation index per edge, -1 if the relation is not in the config
+    """
+    columns = ["lhs", "label", "rhs"]
+    config_triples = pd.DataFrame(
+        [(r["lhs"], r["name"], r["rhs"]) for r in pbg_config["relations"]], columns=columns
+    )
+    config_triples["rel"] = np.arange(len(config_triples))
+    edges_df = pd.DataFrame(dict(lhs=lhs, label=label, rhs=rhs))
+    return (
+        edges_df.merge(config_triples.drop_duplicates(columns), how="left", on=columns)["rel"]
+        .fillna(-1)
+        .to_numpy()
+        .astype(np.int64)
+    )
+
+
+def prepare(comparator, embeddings, bias=False):
+    """normalises the embeddings for the cos comparator, keeping the bias dimension
+    """
+    if bias:
+        return np.concatenate(
+            [embeddings[..., :1], prepare(comparator, embeddings[..., 1:])], axis=-1
+        )
+    if comparator == "cos":
+        norm = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norm, L2_EPSILON)
+    return embeddings
+
+
+def score_pairs(comparator, lhs, rhs, bias=False):
+    """scores of n (lhs, rhs) pairs of prepared embeddings
+
+    Returns:
+        [np.ndarray] -- (n,) scores, higher is more likely
+    """
+    if bias:
+        return score_pairs(comparator, lhs[..., 1:], rhs[..., 1:]) + lhs[..., 0] + rhs[..., 0]
+    if comparator in ("dot", "cos"):
+        return np.einsum("ij,ij->i", lhs, rhs)
+    squared = np.square(lhs - rhs).sum(axis=-1)
+    if comparator == "squared_l2":
+        return -squared
+    if comparator == "l2":
+        return -np.sqrt(np.maximum(squared, L2_EPSILON))
+    raise ValueError(f"unsupported comparator: {comparator}")
+
+
+def score_all_pairs(comparator, queries, candidates, bias=False):
+    """scores of every query against every candidate in one matrix product
+
+    Arguments:
+        queries {[np.ndarray]} -- (n, dimension) prepared embeddings
+        candidates {[np.ndarray]} -- (m, dimension) prepared embeddings
+
+    Returns:
+        [np.ndarray] -- (n, m) scores
+    """
+    if bias:
+        return (
+            score_all_pairs(comparator, queries[..., 1:], candidates[..., 1:])
+            + queries[:, :1]
+            + candidates[:, 0]
+        )
+    products = queries @ candidates.T
+    if comparator in ("dot", "cos"):
+        return products
+    squared = (
+        np.square(queries).sum(axis=-1, keepdims=True)
+        + np.square(candidates).sum(axis=-1)
+        - 2 * products
+    )
+    if comparator == "squared_l2":
+        return -squared
+    if comparator == "l2":
+        return -np.sqrt(np.maximum(squared, L2_EPSILON))
+    raise ValueError(f"unsupported comparator: {comparator}")
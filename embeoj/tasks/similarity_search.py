@@ -1,7 +1,13 @@
-import json
 from pathlib import os
-from embeoj.utils import logging, connect_to_graphdb
+from embeoj.utils import logging, connect_to_graphdb, get_checkpoint_id
+from embeoj.catalogue import load_entity_catalogue, lookup_entity, get_partition_ids
+from embeoj.tasks import index as index_task
+from embeoj.tasks import result_cache
 from embeoj.tasks.index import create_indexes, search_all
+from embeoj.tasks.inferred_store import load_inferred, find_inferred
+from embeoj.metrics import track_stage
+from embeoj.node_attributes import get_value_forms
+from embeoj.resources import apply_stage_resources
 import sys
 import re
 
@@ -51,7 +57,7 @@ def find_node(entity_id):
 
 
 def find_entity_data(entity_id):
-    """ Reads the entity_dictionary.json containing ids of all nodes  to locate the index of the entity
+    """ Looks up the node id in the entity catalogue to locate the index of the entity
     
     Arguments:
         entity_id {[str]} -- id of the node to be searched
@@ -63,50 +69,48 @@ def find_entity_data(entity_id):
     try:
         entity = find_node(entity_id)
         logging.info(f"ENTITY FOUND : {entity}")
-        entity_type = entity["entity_type"]
-        entity_id = str(entity["entity_id"])
-        with open(os.path.join(DATA_DIRECTORY, "entity_dictionary.json"), "r") as f:
-            all_entity_dictionary = json.load(f)
-        f.close()
-        entity_dictionaries = [
-            ent
-            for ent in all_entity_dictionary["all_entities"]
-            if ent["entity_type"] == entity_type
-        ]  # get all the dictionaries where the entity label is found
-        entity_dictionary = [
-            entity_dict
-            for entity_dict in entity_dictionaries
-            if entity_id in entity_dict["entity_ids"]
-        ][0]
-        entity_index = entity_dictionary["entity_ids"].index(entity_id)
-        partition_number = int(entity_dictionary["partition_number"])
-        entity_file = entity_dictionary["entity_file"]
-        return dict(
-            entity_index=entity_index,
-            partition_number=partition_number,
-            entity_file=entity_file,
-            entity_type=entity_type,
-        )
+        catalogue = load_entity_catalogue(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
+        entity_data = lookup_entity(catalogue, entity["entity_id"])
+        if entity_data is None:
+            # nodes added after training are looked up in the inferred embeddings
+            store = load_inferred(CHECKPOINT_DIRECTORY, get_checkpoint_id(CHECKPOINT_DIRECTORY))
+            inferred = find_inferred(store, entity["entity_id"])
+            if inferred is None:
+                raise KeyError(
+                    f"node {entity['entity_id']} has no embedding, run the infer task first"
+                )
+            entity_data = dict(
+                entity_type=inferred[0],
+                partition_number=None,
+                entity_index=None,
+                embedding=inferred[1],
+            )
+        entity_data["entity_id"] = int(entity["entity_id"])
+        return entity_data
     except Exception as e:
         logging.error(f"Could not locate data for node : {e}", exc_info=True)
         sys.exit(e)
 
 
-def map_back_to_entities(entity_file_list, search_result, neighbors):
+def map_back_to_entities(entity_file_list, search_result, neighbors, query_entity_id=None):
     count = 1
     all_similar_ents = list()
+    catalogue = load_entity_catalogue(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
+    store = load_inferred(CHECKPOINT_DIRECTORY, get_checkpoint_id(CHECKPOINT_DIRECTORY))
     for result in search_result:
-        entity_file_list_index = int(result[-1] / neighbors)
+        entity_file_list_index = int(result[-1])
         similar_entity_index = int(result[0])
         similar_entity_distance = result[1]
-        if similar_entity_distance == 0:
+        if similar_entity_index < 0:
             continue
-        entity_filename = (
-            f"entity_names_{entity_file_list[entity_file_list_index]}.json"
-        )
-        entity_filepath = os.path.join(DATA_DIRECTORY, entity_filename)
-        node_list = json.load(open(entity_filepath, "r"))
-        similar_entity_id = node_list[similar_entity_index]
+        if entity_file_list_index < len(catalogue["partitions"]):
+            node_list = get_partition_ids(catalogue, entity_file_list_index)
+        else:
+            inferred_type = entity_file_list[entity_file_list_index].replace("inferred_", "", 1)
+            node_list = store[inferred_type][0]
+        similar_entity_id = str(node_list[similar_entity_index])
+        if similar_entity_id == str(query_entity_id):
+            continue  # the query node itself
         similar_entity = find_node(similar_entity_id)
         similar_entity["distance"] = similar_entity_distance
         count += 1
@@ -116,7 +120,73 @@ def map_back_to_entities(entity_file_list, search_result, neighbors):
     return all_similar_ents
 
 
-def similarity_search(entity_id):
+def parse_filters(filter_strings):
+    """Parses field=value search filters. Values given for the same field are alternatives,
+    different fields must all match. Numbers match stored numbers of equal value
+
+    Arguments:
+        filter_strings {[list]} -- e.g. ["status=active", "label=User", "label=Admin"]
+
+    Returns:
+        [dict] -- accepted values by field, None without filters
+    """
+    filters = dict()
+    for filter_string in filter_strings or []:
+        if "=" not in filter_string:
+            raise ValueError(f"filter {filter_string} is not in the form field=value")
+        field, value = filter_string.split("=", 1)
+        filters.setdefault(field.strip(), set()).update(get_value_forms(value.strip()))
+    return {field: sorted(values) for field, values in filters.items()} or None
+
+
+def get_cache_key(entity_id, filters=None):
+    """the node id, number of neighbours, filters and the index settings the results
+    depend on, including the checkpoint id and NPROBE
+    """
+    index_task.initialise_config()
+    settings = dict(index_task.get_index_settings(), nprobe=index_task.NPROBE)
+    k = index_task.SIMILARITY_SEARCH_CONFIG["NEAREST_NEIGHBORS"]
+    return (
+        result_cache.make_key(entity_id, k, filters, settings),
+        settings["checkpoint_id"],
+    )
+
+
+def search_similar_entities(entity_id, filters=None):
+    entity_details = find_entity_data(entity_id)
+    entity_type = entity_details["entity_type"]
+    partition_number = entity_details["partition_number"]
+    # find index of entity id
+    query_index = entity_details["entity_index"]
+    search_result, entity_file_list, neighbors = search_all(
+        entity_type,
+        partition_number,
+        query_index,
+        query_entity_embedding=entity_details.get("embedding"),
+        filters=filters,
+    )
+    return map_back_to_entities(
+        entity_file_list,
+        search_result,
+        neighbors,
+        query_entity_id=entity_details["entity_id"],
+    )
+
+
+def similarity_search(entity_id, filters=None):
+    """Finds the nodes most similar to the given node. Results are served from the
+    result cache when the same query was answered for the current checkpoint
+
+    Arguments:
+        entity_id {[str]} -- id of the node, or a property value of the node
+
+    Keyword Arguments:
+        filters {[dict]} -- only return nodes with one of the values of every field,
+        e.g. {"status": ["active"], "label": ["User"]} (default: {None})
+
+    Returns:
+        [list] -- similar nodes with their distance
+    """
     try:
         from embeoj.utils import load_config
 
@@ -131,22 +201,37 @@ def similarity_search(entity_id):
             GLOBAL_CONFIG["CHECKPOINT_DIRECTORY"],
         )
 
-        create_indexes()  # create indexes if not present
-        entity_details = find_entity_data(entity_id)
-        entity_type = entity_details["entity_type"]
-        partition_number = entity_details["partition_number"]
-        # find index of entity id
-        query_index = entity_details["entity_index"]
-        search_result, entity_file_list, neighbors = search_all(
-            entity_type, partition_number, query_index
-        )
-        all_similar_ents = map_back_to_entities(
-            entity_file_list, search_result, neighbors
-        )
+        result_cache.initialise_config()
+        with track_stage("similarity_search", unit="queries", profile=True) as record:
+            all_similar_ents = None
+            if result_cache.is_enabled():
+                cache_key, checkpoint_id = get_cache_key(entity_id, filters)
+                all_similar_ents = result_cache.get_cached(
+                    CHECKPOINT_DIRECTORY, checkpoint_id, cache_key
+                )
+            if all_similar_ents is None:
+                create_indexes()  # create indexes if not present
+                apply_stage_resources("SEARCH")
+                all_similar_ents = search_similar_entities(entity_id, filters)
+                if result_cache.is_enabled():
+                    all_similar_ents = result_cache.put_cached(
+                        CHECKPOINT_DIRECTORY, checkpoint_id, cache_key, all_similar_ents
+                    )
+            else:
+                logging.info("RESULTS FOUND IN THE RESULT CACHE")
+            if result_cache.is_enabled():
+                stats = result_cache.get_cache_stats(CHECKPOINT_DIRECTORY)
+                record["cache_hit_rate"] = stats["hit_rate"]
+                logging.info(
+                    f"result cache: {stats['memory_hits']} memory hits, "
+                    f"{stats['disk_hits']} disk hits, {stats['misses']} misses"
+                )
+            record["count"] = 1
         logging.info("-----------SIMILAR NODES FOUND----------------")
         for s in all_similar_ents:
             logging.info(s)
             logging.info("------------------------")
+        return all_similar_ents
 
     except Exception as e:
         logging.error(f"Error in search : {e}", exc_info=True)
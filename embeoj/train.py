@@ -3,6 +3,9 @@
 from torchbiggraph.config import parse_config
 from torchbiggraph.converters.import_from_tsv import convert_input_data
 from torchbiggraph.train import train
+from embeoj.metrics import track_stage
+from embeoj.resources import apply_stage_resources, get_stage_resources
+import h5py
 import json
 from pathlib import Path, os
 import sys
@@ -50,9 +53,12 @@ def initialise_config():
     )
 
 
-def load_pbg_config():
+def load_pbg_config(**overrides):
     """ reads config.json file and creates a schema object  for the config
     
+    Keyword Arguments:
+        overrides -- config.json keys to replace for this run (e.g. init_path, num_epochs)
+
     Returns:
         [object] -- Config Schema object for the json file
     """
@@ -66,6 +72,7 @@ def load_pbg_config():
             pbg_config = f.read()
         f.close()
         pbg_config = json.loads(pbg_config)
+        pbg_config.update(overrides)
         pbg_config = parse_config(pbg_config)
         return pbg_config
     except Exception as e:
@@ -74,6 +81,35 @@ def load_pbg_config():
         sys.exit(e)
 
 
+def count_partitioned_edges(pbg_config):
+    """counts the edges stored in the partitioned edge (.h5) files without loading them
+
+    Arguments:
+        pbg_config {[object]} -- Config Schema object
+
+    Returns:
+        [int] -- number of edges over all buckets and edge paths
+    """
+    num_edges = 0
+    for edge_path in pbg_config.edge_paths:
+        for edge_file in Path(edge_path).glob("edges_*_*.h5"):
+            with h5py.File(edge_file, "r") as hf:
+                num_edges += hf["rel"].len()
+    return num_edges
+
+
+def remove_converted_files(pbg_config):
+    """removes entity and edge files of a previous conversion. PBG skips the conversion
+    when they exist, which would train a re-exported graph on the old files
+    """
+    for pattern in ["entity_count_*_*.txt", "entity_names_*_*.json"]:
+        for converted_file in Path(pbg_config.entity_path).glob(pattern):
+            converted_file.unlink()
+    for edge_path in pbg_config.edge_paths:
+        for edge_file in Path(edge_path).glob("edges_*_*.h5"):
+            edge_file.unlink()
+
+
 def convert_tsv_to_pbg():
     """Reads the tsv file for the graph data and related files are created for training graph embeddings.
     """
@@ -84,77 +120,169 @@ def convert_tsv_to_pbg():
         )
         pbg_config = load_pbg_config()
         edge_paths = [Path(name) for name in FILENAMES.values()]
-        convert_input_data(
-            pbg_config.entities,
-            pbg_config.relations,
-            pbg_config.entity_path,
-            pbg_config.edge_paths,
-            edge_paths,
-            lhs_col=0,
-            rhs_col=2,
-            rel_col=1,
+        remove_converted_files(pbg_config)
+        with track_stage("convert", unit="edges", profile=True) as record:
+            convert_input_data(
+                pbg_config.entities,
+                pbg_config.relations,
+                pbg_config.entity_path,
+                pbg_config.edge_paths,
+                edge_paths,
+                lhs_col=0,
+                rhs_col=2,
+                rel_col=1,
+            )
+            record["count"] = count_partitioned_edges(pbg_config)
+    except Exception as e:
+        logging.info("Could not convert to pbg format")
+        logging.info(e, exc_info=True)
+        sys.exit(e)
+
+
+def convert_graph_to_pbg(relation_df=None):
+    """entry function for creating the entity and edge files for training.
+    The native converter writes them straight from the preprocessed relationships,
+    the tsv converter (CONVERSION_CONFIG["CONVERTER"] = tsv) and dynamic relations use
+    PBG's importer on the graph.tsv written by preprocessing
+
+    Keyword Arguments:
+        relation_df {[Dataframe]} -- relationships returned by preprocessing (default: {None})
+    """
+    from embeoj.utils import load_config
+    from embeoj.convert import convert_relations_to_pbg
+    from embeoj.preprocess import is_tsv_required
+
+    try:
+        if relation_df is None:
+            # a graph.tsv found on disk may be left over from an earlier export
+            raise ValueError("no preprocessed relationships, run preprocessing first")
+        conversion_config = load_config("CONVERSION_CONFIG")
+        pbg_config = load_pbg_config()
+        if is_tsv_required(conversion_config, pbg_config.dynamic_relations):
+            if pbg_config.dynamic_relations:
+                logging.info("dynamic relations are converted with the tsv converter")
+            convert_tsv_to_pbg()
+            return
+        logging.info(
+            "-------------------------CREATING FILES FOR TRAINING------------------------"
         )
+        remove_converted_files(pbg_config)
+        with track_stage("convert", unit="edges", profile=True) as record:
+            record["count"] = convert_relations_to_pbg(
+                relation_df, pbg_config, conversion_config["NUM_WORKERS"]
+            )
     except Exception as e:
         logging.info("Could not convert to pbg format")
         logging.info(e, exc_info=True)
         sys.exit(e)
 
 
-def merge_entity_name_files():
-    """merges all the json files having entity names and their ids to one file called entity_dictionary.json
-    this usually takes place in case number of partitions >1.
-    This can then be used for other downstream tasks 
+def build_catalogue():
+    """builds the entity catalogue (data/entity_catalogue) from the entity_names json files
+    of all partitions. Downstream tasks use it to map embedding rows back to node ids
     """
     try:
+        from embeoj.utils import load_metadata
+        from embeoj.catalogue import build_entity_catalogue
+
         global DATA_DIRECTORY
-        global GLOBAL_CONFIG
-        metadata_path = os.path.join(
-            os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], "metadata.json"
-        )  # read metadata
-        with open(metadata_path, "r") as f:
-            metadata = json.load(f)
-        f.close()
-        all_entities = []
-        entity_files = metadata[
+        entity_files = load_metadata()[
             "entity_files"
         ]  # get a list of all json files having entities' ids
-        for entity_file in entity_files:
-            partition_number = int(os.path.splitext(entity_file)[0].split("_")[-1])
-            entity_type = "_".join(
-                os.path.splitext(entity_file)[0]
-                .replace("entity_names_", "")
-                .split("_")[:-1]
-            ).strip(
-                "_"
-            )  # find the entity type
-            entity_file_path = os.path.join(DATA_DIRECTORY, entity_file)
-            entity_data = json.load(open(entity_file_path, "r"))
-            entity_dict = dict(
-                entity_ids=entity_data,
-                entity_type=entity_type,
-                partition_number=partition_number,
-                entity_file=entity_file,
-            )  # creates a dict object for one partition
-            all_entities.append(entity_dict)
-        with open(os.path.join(DATA_DIRECTORY, "entity_dictionary.json"), "w") as f:
-            json.dump(dict(all_entities=all_entities), f)
-        f.close()
+        build_entity_catalogue(DATA_DIRECTORY, entity_files)
     except Exception as e:
-        logging.info("Could not create a file for all the entities")
+        logging.info("Could not create the entity catalogue")
         logging.info(e, exc_info=True)
 
 
-def train_embeddings():
+def get_worker_overrides(pbg_config):
+    """limits the PBG workers of each trainer rank to the TRAIN threads in RESOURCES,
+    shared by the local ranks of a distributed run
+
+    Returns:
+        [dict] -- config.json keys to replace for this run
+    """
+    threads = get_stage_resources("TRAIN")["THREADS"]
+    if not threads:
+        return dict()
+    workers = max(int(threads) // max(pbg_config.num_machines, 1), 1)
+    if pbg_config.workers is not None and pbg_config.workers <= workers:
+        return dict()
+    return dict(workers=workers)
+
+
+def read_pbg_config_file():
+    with open(os.path.join(CHECKPOINT_DIRECTORY, GLOBAL_CONFIG["PBG_CONFIG_NAME"])) as f:
+        config_text = f.read()
+    f.close()
+    return config_text
+
+
+def restore_pbg_config_file(config_text):
+    """PBG saves the config of the run as config.json in the checkpoint directory, which
+    would keep the overrides of this run (init_path, edge_paths, ...) for the next runs
+    """
+    with open(os.path.join(CHECKPOINT_DIRECTORY, GLOBAL_CONFIG["PBG_CONFIG_NAME"]), "w") as f:
+        f.write(config_text)
+    f.close()
+
+
+def train_embeddings(incremental=False):
     """ Train function for generating embeddings
-    Arguments:
-        pbg_config {[object]} -- [config object]
+
+    Keyword Arguments:
+        incremental {bool} -- warm start from the previous checkpoint and train for
+        INCREMENTAL_CONFIG["EPOCHS"] epochs (default: {False})
     """
     try:
+        from embeoj.utils import load_config
+        from embeoj.distributed import launch_distributed_training
+        from embeoj.catalogue import save_trained_fingerprint
+        from embeoj.incremental import (
+            clear_checkpoint,
+            prepare_warm_start,
+            snapshot_entity_names,
+            snapshot_edge_hashes,
+            remove_edge_hashes,
+        )
+
         initialise_config()
-        pbg_config = load_pbg_config()
-        merge_entity_name_files()
+        apply_stage_resources("TRAIN")
+        pbg_config = base_config = load_pbg_config()
+        config_text = read_pbg_config_file()
+        build_catalogue()
+        overrides = get_worker_overrides(pbg_config)
+        if incremental:
+            logging.info("-------------------------WARM START------------------------")
+            with track_stage("train.warm_start", unit="entities"):
+                overrides.update(
+                    prepare_warm_start(
+                        pbg_config, CHECKPOINT_DIRECTORY, load_config("INCREMENTAL_CONFIG")
+                    )
+                )
+        else:
+            clear_checkpoint(CHECKPOINT_DIRECTORY)
+        if overrides:
+            pbg_config = load_pbg_config(**overrides)
+        logging.info(f"PBG workers per trainer: {pbg_config.workers or 'all cores'}")
         logging.info("-------------------------TRAINING------------------------")
-        train(pbg_config)
+        with track_stage("train", unit="edges", profile=True) as record:
+            if pbg_config.num_machines > 1:
+                # one local process per trainer rank and partition server
+                launch_distributed_training(pbg_config, CHECKPOINT_DIRECTORY)
+            else:
+                train(pbg_config)
+            # edges seen over all epochs
+            record["count"] = count_partitioned_edges(pbg_config) * pbg_config.num_epochs
+        if overrides:
+            restore_pbg_config_file(config_text)
+        # ids and edges of this checkpoint, used by the next incremental run
+        snapshot_entity_names(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
+        save_trained_fingerprint(DATA_DIRECTORY, CHECKPOINT_DIRECTORY)
+        if load_config("INCREMENTAL_CONFIG")["TOUCHED_BUCKETS_ONLY"]:
+            snapshot_edge_hashes(base_config, CHECKPOINT_DIRECTORY)
+        else:
+            remove_edge_hashes(CHECKPOINT_DIRECTORY)
     except Exception as e:
         logging.info("error in training")
         logging.info(e, exc_info=True)
@@ -5,6 +5,7 @@ from py2neo import Graph
 import yaml
 from yaml.loader import Loader
 import logging
+import json
 from pathlib import os
 
 
@@ -63,6 +64,12 @@ def test_db_connection():
         return False
 
 
+def quote_name(name):
+    """quotes a label, relationship type or property name for use in a cypher query
+    """
+    return "`" + str(name).replace("`", "``") + "`"
+
+
 def update_config(**kwargs):
     try:
         logging.info("-----------------UPDATING CONFIG-----------------")
@@ -102,3 +109,57 @@ def get_checkpoint_version():
         return version
     except Exception as e:
         logging.error(f"Could locate checkpoint version file: {e}", exc_info=True)
+
+
+def get_checkpoint_id(checkpoint_directory):
+    """identifies the checkpoint files, not only their version: incremental runs restart
+    the version numbers, so a new checkpoint can have the version of an older one
+
+    Returns:
+        [str] -- version, size and modification time of the model file and the
+        fingerprint of the entity catalogue it was trained on
+    """
+    from embeoj.catalogue import read_trained_fingerprint
+
+    version = get_checkpoint_version()
+    checkpoint_id = [f"v{version}"]
+    for checkpoint_file in [f"model.v{version}.h5", "checkpoint_version.txt"]:
+        checkpoint_path = os.path.join(checkpoint_directory, checkpoint_file)
+        if os.path.exists(checkpoint_path):
+            stat = os.stat(checkpoint_path)
+            checkpoint_id.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+    checkpoint_id.append(str(read_trained_fingerprint(checkpoint_directory)))
+    return "-".join(checkpoint_id)
+
+
+def get_metadata_path():
+    GLOBAL_CONFIG = load_config("GLOBAL_CONFIG")
+    return os.path.join(
+        os.getcwd(), GLOBAL_CONFIG["PROJECT_NAME"], "metadata.json"
+    )  # default myproject/metadata.json
+
+
+def load_metadata():
+    """reads metadata.json of the project
+
+    Returns:
+        [dict] -- metadata, empty if the file does not exist yet
+    """
+    metadata_path = get_metadata_path()
+    if not os.path.exists(metadata_path):
+        return dict()
+    with open(metadata_path, "r") as f:
+        metadata = json.load(f)
+    f.close()
+    return metadata
+
+
+def update_metadata(**kwargs):
+    """adds or replaces top level keys of metadata.json, keeping the other keys
+    written by earlier stages
+    """
+    metadata = load_metadata()
+    metadata.update(kwargs)
+    with open(get_metadata_path(), "w") as f:
+        json.dump(metadata, f)
+    f.close()
@@ -1,4 +1,9 @@
-from embeoj.tasks.similarity_search import similarity_search
+from embeoj.tasks.similarity_search import similarity_search, parse_filters
+from embeoj.tasks.evaluate import evaluate
+from embeoj.tasks.benchmark import benchmark
+from embeoj.tasks.infer import infer
+from embeoj.tasks.cluster import cluster
+from embeoj.metrics import set_profiling
 from embeoj.utils import test_db_connection, logging, update_config
 import click
 import sys
@@ -32,12 +37,28 @@ import sys
     prompt=True,
     hide_input=True,
 )
-@click.option("--node", default=None, help="node id of any node in the graph")
+@click.option(
+    "--node",
+    default=None,
+    help="node id of any node in the graph (comma separated ids for infer)",
+)
+@click.option(
+    "--filter",
+    "filters",
+    multiple=True,
+    help="field=value filter for similarity, field is a node property or label (repeatable)",
+)
 @click.option("--config_path", default=None, help="path to a yml config file")
-def tasks(task, project_name, url, username, password, node, config_path):
-    """Command line interface for similarity search on graph embeddings
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="dump cProfile stats of each stage to <project_name>/profiles",
+)
+def tasks(task, project_name, url, username, password, node, filters, config_path, profile):
+    """Command line interface for tasks on graph embeddings: similarity, evaluate, benchmark, infer, cluster
     """
     try:
+        set_profiling(profile)
         if not test_db_connection():
             logging.info("could not connect to Neo4j")
             return
@@ -48,11 +69,23 @@ def tasks(task, project_name, url, username, password, node, config_path):
             neo4j_user=username,
             neo4j_password=password,
         )
-        if node is None:
-            logging.info("Enter node id!!")
-            sys.exit()
         if task == "similarity":
-            similarity_search(node)
+            if node is None:
+                logging.info("Enter node id!!")
+                sys.exit()
+            similarity_search(node, parse_filters(filters))
+        elif task == "evaluate":
+            evaluate()
+        elif task == "benchmark":
+            benchmark()
+        elif task == "infer":
+            infer(None if node is None else [n.strip() for n in node.split(",")])
+        elif task == "cluster":
+            cluster()
+        else:
+            logging.info(
+                f"unknown task {task}, use similarity, evaluate, benchmark, infer or cluster"
+            )
     except Exception as e:
         logging.info(f"error: {e}", exc_info=True)
         sys.exit(e)